@@ -1,76 +1,79 @@
 from __future__ import annotations
-import base64
+from copy import copy
+import re
+import time
 from datetime import datetime # allow referecing types before they are added for type hinting
 from os import getenv, mkdir, path
-import sqlite3
-import bcrypt
 from bson import ObjectId
 from dotenv import load_dotenv
-from flask import Blueprint, flash, g, redirect, render_template, request, url_for
+from io import BytesIO
+from flask import Blueprint, Response, abort, current_app, flash, g, has_app_context, redirect, render_template, request, session, stream_template, url_for
 from flask_login import LoginManager, UserMixin, login_required, login_user, logout_user, current_user
 from flask_wtf import FlaskForm
-import gridfs
-from pymongo import MongoClient
+from werkzeug.local import LocalProxy
 from wtforms import EmailField, PasswordField, RadioField, StringField, SubmitField
 from wtforms.validators import DataRequired, Length
+from extensions import login_manager
+from mongolib.connection import getDatabase
 from mongolib.object import MongoObject
-from flask_mail import Message
+from ridelib import blocking
+from ridelib.cache import TTLCache
+from ridelib.driverstore import DriverStore
+from ridelib.matching import DriverAvailability
+from ridelib.passwords import PasswordServiceBusy
+from ridelib import repository
 from flask_babel import gettext
 from flask_wtf.file import FileField, FileAllowed
 from werkzeug.utils import secure_filename
 
+# pillow is only needed to make thumbnails, without it every size falls back to the original image
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 # load all environment variables from the .env file
 load_dotenv()
 
-instancepath = ''
-try:
-    instancepath = g.instance_path
-except:
-    pass
-
-mail = g.mail
-
-def getSQLiteDB():
-    sqlDB = getattr(g, '_database', None)
-    if sqlDB is None:
-        sqlDB = g._database = sqlite3.connect("drivers.db")
-        createSQLiteTable(sqlDB)
-    return sqlDB
-
-# this will create the table users in our sqlite db
-def createSQLiteTable(sqlDB):
-    cursor = sqlDB.cursor()
-    cursor.execute("""
-                   CREATE TABLE IF NOT EXISTS drivers (
-                   userId VARCHAR(20) PRIMARY KEY,
-                   carType TEXT,
-                     carMake TEXT,
-                        carModel TEXT,
-                        carYear TEXT,
-                        carColor TEXT,
-                        carLicensePlate TEXT)""")
-    sqlDB.commit()
-
-# create the mongo client from the connection string in the .env file
-mongo = MongoClient(getenv("MONGO_URI"))
-db = mongo["mainDatabase"]
-users = db['users']
-rides = db['rides']
-
-fs = gridfs.GridFS(db)
+# queued mail (see create_app in main.py)
+outbox = LocalProxy(lambda: current_app.extensions['outbox'])
+# bcrypt runs on a pool of worker processes, logins are throttled per username and per ip address
+passwords = LocalProxy(lambda: current_app.extensions['passwords'])
+userLoginLimiter = LocalProxy(lambda: current_app.extensions['userLoginLimiter'])
+ipLoginLimiter = LocalProxy(lambda: current_app.extensions['ipLoginLimiter'])
+
+# the drivers' vehicle information (sqlite)
+driverStore = DriverStore(getenv('DRIVERS_DB_PATH', 'drivers.db'), int(getenv('DRIVERS_DB_POOL_SIZE', 8)))
+
+_fs = None
+def getFS():
+    global _fs
+    if (_fs is None):
+        import gridfs
+        _fs = gridfs.GridFS(getDatabase())
+    return _fs
+
+# the longest side (in pixels) of each thumbnail that gets generated when an image is uploaded
+THUMBNAIL_SIZES = {'thumb': 64, 'small': 150}
+# the only types images are stored and served as, never what the browser claimed the upload was
+IMAGE_TYPES = {'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png'}
+PILLOW_IMAGE_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png'}
 
 auth_blueprint = Blueprint('auth', __name__,
                         template_folder='templates')
 
 def logThemIn(user: User) -> None:
     # notify the user that a new login occurred
-    msg = Message(subject="New login from your account!", body="Hello! You logged in at " + str(datetime.now()),
+    # sent in the background so logging in doesn't wait for the mail server
+    outbox.Enqueue(subject="New login from your account!", body="Hello! You logged in at " + str(datetime.now()),
                   sender="no-reply@company.com",
                   recipients=[user.email])
-    mail.send(msg)
     login_user(user)
 
 class User(MongoObject, UserMixin):
+    # users (and drivers) by id, shared by every request in this process
+    cache = TTLCache(int(getenv('USER_CACHE_SIZE', 10000)), float(getenv('USER_CACHE_TTL', 60)))
+
     def __init__(self, id: str, username: str, password: str, email: str, driver: bool, imageId: str):
         self.id = id
         self.username = username
@@ -79,22 +82,40 @@ class User(MongoObject, UserMixin):
         self.driver = driver
         self.imageId = imageId
         if (self.id is None): # Creates a user instance and inserts it into mongodb (also hashes the password)
-            self.password = bcrypt.hashpw(self.password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-            self.id = str(users.insert_one(self.MongoSafeObject()).inserted_id)
+            self.password = passwords.Hash(self.password)
+            self.id = repository.users.Insert(self.MongoSafeObject())
     
-    @property
-    def image(self) -> str|None:
-        binary = fs.find_one({"image_id": self.imageId}).read()
-        return base64.b64encode(binary).decode('utf-8') if binary is not None else None
+    # the url of the user's profile image (or one of its THUMBNAIL_SIZES), None if they didn't upload one
+    def ImageUrl(self, size: str|None = None) -> str|None:
+        if (self.imageId is None):
+            return None
+        return url_for('auth.image', imageId=self.imageId, size=size)
 
     # Verify if a password matches the current instance's password hash
     def MatchPasswordHash(self, password: str) -> bool:
-        return bcrypt.checkpw(password.encode('utf-8'), self.password.encode('utf-8'))
+        return passwords.Check(password, self.password)
 
     # Get user by id (also used by flask-login)
-    @g.login_manager.user_loader
+    # looks in the current request first, then in the process wide cache and only then in the databases
+    @login_manager.user_loader
     def GetUserById(userid: str) -> User|None:
-        user = users.find_one({'_id': ObjectId(userid)})
+        memo = g.setdefault('_users', {}) if has_app_context() else None
+        if (memo is not None and userid in memo):
+            return memo[userid]
+
+        userObj = User.cache.Get(userid)
+        if (userObj is None):
+            userObj = User.LoadUser(userid)
+            if (userObj is None):
+                return None
+            User.cache.Set(userid, userObj)
+        userObj = copy(userObj) # every request gets its own instance so changes to it don't leak into the cache
+        if (memo is not None):
+            memo[userid] = userObj
+        return userObj
+
+    def LoadUser(userid: str) -> User|None:
+        user = repository.users.FindById(userid)
         userObj = User.convertBack(user) if user is not None else None
         if (userObj is None):
             return None
@@ -103,16 +124,35 @@ class User(MongoObject, UserMixin):
             return Driver.GetDriver(userObj)
         else:
             return userObj
+
+    # drop a user from the caches after they change so the next lookup reads them again
+    def ForgetUser(userid: str) -> None:
+        User.cache.Delete(userid)
+        if (has_app_context()):
+            g.get('_users', {}).pop(userid, None)
     
     def GetUserByUsername(username: str) -> User|None:
-        user = users.find_one({'username': username})
+        user = repository.users.FindByUsername(username)
         return User.convertBack(user) if user is not None else None
     
     def GetUsers() -> list[User]:
-        return [User.convertBack(user) for user in users.find({})]
+        return [User.convertBack(user) for user in repository.users.FindAll()]
+
+    # one page of users ordered by id (after the id `after`), optionally only the ones whose username or email starts with `search`
+    # password hashes are never loaded
+    def GetUsersPage(after: str|None = None, search: str|None = None, limit: int = 50) -> UserPage:
+        query = {}
+        if (after):
+            query['_id'] = {'$gt': repository.toObjectId(after)} # the route only passes valid ids
+        if (search):
+            # an anchored, case sensitive prefix can be answered from the username/email indexes
+            prefix = {'$regex': '^' + re.escape(search)}
+            query['$or'] = [{'username': prefix}, {'email': prefix}]
+        return UserPage(repository.users.Page(query, limit), limit)
 
     def Update(self):
-        users.update_one({"_id": ObjectId(self.id)}, {"$set": self.MongoSafeObject()})
+        repository.users.Update(self.id, self.MongoSafeObject())
+        User.ForgetUser(self.id)
 
     def IsUsernameTaken(username: str) -> bool:
         return User.GetUserByUsername(username = username) is not None
@@ -123,33 +163,43 @@ class User(MongoObject, UserMixin):
         return None
     
     def CreateDriver(self, carType: str, carMake: str, carModel: str, carYear: str, carColor: str, carLicensePlate: str) -> Driver:
-        conn = getSQLiteDB()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO drivers VALUES (?, ?, ?, ?, ?, ?, ?)', (self.id, carType, carMake, carModel, carYear, carColor, carLicensePlate))
-        conn.commit()
+        driverStore.Insert(self.id, carType, carMake, carModel, carYear, carColor, carLicensePlate)
+        User.ForgetUser(self.id)
         return Driver.GetDriver(self)
     
+# iterating over a page streams the users out of the cursor one at a time, once it's done `next` holds the id
+# to continue from (None on the last page)
+class UserPage():
+    def __init__(self, cursor, limit: int):
+        self.cursor = cursor
+        self.limit = limit
+        self.next = None
+
+    def __iter__(self):
+        last = None
+        for count, user in enumerate(self.cursor):
+            if (count == self.limit): # we asked for one extra user just to know if there's another page
+                self.next = last
+                break
+            last = str(user['_id'])
+            yield User.convertBack(user)
+
 class Driver(User):
-    def FindDriver(vehicleType: str) -> Driver|None:
-        conn = getSQLiteDB()
-        cursor = conn.cursor()
-        cursor.execute('SELECT userId, carType FROM drivers WHERE carType = ?', (vehicleType,))
-
-        drivers = cursor.fetchall()
-        freeDriver = None
-        for i in drivers:
-            if (rides.find_one({"driverId": i[0]}) is not None):
-                continue
-            freeDriver = Driver.GetDriver(User.GetUserById(i[0]))
-        
-        return freeDriver
+    # drivers that are currently free, kept up to date by the ride exchange (see main.py)
+    availability = DriverAvailability()
 
-    def GetDriver(user: User) -> Driver|None:
-        conn = getSQLiteDB()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM drivers WHERE userId = ?', (user.id,))
+    # find the closest free driver to the pickup point (or any free driver if we don't know where the pickup is)
+    def FindDriver(vehicleType: str, lat: float|None = None, long: float|None = None) -> Driver|None:
+        driverId = Driver.availability.Closest(vehicleType, lat, long)
+        if (driverId is None):
+            return None
+        user = User.GetUserById(driverId)
+        return Driver.GetDriver(user) if user is not None else None
 
-        driver = cursor.fetchone()
+    def GetDriver(user: User) -> Driver|None:
+        if (isinstance(user, Driver)):
+            return user # already loaded (GetUserById returns drivers for driver accounts)
+        driver = driverStore.Get(user.id)
         if (driver is None):
             return None
         
@@ -165,10 +215,8 @@ class Driver(User):
         self.carLicensePlate = carLicensePlate
 
     def UpdateDriver(self):
-        conn = getSQLiteDB()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE drivers SET carType=?, carMake=?, carModel=?, carYear=?, carColor=?, carLicensePlate=? WHERE userId=?', (self.carType, self.carMake, self.carModel, self.carYear, self.carColor, self.carLicensePlate, self.id))
-        conn.commit()
+        driverStore.Update(self.id, self.carType, self.carMake, self.carModel, self.carYear, self.carColor, self.carLicensePlate)
+        User.ForgetUser(self.id)
 
 class LoginForm(FlaskForm):
     username = StringField(gettext('Username'), validators=[DataRequired(), Length(min=3, max=64)])
@@ -192,10 +240,78 @@ class DriverInformationForm(FlaskForm):
     carLicensePlate = StringField(gettext('Car License Plate'), validators=[DataRequired(), Length(min=3, max=64)])
     submit = SubmitField(gettext('Submit'))
 
+# read an uploaded image and make its thumbnails, returns None if it isn't one of IMAGE_TYPES
+# (this is the slow, cpu bound part, so it runs before anything is stored and can be offloaded)
+def prepareImage(image) -> dict|None:
+    data = image.read()
+    filename = secure_filename(image.filename)
+    if (Image is None):
+        # without pillow the extension decides, the type is still one of ours so the browser never gets to pick
+        contentType = IMAGE_TYPES.get(filename.rsplit('.', 1)[-1].lower())
+        return {'data': data, 'filename': filename, 'contentType': contentType, 'thumbnails': {}} if contentType is not None else None
+    try:
+        original = Image.open(BytesIO(data))
+        original.load()
+    except Exception:
+        return None # not something pillow can read
+    contentType = PILLOW_IMAGE_TYPES.get(original.format)
+    if (contentType is None):
+        return None
+    thumbnails = {}
+    for size, pixels in THUMBNAIL_SIZES.items():
+        thumbnail = original.copy()
+        thumbnail.thumbnail((pixels, pixels))
+        output = BytesIO()
+        thumbnail.convert('RGB').save(output, format='JPEG', quality=85)
+        thumbnails[size] = output.getvalue()
+    return {'data': data, 'filename': filename, 'contentType': contentType, 'thumbnails': thumbnails}
+
+# store a prepared image (and its thumbnails) in gridfs
+def saveImage(prepared: dict, imageId: str) -> None:
+    getFS().put(prepared['data'], filename=prepared['filename'], image_id=imageId, contentType=prepared['contentType'])
+    for size, data in prepared['thumbnails'].items():
+        getFS().put(data, filename=f"{size}-{prepared['filename']}", image_id=imageId, size=size, contentType='image/jpeg')
+
+# streams an image straight out of gridfs, browsers can cache it because an image id never changes its content
+@auth_blueprint.route('/image/<imageId>')
+@login_required
+def image(imageId):
+    size = request.args.get('size')
+    if (size is not None and size not in THUMBNAIL_SIZES):
+        abort(404)
+    file = None
+    if (size is not None):
+        file = getFS().find_one({'image_id': imageId, 'size': size})
+    if (file is None):
+        file = getFS().find_one({'image_id': imageId, 'size': None}) # the original
+    if (file is None):
+        abort(404)
+
+    # gridout iterates over the stored chunks, so the image is never loaded into memory at once
+    # files stored before the type was checked could say anything, those are only ever downloaded
+    contentType = file.content_type if file.content_type in IMAGE_TYPES.values() else 'application/octet-stream'
+    response = Response(file, mimetype=contentType, direct_passthrough=True)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.content_length = file.length
+    response.set_etag(str(file._id))
+    response.last_modified = file.upload_date
+    response.cache_control.private = True
+    response.cache_control.max_age = 7 * 24 * 3600
+    return response.make_conditional(request) # answers with 304 if the browser already has this file
+
 #region credentials
+# whether this browser logged in as the admin within the last ADMIN_SESSION_SECONDS
+def isAdmin() -> bool:
+    since = session.get('admin') # a login time (True in sessions from before it expired, which counts as a very old one)
+    if (not isinstance(since, (int, float)) or time.time() - since > current_app.config['ADMIN_SESSION_SECONDS']):
+        session.pop('admin', None)
+        return False
+    return True
+
 @auth_blueprint.route('/logout')
 def logout():
     logout_user()
+    session.pop('admin', None)
     return redirect('/')
 
 @auth_blueprint.route('/admin', methods=['GET', 'POST'])
@@ -204,11 +320,33 @@ def admin():
     if form.validate_on_submit():
         username = form.username.data
         password = form.password.data
-        if bcrypt.checkpw(password.encode('utf-8'), getenv('adminPassword').encode('utf-8')) and username == "admin":
-            return render_template('admin.html', users=User.GetUsers())
+        if (not ipLoginLimiter.Hit(request.remote_addr or '')):
+            flash(gettext('Too many login attempts, please try again later'), 'error')
+            return render_template('login.html', form=form), 429
+        try:
+            matched = username == "admin" and passwords.Check(password, getenv('adminPassword'))
+        except PasswordServiceBusy:
+            flash(gettext("We're busy right now, please try again in a moment"), 'error')
+            return render_template('login.html', form=form), 503
+        if matched:
+            session['admin'] = time.time() # remember the admin (for ADMIN_SESSION_SECONDS) so they can page through the users without logging in again
+            return redirect(url_for('auth.adminUsers'))
         else:
             flash(gettext('Invalid username or password'), 'error')
     return render_template('login.html', form=form)
+
+# the user list for admins, one page at a time and streamed to the browser as it's read from mongo
+@auth_blueprint.route('/admin/users')
+def adminUsers():
+    if (not isAdmin()):
+        return redirect(url_for('auth.admin'))
+    search = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    after = request.args.get('after')
+    if (after and repository.toObjectId(after) is None):
+        abort(400)
+    page = User.GetUsersPage(after, search, limit)
+    return stream_template('admin.html', users=page, search=search, limit=limit)
     
 @auth_blueprint.route('/login', methods=['GET', 'POST'])
 def login():
@@ -219,9 +357,26 @@ def login():
     if form.validate_on_submit():
         username = form.username.data
         password = form.password.data
+        # checked before anything else so a flood of attempts never reaches bcrypt
+        if (not ipLoginLimiter.Hit(request.remote_addr or '') or not userLoginLimiter.Hit(username)):
+            flash(gettext('Too many login attempts, please try again later'), 'error')
+            return render_template('login.html', form=form), 429
         user = User.GetUserByUsername(username = username)
         
-        if user and user.MatchPasswordHash(password):
+        try:
+            matched = user is not None and user.MatchPasswordHash(password)
+        except PasswordServiceBusy:
+            flash(gettext("We're busy right now, please try again in a moment"), 'error')
+            return render_template('login.html', form=form), 503
+        if (matched and passwords.NeedsRehash(user.password)):
+            # the hash was made with an older cost, replace it now that we know the password
+            try:
+                user.password = passwords.Hash(password)
+                user.Update()
+            except PasswordServiceBusy:
+                pass # the old hash still works, it is upgraded on one of their next logins instead
+        if matched:
+            userLoginLimiter.Reset(username)
             if (user.driver):
                 driver = Driver.GetDriver(user)
                 if (driver is None):
@@ -262,14 +417,22 @@ def signup():
         driver = form.accountType.data == 'driver'
 
         if not User.IsUsernameTaken(username):
-            imageId = None
+            imageId = prepared = None
             if (form.image.data is not None):
+                prepared = blocking.offload(prepareImage, form.image.data)
+                if (prepared is None):
+                    flash(gettext('Images only!'), 'error')
+                    return render_template('signup.html', form=form)
                 imageId = str(ObjectId())
-                image = form.image.data
-                filename = secure_filename(image.filename)
-                fs.put(image, filename=filename, image_id=imageId)
 
-            user = User(None, username, password, email, driver, imageId)
+            try:
+                user = User(None, username, password, email, driver, imageId)
+            except PasswordServiceBusy:
+                flash(gettext("We're busy right now, please try again in a moment"), 'error')
+                return render_template('signup.html', form=form), 503
+            # only stored once the user exists, so a failed signup never leaves files behind
+            if (prepared is not None):
+                saveImage(prepared, imageId)
             # automatically log the user in so they dont have to login after signing up
             logThemIn(user)
             if (user.driver):
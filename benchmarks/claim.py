@@ -0,0 +1,70 @@
+# hundreds of drivers racing to claim the same burst of ride requests, checks that every request is won exactly once
+# and reports how long claim attempts take
+#   python benchmarks/claim.py [drivers] [requests] [--redis-url redis://localhost:6379/15]
+import argparse
+import random
+import statistics
+import sys
+import time
+from os import path
+from threading import Barrier, Thread
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from ridelib.pending import PendingRideStore
+
+def burst(store, count: int) -> list[dict]:
+    requests = [{'requestId': f"request{i}", 'userId': f"rider{i}", 'carType': 'sedan', 'textAddress': 'airport', 'time': 'now',
+                 'pickup': {'lat': 32 + random.random() * 0.2, 'long': 34.7 + random.random() * 0.2}} for i in range(count)]
+    for rideRequest in requests:
+        store.Add(rideRequest)
+    return requests
+
+def race(store, drivers: int, requests: list[dict]) -> tuple[dict, list[float], float]:
+    winners = {}
+    latencies = []
+    barrier = Barrier(drivers)
+
+    def driver(driverId: str) -> None:
+        order = requests[:]
+        random.shuffle(order) # every driver goes after the requests in a different order
+        own = []
+        barrier.wait() # everyone starts at the same moment
+        for rideRequest in order:
+            start = time.perf_counter()
+            won = store.Claim(rideRequest['userId'], driverId, 'sedan', rideRequest['requestId'])
+            own.append(time.perf_counter() - start)
+            if (won is not None):
+                winners.setdefault(rideRequest['requestId'], []).append(driverId)
+        latencies.extend(own)
+
+    threads = [Thread(target=driver, args=(f"driver{i}",)) for i in range(drivers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return winners, latencies, time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('drivers', type=int, nargs='?', default=300)
+    parser.add_argument('requests', type=int, nargs='?', default=200)
+    parser.add_argument('--redis-url')
+    args = parser.parse_args()
+
+    if (args.redis_url):
+        from ridelib.state import RedisStateBackend
+        store = RedisStateBackend(args.redis_url, prefix=f"bench-{time.time()}").pending
+    else:
+        store = PendingRideStore()
+
+    requests = burst(store, args.requests)
+    winners, latencies, elapsed = race(store, args.drivers, requests)
+    duplicates = sum(1 for i in winners.values() if len(i) > 1)
+    latencies.sort()
+    print(f"{args.drivers} drivers, {args.requests} requests, {len(latencies)} claim attempts in {elapsed * 1000:.1f} ms")
+    print(f"  claimed: {len(winners)}/{args.requests}   won twice: {duplicates}   left pending: {len(store)}")
+    print(f"  attempts/s: {len(latencies) / elapsed:,.0f}")
+    print(f"  latency p50 {statistics.median(latencies) * 1e6:.1f} us   p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.1f} us   max {latencies[-1] * 1e6:.1f} us")
+    sys.exit(1 if duplicates or len(winners) != args.requests else 0)
@@ -0,0 +1,77 @@
+# converts 100k user shaped documents back and forth with the per class codecs and with the old
+# per document get_type_hints approach, and compares the memory of __dict__ and __slots__ instances
+#   python benchmarks/codec.py [documents]
+import sys
+import time
+import tracemalloc
+from os import path
+from typing import get_type_hints
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from bson import ObjectId
+from mongolib.object import MongoObject
+
+class Statistics(MongoObject):
+    def __init__(self, rides: int, rating: float):
+        self.rides = rides
+        self.rating = rating
+
+class Member(MongoObject):
+    def __init__(self, id: str, username: str, email: str, driver: bool, imageId: str, statistics: Statistics):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.driver = driver
+        self.imageId = imageId
+        self.statistics = statistics
+
+class SlottedMember(MongoObject):
+    __slots__ = ('id', 'username', 'email', 'driver', 'imageId', 'statistics')
+
+    def __init__(self, id: str, username: str, email: str, driver: bool, imageId: str, statistics: Statistics):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.driver = driver
+        self.imageId = imageId
+        self.statistics = statistics
+
+# what MongoObject.convertBack used to do for every document
+def legacyConvertBack(cls, dic: dict):
+    if "_id" in dic:
+        dic['id'] = str(dic['_id'])
+        del dic['_id']
+    initiatorHints = get_type_hints(cls.__init__)
+    for key, value in dic.items():
+        if (isinstance(value, dict)) and initiatorHints.get(key) and issubclass(initiatorHints[key], MongoObject):
+            dic[key] = legacyConvertBack(initiatorHints[key], dic[key])
+    return cls(**dic)
+
+def documents(count: int) -> list[dict]:
+    return [{'_id': ObjectId(), 'username': f"user{i}", 'email': f"user{i}@company.com", 'driver': i % 2 == 0, 'imageId': None,
+             'statistics': {'rides': i, 'rating': 4.5}} for i in range(count)]
+
+def timed(name: str, count: int, function) -> None:
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>28}: {elapsed * 1000:8.1f} ms  ({count / elapsed:,.0f} documents/s)")
+
+def memory(cls, docs: list[dict]) -> float:
+    tracemalloc.start()
+    instances = [cls.convertBack(document) for document in docs]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del instances
+    return size / len(docs)
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    docs = documents(count)
+    timed('legacy convertBack', count, lambda: [legacyConvertBack(Member, dict(document, statistics=dict(document['statistics']))) for document in docs])
+    timed('codec convertBack', count, lambda: [Member.convertBack(document) for document in docs])
+    members = [Member.convertBack(document) for document in docs]
+    timed('codec MongoSafeObject', count, lambda: [member.MongoSafeObject() for member in members])
+    print(f"{'bytes per __dict__ instance':>28}: {memory(Member, docs):8.0f}")
+    print(f"{'bytes per __slots__ instance':>28}: {memory(SlottedMember, docs):8.0f}")
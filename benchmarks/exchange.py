@@ -0,0 +1,217 @@
+# drives simulated riders and drivers through the real socket.io namespaces (with the socket.io test client, in one process)
+# every rider requests a ride on the form, joins the ride exchange and waits, a driver claims it, they chat and the driver
+# finishes the ride; reports rides per second, latency percentiles per step and memory, and can save/compare baselines
+#
+# runs against local stand-ins: mongomock (pip install mongomock) or a local mongod with --mongo-uri,
+# a temporary sqlite drivers database, a static geocoder and mail that is only kept in memory
+#   python benchmarks/exchange.py [riders] [drivers] [--chat 4] [--save baseline.json] [--compare baseline.json]
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# how much slower (or less throughput) than the baseline a run can be before it counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+CENTER = (32.08, 34.78)
+_places = random.Random(0)
+ADDRESSES = {f"street {i}": (CENTER[0] + _places.uniform(-0.05, 0.05), CENTER[1] + _places.uniform(-0.05, 0.05)) for i in range(50)}
+
+class Recorder():
+    def __init__(self):
+        self.latencies = {} # step -> [seconds]
+
+    def Time(self, step: str, call, *args, **kwargs):
+        start = time.perf_counter()
+        result = call(*args, **kwargs)
+        self.latencies.setdefault(step, []).append(time.perf_counter() - start)
+        return result
+
+    def Summary(self) -> dict:
+        summary = {}
+        for step, values in self.latencies.items():
+            values = sorted(values)
+            percentile = lambda p: values[min(int(len(values) * p), len(values) - 1)]
+            summary[step] = {'count': len(values), 'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99), 'max': values[-1]}
+        return summary
+
+def received(client, name: str, namespace: str) -> list:
+    return [i['args'][0] for i in client.get_received(namespace) if i['name'] == name]
+
+def setUp(args, tempdir: str):
+    # the drivers database path is read when auth is imported, so it has to be set before the app is
+    os.environ['DRIVERS_DB_PATH'] = path.join(tempdir, 'drivers.db')
+    from mongolib import connection
+    if (args.mongo_uri):
+        os.environ['MONGO_URI'] = args.mongo_uri
+        os.environ['MONGO_DATABASE'] = f"benchmark{int(time.time())}"
+    else:
+        import mongomock
+        connection._client = mongomock.MongoClient()
+
+    import main
+    from ridelib.geocoding import Geocoder, StaticUpstream
+    app = main.create_app({'MAIL_BACKEND': 'memory', 'TESTING': True, 'WTF_CSRF_ENABLED': False, 'DRIVER_FRAME_RADIUS_KM': args.radius,
+                           'ENSURE_INDEXES': bool(args.mongo_uri), # mongomock doesn't support partial indexes
+                           'OUTBOX_PATH': path.join(tempdir, 'outbox.db'), 'GEOCODE_CACHE_PATH': path.join(tempdir, 'geocode.db')})
+    app.extensions['geocoder'] = Geocoder(StaticUpstream(ADDRESSES), path.join(tempdir, 'geocode.db'))
+    return main, app
+
+def createUsers(riders: int, drivers: int, carType: str) -> tuple[list[str], list[str]]:
+    import bcrypt
+    from auth import driverStore
+    from ridelib import repository
+    # every simulated user shares one cheap hash, they log in through the session and never type it
+    password = bcrypt.hashpw(b'benchmark', bcrypt.gensalt(4)).decode('utf-8')
+    user = lambda name, driver: repository.users.Insert({'username': name, 'password': password, 'email': f"{name}@example.com", 'driver': driver, 'imageId': None})
+    riderIds = [user(f"rider{i}", False) for i in range(riders)]
+    driverIds = [user(f"driver{i}", True) for i in range(drivers)]
+    for i, driverId in enumerate(driverIds):
+        driverStore.Insert(driverId, carType, 'Toyota', 'Corolla', '2020', 'White', f"{i:07}")
+    return riderIds, driverIds
+
+def logIn(app, userId: str):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = userId
+        session['_fresh'] = True
+    return client
+
+def run(args) -> dict:
+    with tempfile.TemporaryDirectory() as tempdir:
+        main, app = setUp(args, tempdir)
+        socketio = main.socketio
+        riderIds, driverIds = createUsers(args.riders, args.drivers, args.car_type)
+        recorder = Recorder()
+        if (args.trace_memory):
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        drivers = []
+        for driverId in driverIds:
+            http = logIn(app, driverId)
+            lat, long = CENTER[0] + random.uniform(-0.05, 0.05), CENTER[1] + random.uniform(-0.05, 0.05)
+            socket = socketio.test_client(app, namespace='/rideExchange', flask_test_client=http)
+            socket.connect('/rideChat')
+            socket.connect('/ride')
+            drivers.append({'id': driverId, 'http': http, 'socket': socket, 'lat': lat, 'long': long})
+
+        completed = 0
+        # the riders come in waves of one rider per driver, every driver takes one ride per wave
+        for wave in range(0, len(riderIds), len(drivers)):
+            for driver in drivers:
+                recorder.Time('driver join', driver['socket'].emit, 'join', {'lat': driver['lat'], 'long': driver['long']}, namespace='/rideExchange')
+                recorder.Time('GET / (driver)', driver['http'].get, f"/?lat={driver['lat']}&long={driver['long']}")
+
+            riders = []
+            for riderId in riderIds[wave:wave + len(drivers)]:
+                http = logIn(app, riderId)
+                address = random.choice(list(ADDRESSES))
+                pickup = (CENTER[0] + random.uniform(-0.05, 0.05), CENTER[1] + random.uniform(-0.05, 0.05))
+                response = recorder.Time('POST / (request ride)', http.post, '/', data={'address': address, 'nowOrLater': 'now', 'vehicleType': args.car_type, 'lat': pickup[0], 'long': pickup[1]})
+                assert response.status_code == 200, response.status_code
+                socket = socketio.test_client(app, namespace='/rideExchange', flask_test_client=http)
+                socket.connect('/rideChat')
+                recorder.Time('rider join', socket.emit, 'join', {'address': {'lat': ADDRESSES[address][0], 'long': ADDRESSES[address][1]}, 'textAddress': address,
+                                                                  'pickup': {'lat': pickup[0], 'long': pickup[1]}, 'time': 'now', 'carType': args.car_type}, namespace='/rideExchange')
+                riders.append({'id': riderId, 'socket': socket})
+
+            # send the drivers whatever is still waiting for the end of the frame window
+            app.extensions['broadcaster'].Flush()
+            # every driver has been told about every request near them in the wave, each one claims a different rider
+            for driver, rider in zip(drivers, riders):
+                offers = {i['userId']: i for frame in received(driver['socket'], 'giveride', '/rideExchange') for i in frame['added']}
+                rideRequest = offers[rider['id']]
+                recorder.Time('selrid', driver['socket'].emit, 'selrid', {'userId': rider['id'], 'carType': args.car_type, 'requestId': rideRequest['requestId']}, namespace='/rideExchange')
+                redirect = received(driver['socket'], 'redirect', '/rideExchange')
+                assert redirect, "the driver didn't get the ride"
+                rideId = redirect[0]['url'].rsplit('/', 1)[1]
+                assert received(rider['socket'], 'gotride', '/rideExchange')[0]['rideId'] == rideId
+
+                recorder.Time('GET /ride/<rideId>', driver['http'].get, f"/ride/{rideId}")
+                for who in (driver, rider):
+                    recorder.Time('chat join', who['socket'].emit, 'join', {'id': rideId}, namespace='/rideChat')
+                for i in range(args.chat):
+                    who = driver if i % 2 else rider
+                    recorder.Time('chat', who['socket'].emit, 'chat', {'id': rideId, 'message': f"message {i}"}, namespace='/rideChat')
+                recorder.Time('ride join', driver['socket'].emit, 'join', {'id': rideId}, namespace='/ride')
+                recorder.Time('triggerarrived', driver['socket'].emit, 'triggerarrived', {'id': rideId}, namespace='/ride')
+                completed += 1
+                rider['socket'].disconnect('/rideChat')
+                rider['socket'].disconnect('/rideExchange')
+            for driver in drivers:
+                driver['socket'].get_received('/rideExchange') # drop whatever is left from this wave
+                driver['socket'].get_received('/rideChat')
+                driver['socket'].get_received('/ride')
+        elapsed = time.perf_counter() - start
+
+        memory = {'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        if (args.trace_memory):
+            memory['python_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+        app.extensions['outbox'].Stop()
+        return {'config': {'riders': args.riders, 'drivers': args.drivers, 'chat': args.chat, 'mongo': 'mongod' if args.mongo_uri else 'mongomock', 'python': platform.python_version()},
+                'rides': completed, 'seconds': elapsed, 'rides_per_second': completed / elapsed, 'memory': memory, 'steps': recorder.Summary()}
+
+# the steps whose p95 (or the overall throughput) got worse than the baseline by more than `tolerance`
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    if (result['rides_per_second'] < baseline['rides_per_second'] * (1 - tolerance)):
+        regressions.append(f"rides/s {baseline['rides_per_second']:.1f} -> {result['rides_per_second']:.1f}")
+    for step, stats in result['steps'].items():
+        before = baseline['steps'].get(step)
+        if (before is not None and stats['p95'] > before['p95'] * (1 + tolerance)):
+            regressions.append(f"{step} p95 {before['p95'] * 1000:.2f} ms -> {stats['p95'] * 1000:.2f} ms")
+    return regressions
+
+def report(result: dict, baseline: dict|None) -> None:
+    print(f"{result['rides']} rides ({result['config']['riders']} riders, {result['config']['drivers']} drivers, {result['config']['mongo']}) in {result['seconds']:.2f} s")
+    print(f"  rides/s: {result['rides_per_second']:.1f}" + (f"   (baseline {baseline['rides_per_second']:.1f})" if baseline else ''))
+    print('  memory: ' + '   '.join(f"{key} {value:.1f}" for key, value in result['memory'].items()))
+    print(f"  {'step':<24}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}" + (f"{'base p95':>10}" if baseline else ''))
+    for step, stats in result['steps'].items():
+        line = f"  {step:<24}{stats['count']:>7}{stats['p50'] * 1000:>10.2f}{stats['p95'] * 1000:>10.2f}{stats['p99'] * 1000:>10.2f}{stats['max'] * 1000:>10.2f}"
+        if (baseline and step in baseline['steps']):
+            line += f"{baseline['steps'][step]['p95'] * 1000:>10.2f}"
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('riders', type=int, nargs='?', default=200)
+    parser.add_argument('drivers', type=int, nargs='?', default=20)
+    parser.add_argument('--chat', type=int, default=4, help="chat messages per ride")
+    parser.add_argument('--car-type', default='sedan')
+    parser.add_argument('--radius', type=float, default=20, help="only tell drivers about requests this close to them (0 tells every driver)")
+    parser.add_argument('--mongo-uri', help="a local mongod to use instead of mongomock (a new database is created for every run)")
+    parser.add_argument('--trace-memory', action='store_true', help="also report the python heap peak (slows everything down)")
+    parser.add_argument('--save', help="write the results to this json file as the new baseline")
+    parser.add_argument('--compare', help="a baseline json file to compare against, exits with 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    result = run(args)
+    baseline = None
+    if (args.compare):
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    report(result, baseline)
+    if (args.save):
+        with open(args.save, 'w') as file:
+            json.dump(result, file, indent=2)
+    if (baseline is not None):
+        regressions = compare(result, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"  REGRESSION: {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,37 @@
+# prices a burst of pending requests one at a time in python and in one batch with FareEngine (numpy)
+#   python benchmarks/fares.py [requests]
+import random
+import sys
+import time
+from datetime import datetime
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from ridelib.fares import DEFAULT_HOURLY_MULTIPLIERS, DEFAULT_RATES, FareEngine
+from ridelib.geo import haversine
+
+def pythonQuote(rideRequest: dict, when: datetime, speedKmh: float = 30, roadFactor: float = 1.3) -> dict:
+    rates = DEFAULT_RATES.get(rideRequest['carType'], DEFAULT_RATES['default'])
+    distance = haversine(rideRequest['pickup']['lat'], rideRequest['pickup']['long'], rideRequest['address']['lat'], rideRequest['address']['long']) * roadFactor
+    minutes = distance / speedKmh * 60
+    fare = max(rates['minimum'], (rates['base'] + rates['perKm'] * distance + rates['perMinute'] * minutes) * DEFAULT_HOURLY_MULTIPLIERS[when.hour])
+    return {'fare': round(fare, 2), 'distanceKm': round(distance, 2), 'minutes': int(round(minutes))}
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    point = lambda: {'lat': 32.08 + random.uniform(-0.1, 0.1), 'long': 34.78 + random.uniform(-0.1, 0.1)}
+    requests = [{'carType': random.choice(['sedan', 'van', 'luxury']), 'pickup': point(), 'address': point()} for _ in range(count)]
+    when = datetime.now()
+    engine = FareEngine()
+    engine.QuoteRequests(requests[:1], when) # load numpy before timing
+
+    start = time.perf_counter()
+    loop = [pythonQuote(i, when) for i in requests]
+    looped = time.perf_counter() - start
+    start = time.perf_counter()
+    batch = engine.QuoteRequests(requests, when)
+    batched = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(loop, batch) if abs(a['fare'] - b['fare']) > 0.011)
+    print(f"{count} requests: python loop {looped * 1000:.1f} ms   numpy batch {batched * 1000:.1f} ms   ({looped / batched:.1f}x)   mismatched fares: {mismatches}")
@@ -0,0 +1,62 @@
+# a login storm: many threads checking passwords at once, with bcrypt either running in the request threads
+# or on the PasswordHasher's process pool, while a probe measures how late a tiny recurring task
+# (standing in for socket.io traffic) gets to run
+#   python benchmarks/login.py [concurrency] [logins] [--rounds 12] [--workers 2]
+import argparse
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from threading import Event, Thread
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from ridelib.passwords import PasswordHasher
+
+# how late (in seconds) a 10ms timer fires while the storm is going on
+def probe(stop: Event, lags: list[float]) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        time.sleep(0.01)
+        sum(range(1000)) # a little python work, like handling an event
+        lags.append(time.perf_counter() - start - 0.01)
+
+def storm(hasher: PasswordHasher, hashed: str, concurrency: int, logins: int) -> dict:
+    hasher.Check('benchmark', hashed) # start the workers before timing
+    latencies = []
+    lags = []
+    stop = Event()
+    prober = Thread(target=probe, args=(stop, lags))
+    prober.start()
+
+    def login(_) -> None:
+        start = time.perf_counter()
+        assert hasher.Check('benchmark', hashed)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    prober.join()
+    latencies.sort()
+    lags.sort()
+    return {'logins/s': logins / elapsed, 'p50 ms': statistics.median(latencies) * 1000, 'p95 ms': latencies[int(len(latencies) * 0.95)] * 1000,
+            'probe lag p50 ms': statistics.median(lags) * 1000, 'probe lag p99 ms': lags[int(len(lags) * 0.99)] * 1000}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('concurrency', type=int, nargs='?', default=32)
+    parser.add_argument('logins', type=int, nargs='?', default=200)
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    hashed = PasswordHasher(args.rounds, workers=0).Hash('benchmark')
+    # maxPending is as large as the storm so nobody is turned away and only the speed is compared
+    for name, hasher in [('inline', PasswordHasher(args.rounds, 0, args.concurrency)), (f"pool of {args.workers}", PasswordHasher(args.rounds, args.workers, args.concurrency))]:
+        result = storm(hasher, hashed, args.concurrency, args.logins)
+        hasher.Close()
+        print(f"{name:>10}: " + '   '.join(f"{key} {value:.1f}" for key, value in result.items()))
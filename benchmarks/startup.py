@@ -0,0 +1,42 @@
+# measures how long a fresh worker takes to import the app, build it with create_app and answer its first request
+# every run is a new python process so nothing is already imported or cached, and gets its own temporary sqlite files
+#   python benchmarks/startup.py [runs]
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app({'MAIL_BACKEND': 'memory', 'ENSURE_INDEXES': False, 'TESTING': True})
+created = time.perf_counter()
+response = app.test_client().get('/auth/login')
+answered = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({'import': imported - start, 'create_app': created - imported, 'first_request': answered - created, 'total': answered - start}))
+"""
+
+def run(runs: int) -> dict[str, list[float]]:
+    results = {}
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as tempdir:
+            # the outbox, geocoding cache and drivers databases go to the temporary directory instead of the working tree
+            env = dict(os.environ, OUTBOX_PATH=path.join(tempdir, 'outbox.db'), GEOCODE_CACHE_PATH=path.join(tempdir, 'geocode.db'),
+                       DRIVERS_DB_PATH=path.join(tempdir, 'drivers.db'))
+            output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+        for key, value in json.loads(output.strip().splitlines()[-1]).items():
+            results.setdefault(key, []).append(value)
+    return results
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for key, values in run(runs).items():
+        print(f"{key:>14}: median {statistics.median(values) * 1000:8.1f} ms   min {min(values) * 1000:8.1f} ms")
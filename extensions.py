@@ -0,0 +1,10 @@
+from flask_babel import Babel
+from flask_login import LoginManager
+from flask_socketio import SocketIO
+
+# the flask extensions are created here without an app so any module can import them,
+# create_app (in main.py) binds them to the app
+socketio = SocketIO()
+babel = Babel()
+# renaming this causes a lot of internal errors
+login_manager = LoginManager()
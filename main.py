@@ -1,339 +1,676 @@
-from datetime import datetime
 from gettext import gettext
-import random
-import sqlite3
+import hmac
+import json
+import logging
+import time
 from bson import ObjectId
 from dotenv import load_dotenv
-from flask import Flask, flash, g, redirect, render_template, request
-from flask_login import LoginManager, current_user, login_required
-from flask_socketio import SocketIO, emit, join_room, Namespace
-from pymongo import MongoClient
-import requests
-from flask_mail import Message
-from flask_mail import Mail
-from flask_babel import Babel
+from flask import Blueprint, Flask, Response, current_app, flash, g, jsonify, redirect, render_template, request
+from flask_login import current_user, login_required
+from flask_socketio import emit, join_room, Namespace
 from os import getenv
 from flask_wtf import FlaskForm
+from werkzeug.local import LocalProxy
 from wtforms import HiddenField, RadioField, SelectField, StringField, SubmitField
 from wtforms.validators import DataRequired
-import folium
+from extensions import babel, login_manager, socketio
+from mongolib import connection
+from mongolib.connection import LazyCollection, getDatabase
+from ridelib.active import ActiveRides
+from ridelib.broadcast import RideRequestBroadcaster
+from ridelib import blocking
+from ridelib.chat import ChatStore
+from ridelib.fares import FareEngine
+from ridelib.geocoding import Geocoder, GeocodingError, NominatimUpstream
+from ridelib.indexes import ensureIndexes
+from ridelib.maps import RideMaps, ridePoints
+from ridelib import metrics
+from ridelib.outbox import FlaskMailTransport, MemoryTransport, Outbox
+from ridelib.passwords import PasswordHasher, RateLimiter
+from ridelib.repository import PARTICIPANTS_PROJECTION, rides
+from ridelib.state import createStateBackend
+from ridelib.tracking import RideTracker
 
 from werkzeug import exceptions as HttpErrors # stores http error status codes in a readable way
 
-app = Flask(__name__)
-
-socketio = SocketIO(app)
-
 load_dotenv()
 
-app.config['MAIL_SERVER']='sandbox.smtp.mailtrap.io'
-app.config['MAIL_PORT'] = 2525
-app.config['MAIL_USERNAME'] = getenv('MAIL_USERNAME')
-app.config['MAIL_PASSWORD'] = getenv('MAIL_PASSWORD')
-app.config['MAIL_USE_TLS'] = True
-app.config['MAIL_USE_SSL'] = False
-
-# randomize secret key for development (you will need to reauthenticate whenever you restart the server)
-app.config['SECRET_KEY'] = 'test'#str(ObjectId())
-
-mail = Mail(app)
-
-babel = Babel(app)
-
-app.config['LANGUAGES'] = {
-    'en': 'English',
-    'fr': 'French',
-    'ar': 'Arabic'
-}
-
-# renaming this causes a lot of internal errors
-login_manager = LoginManager()
-login_manager.init_app(app)
-# tell the login manager to use the login route to redirect users to when they try to access areas that require authentication
-login_manager.login_view = 'auth.login'
-
-mongo = MongoClient(getenv("MONGO_URI"))
-db = mongo["mainDatabase"]
-rides = db['rides']
+from auth import Driver, User, driverStore, isAdmin
+
+main_blueprint = Blueprint('main', __name__)
+
+# services that create_app sets up for the app, these proxies always point at the current app's instance
+geocoder = LocalProxy(lambda: current_app.extensions['geocoder'])
+outbox = LocalProxy(lambda: current_app.extensions['outbox'])
+chats = LocalProxy(lambda: current_app.extensions['chats'])
+rideMaps = LocalProxy(lambda: current_app.extensions['rideMaps'])
+activeRides = LocalProxy(lambda: current_app.extensions['activeRides'])
+broadcaster = LocalProxy(lambda: current_app.extensions['broadcaster'])
+fares = LocalProxy(lambda: current_app.extensions['fares'])
+tracker = LocalProxy(lambda: current_app.extensions['tracker'])
+
+requestLatency = metrics.histogram('http_request_seconds', 'Time spent handling http requests', ('route', 'method', 'status'))
+requestsInFlight = metrics.gauge('http_requests_in_flight', 'Http requests being handled right now')
+eventLatency = metrics.histogram('socketio_event_seconds', 'Time spent handling socket.io events', ('namespace', 'event'))
+eventsInFlight = metrics.gauge('socketio_events_in_flight', 'Socket.io events being handled right now', ('namespace',))
+mongoLatency = metrics.histogram('mongo_command_seconds', 'Time spent on mongo commands', ('command', 'collection'))
+mongoFailures = metrics.counter('mongo_command_failures_total', 'Mongo commands that failed', ('command', 'collection'))
+
+def observeMongoCommand(command: str, collection: str, seconds: float, failed: bool) -> None:
+    mongoLatency.Observe(seconds, command, collection)
+    if (failed):
+        mongoFailures.Inc(command, collection)
+connection.commandMetrics.observers.append(observeMongoCommand)
+
+# mongo commands slower than this are logged as warnings (create_app sets it from MONGO_SLOW_MS)
+# the listener is per process, so this observer is registered once here instead of once per app
+slowMongoSeconds = 0.2
+def logSlowMongoCommand(command: str, collection: str, seconds: float, failed: bool) -> None:
+    if (seconds >= slowMongoSeconds):
+        logging.getLogger(__name__).warning(f"Slow mongo command: {command} {collection} took {seconds * 1000:.1f}ms")
+connection.commandMetrics.observers.append(logSlowMongoCommand)
+
+def countPendingRides() -> dict:
+    pending = RideExchangeNamespace.pendingRideRequests
+    if (pending is None):
+        return {}
+    return {(carType,): pending.Count(carType) for carType in driverStore.CarTypes()}
+metrics.gauge('pending_ride_requests', 'Ride requests waiting for a driver', ('car_type',), collect=countPendingRides)
+
+droppedRides = metrics.counter('pending_ride_requests_dropped_total', 'Ride requests dropped before a driver took them', ('reason',))
 
 def get_locale():
     try:
-        return request.accept_languages.best_match(app.config['LANGUAGES'].keys())
+        return request.accept_languages.best_match(current_app.config['LANGUAGES'].keys())
     except:
         return 'en'
 
-babel.init_app(app, locale_selector=get_locale)
-
-def getSQLiteDB():
-    sqlDB = getattr(g, '_database', None)
-    if sqlDB is None:
-        sqlDB = g._database = sqlite3.connect("drivers.db")
-        createSQLiteTable(sqlDB)
-    return sqlDB
-
-# this will create the table users in our sqlite db
-def createSQLiteTable(sqlDB):
-    cursor = sqlDB.cursor()
-    cursor.execute("""
-                   CREATE TABLE IF NOT EXISTS drivers (
-                   userId VARCHAR(20) PRIMARY KEY,
-                   carType TEXT,
-                     carMake TEXT,
-                        carModel TEXT,
-                        carYear TEXT,
-                        carColor TEXT,
-                        carLicensePlate TEXT)""")
-    sqlDB.commit()
-
-# we need to use with app context because if we import from auth it will hit the line that uses "g" (in the auth module)
-    # so we need to have already defined all of the g variables before referencing auth which we need the appcontext for
-with app.app_context():
-    g.mail = mail
-    g.login_manager = login_manager
-    g.babel = babel
-    g.instance_path = app.instance_path
-    from auth import Driver, User
-    @app.route('/', methods=['GET', 'POST'])
-    @login_required
-    def index():
-            if (current_user.driver):
-                # a page for the driver to view all of their pending rides
-                if (current_user.carType not in RideExchangeNamespace.pendingRideRequests):
-                    RideExchangeNamespace.pendingRideRequests[current_user.carType] = []
-                return render_template('driver.html', pendingRides=RideExchangeNamespace.pendingRideRequests[current_user.carType])
+@main_blueprint.route('/', methods=['GET', 'POST'])
+@login_required
+def index():
+        if (current_user.driver):
+            # a page for the driver to view the pending rides closest to them
+            pending = RideExchangeNamespace.pendingRideRequests
+            limit = current_app.config['PENDING_RIDES_LIMIT']
+            lat, long = request.args.get('lat', type=float), request.args.get('long', type=float)
+            if (lat is not None and long is not None):
+                pendingRides = pending.Nearest(current_user.carType, lat, long, limit, current_app.config['PENDING_RIDES_RADIUS_KM'])
             else:
-                form = RequestRide()
-                conn = getSQLiteDB()
-                cursor = conn.cursor()
-                cursor.execute('SELECT DISTINCT carType FROM drivers')
-                form.vehicleType.choices = [(i[0], i[0]) for i in cursor.fetchall()]
-                if form.validate_on_submit():
-                    if (form.nowOrLater.data == "now" and (form.time.data is not None and form.time.data != "")):
-                        flash("You can't define the time when you are requesting a ride for now!")
-                    else:
-                        driver = Driver.FindDriver(form.vehicleType.data)
-                        # get the long/lat from a text address
-                        base_url = 'https://nominatim.openstreetmap.org/search'
-
-                        params = {
-                            'q': form.address.data,
-                            'format': 'json',
+                # we don't know where the driver is yet (the page will ask the browser for it)
+                pendingRides = [dict(i) for i in pending.All(current_user.carType, limit)]
+            # requests are quoted when they're added, anything that wasn't (added before quoting existed) is quoted here in one batch
+            unquoted = [i for i in pendingRides if 'quote' not in i]
+            for rideRequest, quote in zip(unquoted, fares.QuoteRequests(unquoted)):
+                rideRequest['quote'] = quote
+            return render_template('driver.html', pendingRides=pendingRides, located=lat is not None and long is not None, driverLocation={'lat': lat, 'long': long})
+        else:
+            form = RequestRide()
+            form.vehicleType.choices = [(i, i) for i in driverStore.CarTypes()]
+            if form.validate_on_submit():
+                if (form.nowOrLater.data == "now" and (form.time.data is not None and form.time.data != "")):
+                    flash("You can't define the time when you are requesting a ride for now!")
+                else:
+                    # get the long/lat from a text address
+                    try:
+                        location = geocoder.Lookup(form.address.data)
+                    except GeocodingError:
+                        current_app.logger.exception("Geocoding failed")
+                        flash("We couldn't look up that address right now, please try again!")
+                        return render_template('rider.html', form=form)
+
+                    if location is not None:
+                        lat, lng = location
+                        # create the ride request object so the page can broadcast it to all drivers
+                        data = {'userId': current_user.id, 'address': { 'long': lng, 'lat': lat }, 'textAddress': form.address.data, 
+                            'pickup': {'long': form.long.data, 'lat': form.lat.data},
+                            'time': form.time.data if form.nowOrLater.data != "now" else 'now', 'id': current_user.id, 'carType': form.vehicleType.data
                         }
-
-                        response = requests.get(base_url, params=params)
-                        data = response.json()
-
-                        if response.status_code == 200 and data:
-                            location = data[0] # pick the first matching location
-                            lat, lng = location['lat'], location['lon']
-                            # create the ride request object so the page can broadcast it to all drivers
-                            data = {'userId': current_user.id, 'address': { 'long': lng, 'lat': lat }, 'textAddress': form.address.data, 
-                                'pickup': {'long': form.long.data, 'lat': form.lat.data},
-                                'time': form.time.data if form.nowOrLater.data != "now" else 'now', 'id': current_user.id, 'carType': form.vehicleType.data
-                            }
-                            return render_template('waiting.html', data=data)
-                        else:
-                            flash("Invalid address!")
-                return render_template('rider.html', form=form)
-
-    # this route shows ride details
-    @app.route('/ride/<rideId>')
+                        return render_template('waiting.html', data=data)
+                    else:
+                        flash("Invalid address!")
+            return render_template('rider.html', form=form)
+
+# this route shows ride details
+@main_blueprint.route('/ride/<rideId>')
+@login_required
+def rideDetails(rideId):
+    ride = rides.FindForUser(rideId, current_user.id)
+    if (ride is None):
+        return redirect('/')
+    if (ride.get('arrived')):
+        return redirect(f'/ride/{rideId}/invoice')
+
+    rider = User.GetUserById(ride['riderId'])
+    driver = Driver.GetDriver(User.GetUserById(ride['driverId']))
+
+    map = None
+    # the live driver marker is drawn on the browser's map, folium's map is in an iframe the page can't reach
+    if (current_app.config['RIDE_MAP_MODE'] == 'server' and not current_app.config['LOCATION_TRACKING']):
+        # folium is slow, pure python work, under eventlet/gevent it runs on an os thread so other connections keep being served
+        map = blocking.offload(rideMaps.Render, rideId, *ridePoints(ride))
+    return render_template('ride.html', ride=ride, rider=rider, driver=driver, map=map)
+
+# the ride's points as json so the ride page can draw the map itself (RIDE_MAP_MODE=client)
+@main_blueprint.route('/ride/<rideId>/map.json')
+@login_required
+def rideMap(rideId):
+    ride = rides.FindForUser(rideId, current_user.id, {'pickup': 1, 'address': 1})
+    if (ride is None):
+        raise HttpErrors.NotFound()
+    pickup, destination = ridePoints(ride)
+    response = jsonify({'pickup': pickup, 'destination': destination})
+    response.cache_control.private = True
+    response.cache_control.max_age = 3600 # the points of a ride never change
+    return response
+
+# this route is for the ride chat page between the driver and the rider
+@main_blueprint.route('/ride/<rideId>/chat')
+@login_required
+def rideChat(rideId):
+    ride = rides.FindForUser(rideId, current_user.id)
+    if (ride is None):
+        return redirect('/')
+    rider = User.GetUserById(ride['riderId'])
+    driver = Driver.GetDriver(User.GetUserById(ride['driverId']))
+    # only the latest messages are rendered, older ones are fetched from the history route and new ones arrive over the socket
+    messages = chats.Page(rideId, limit=current_app.config['CHAT_PAGE_SIZE'])
+    return render_template('chat.html', messages=messages, ride=ride, rider=rider, driver=driver)
+
+# what a trip to the address costs with every car type, so the rider sees the price before requesting the ride
+@main_blueprint.route('/quote')
+@login_required
+def quote():
+    lat, long = request.args.get('lat', type=float), request.args.get('long', type=float)
+    address = request.args.get('address', '')
+    if (lat is None or long is None or not address.strip()):
+        raise HttpErrors.BadRequest()
+    try:
+        destination = geocoder.Lookup(address)
+    except GeocodingError:
+        return jsonify({'error': gettext("We couldn't look up that address right now, please try again!")}), HttpErrors.ServiceUnavailable.code
+    if (destination is None):
+        return jsonify({'error': gettext("Invalid address!")}), HttpErrors.NotFound.code
+    return jsonify({'quotes': fares.QuoteCarTypes(driverStore.CarTypes(), (lat, long), destination)})
+
+# older chat messages as json (the ones before the sequence number in ?before=), or newer ones (after the one in ?after=)
+@main_blueprint.route('/ride/<rideId>/chat/history')
+@login_required
+def rideChatHistory(rideId):
+    if (rides.FindForUser(rideId, current_user.id, PARTICIPANTS_PROJECTION) is None):
+        raise HttpErrors.NotFound()
+    limit = max(1, min(request.args.get('limit', current_app.config['CHAT_PAGE_SIZE'], type=int), current_app.config['CHAT_PAGE_SIZE']))
+    after = request.args.get('after', type=int)
+    messages = chats.Page(rideId, request.args.get('before', type=int), limit) if after is None else chats.After(rideId, after, limit)
+    return jsonify({'messages': messages, 'more': len(messages) == limit})
+
+# this route shows the driver and the rider the final invoice
+@main_blueprint.route('/ride/<rideId>/invoice')
+@login_required
+def rideInvoice(rideId):
+    ride = rides.FindForUser(rideId, current_user.id)
+    if (ride is None or not ride.get('arrived')):
+        return redirect('/')
+    rider = User.GetUserById(ride['riderId'])
+    driver = Driver.GetDriver(User.GetUserById(ride['driverId']))
+    return render_template('invoice.html', ride=ride, rider=rider, driver=driver, amountEarned=ride['cost'])
+
+# times every event handler, events without a handler share one label so clients can't create new series
+class MeasuredNamespace(Namespace):
+    def trigger_event(self, event, *args):
+        label = event if hasattr(self, f'on_{event}') else 'unhandled'
+        eventsInFlight.Inc(self.namespace)
+        start = time.perf_counter()
+        try:
+            return super().trigger_event(event, *args)
+        finally:
+            eventLatency.Observe(time.perf_counter() - start, self.namespace, label)
+            eventsInFlight.Dec(self.namespace)
+
+class RideNamespace(MeasuredNamespace):
+    userSessionIds = {}
     @login_required
-    def rideDetails(rideId):
-        ride = rides.find_one({'_id': ObjectId(rideId)})
-        if (ride is None or (ride['driverId'] != current_user.id and ride['riderId'] != current_user.id)):
-            return redirect('/')
-        rider = User.GetUserById(ride['riderId'])
-        driver = Driver.GetDriver(User.GetUserById(ride['driverId']))
-
-        if (ride['arrived']):
-            return redirect(f'/ride/{rideId}/invoice')
-
-        # Define coordinates of points
-        point_A = [float(ride['pickup']['long']), float(ride['pickup']['lat'])]
-        point_B = [float(ride['address']['long']), float(ride['address']['lat'])]
-
-        # Create the map
-        map = folium.Map(location=point_B, zoom_start = 13)
-
-        # Add points to the map
-        folium.Marker(point_A, popup='Pickup').add_to(map)
-        folium.Marker(point_B, popup='Destination').add_to(map)
-
-        # Draw line between point A and point B
-        folium.PolyLine(locations=[point_A, point_B], color="red", weight=2.5, opacity=1).add_to(map)
-
-        return render_template('ride.html', ride=ride, rider=rider, driver=driver, map=map._repr_html_())
+    def on_join(self, data):
+        ride = rides.FindForUser(data['id'], current_user.id, PARTICIPANTS_PROJECTION)
+        if (ride is None):
+            emit('Failed', {'msg': 'Invalid ride!'})
+            return
+        join_room(data['id'])
+        RideNamespace.userSessionIds[current_user.id] = request.sid
+        if (ride['driverId'] == current_user.id):
+            # the driver's location updates are checked against this instead of looking the ride up for every one of them
+            tracker.Start(data['id'], current_user.id)
+        position = tracker.Position(data['id'])
+        if (position is not None):
+            emit('location', position)
+
+    def on_disconnect(self, *_):
+        if (current_user.is_authenticated):
+            forgetSession(RideNamespace.userSessionIds, current_user.id, request.sid)
+
+    # the driver's browser sends its position as often as it gets one, only the updates the tracker lets through reach the rider
+    @login_required
+    def on_location(self, data):
+        if (not current_app.config['LOCATION_TRACKING']):
+            return
+        frame = tracker.Update(data['id'], current_user.id, data.get('lat'), data.get('long'))
+        if (frame is not None):
+            emit('location', frame, room=data['id'], include_self=False)
 
-    # this route is for the ride chat page between the driver and the rider
-    @app.route('/ride/<rideId>/chat')
     @login_required
-    def rideChat(rideId):
-        ride = rides.find_one({'_id': ObjectId(rideId)})
-        if (ride is None or (ride['driverId'] != current_user.id and ride['riderId'] != current_user.id)):
+    def on_triggerarrived(self, data):
+        ride = rides.FindForDriver(data['id'], current_user.id)
+        if (ride is None):
             return redirect('/')
         rider = User.GetUserById(ride['riderId'])
-        driver = Driver.GetDriver(User.GetUserById(ride['driverId']))
-        return render_template('chat.html', messages=ride['chat'], ride=ride, rider=rider, driver=driver)
+        quote = ride.get('quote')
+        if (quote is None): # rides from before quoting existed are priced now
+            quote = fares.QuoteRequests([dict(ride, carType=current_user.carType)])[0]
+        amountEarned = quote['fare']
+        rides.Finish(ride['_id'], amountEarned)
+        activeRides.Finished(ride['driverId'], ride['riderId'])
+        rideMaps.Forget(str(ride['_id']))
+        tracker.Finish(str(ride['_id']))
+        # the driver is only available again once they are back on the ride exchange (which knows when they leave it)
+        emit('refresh', room=ride['_id'], broadcast=True)
+        outbox.Enqueue(subject="Ride completed!", body=f"Hello! You owe {amountEarned}$ to your driver!",
+                    sender="no-reply@company.com",
+                    recipients=[rider.email])
+
+class RideChatNamespace(MeasuredNamespace):
+    userSessionIds = {}
+    @login_required
+    def on_join(self, data):
+        if (rides.FindForUser(data['id'], current_user.id, PARTICIPANTS_PROJECTION) is None):
+            emit('Failed', {'msg': 'Invalid ride!'})
+            return
+        join_room(data['id'])
+        RideChatNamespace.userSessionIds[current_user.id] = request.sid
+
+    def on_disconnect(self, *_):
+        if (current_user.is_authenticated):
+            forgetSession(RideChatNamespace.userSessionIds, current_user.id, request.sid)
+    
+    # store the message in the database and send it to everyone in the ride
+    @login_required
+    def on_chat(self, data):
+        chat = chats.Append(data['id'], current_user.id, 'driver' if current_user.driver else 'rider', data['message'])
+        if (chat is None):
+            emit('Failed', {'msg': 'Invalid ride!'})
+            return
+        emit('chat', chat, room=data['id'], broadcast=True)
+
+class RideExchangeNamespace(MeasuredNamespace):
+    userSessionIds = {}
+    pendingRideRequests = None # set by create_app from the state backend
 
-    # this route shows the driver and the rider the final invoice
-    @app.route('/ride/<rideId>/invoice')
     @login_required
-    def rideInvoice(rideId):
-        ride = rides.find_one({'_id': ObjectId(rideId)})
-        if (ride is None or (ride['driverId'] != current_user.id and ride['riderId'] != current_user.id) or not ride['arrived']):
-            return redirect('/')
-        rider = User.GetUserById(ride['riderId'])
-        driver = Driver.GetDriver(User.GetUserById(ride['driverId']))
-        return render_template('invoice.html', ride=ride, rider=rider, driver=driver, amountEarned=ride['cost'])
-
-    class RideNamespace(Namespace):
-        userSessionIds = {}
-        @login_required
-        def on_join(self, data):
-            ride = rides.find_one({'_id': ObjectId(data['id'])})
-            if (ride is None or (ride['driverId'] != current_user.id and ride['riderId'] != current_user.id)):
-                emit('Failed', {'msg': 'Invalid ride!'})
-                return
-            join_room(data['id'])
-            RideNamespace.userSessionIds[current_user.id] = request.sid
-
-        @login_required
-        def on_triggerarrived(self, data):
-            ride = rides.find_one({'_id': ObjectId(data['id'])})
-            if (ride is None or (ride['driverId'] != current_user.id)):
-                return redirect('/')
-            rider = User.GetUserById(ride['riderId'])
-            amountEarned = random.randint(1, 100)
-            rides.update_one({'_id': ObjectId(ride['_id'])}, {'$set': {'arrived': True, 'cost': amountEarned}})
-            emit('refresh', room=ride['_id'], broadcast=True)
-            msg = Message(subject="Ride completed!", body=f"Hello! You owe {amountEarned}$ to your driver!",
-                        sender="no-reply@company.com",
-                        recipients=[rider.email])
-            mail.send(msg)
-
-    class RideChatNamespace(Namespace):
-        userSessionIds = {}
-        @login_required
-        def on_join(self, data):
-            ride = rides.find_one({'_id': ObjectId(data['id'])})
-            if (ride is None or (ride['driverId'] != current_user.id and ride['riderId'] != current_user.id)):
-                emit('Failed', {'msg': 'Invalid ride!'})
-                return
-            join_room(data['id'])
-            RideChatNamespace.userSessionIds[current_user.id] = request.sid
-        
-        # for notifying others that a message has been sent and store the message in the database
-        @login_required
-        def on_chat(self, data):
-            ride = rides.find_one({'_id': ObjectId(data['id'])})
-            if (ride is None or (ride['driverId'] != current_user.id and ride['riderId'] != current_user.id)):
-                emit('Failed', {'msg': 'Invalid ride!'})
-                return
-            rides.update_one({'_id': ObjectId(data['id'])}, {'$push': {'chat': {'sender': 'driver' if current_user.driver else 'rider', 'message': data['message']}}})
-            emit('refresh', room=data['id'], broadcast=True)
-
-    class RideExchangeNamespace(Namespace):
-        userSessionIds = {}
-        pendingRideRequests = {}
-
-        @login_required
-        def on_join(self, data):
-            # if the user is already in a ride (driver or rider) that doesnt have the "arrived" attribute then they cant join another ride
-            if (current_user.driver and rides.find_one({"driverId": current_user.id, 'arrived': {'$exists': False}}) is not None):
-                emit('Failed', {'msg': 'You are already in a ride!'})
-                return
-            elif (not current_user.driver and rides.find_one({"riderId": current_user.id, 'arrived': {'$exists': False}}) is not None):
-                emit('Failed', {'msg': 'You are already in a ride!'})
-                return
-            # the room id for drivers is basically dependent on their car type
-            join_room(f"{current_user.id}-WAITING" if not current_user.driver else f"{current_user.carType}-DECIDING")
+    def on_join(self, data):
+        # if the user is already in a ride (driver or rider) that hasn't arrived yet then they cant join another ride
+        activeRideId = activeRides.ForUser(current_user.id, current_user.driver)
+        if (activeRideId is not None):
             if (not current_user.driver):
-                # create the ride request object
-                rideRequest = {'userId': current_user.id, 'address': { 'long': data['address']['long'], 'lat': data['address']['lat'] }, 'textAddress': data['textAddress'], 
-                                'pickup': {'long': data['pickup']['long'], 'lat': data['pickup']['lat']},
-                                'time': data['time'] if 'time' in data else 'now', 'carType': data['carType']
-                            }
-                # notify all drivers that a new ride request has been made
-                emit('giveride', rideRequest,
-                    room=f"{data['carType']}-DECIDING", broadcast=True)
-                # add the ride request to the list of pending ride requests (set a default list if one doesnt exist)
-                if (data['carType'] not in RideExchangeNamespace.pendingRideRequests):
-                    RideExchangeNamespace.pendingRideRequests[data['carType']] = []
-                RideExchangeNamespace.pendingRideRequests[data['carType']].append(rideRequest)
-            # store session ids just in case we need to communicate directly with someone
-            RideExchangeNamespace.userSessionIds[current_user.id] = request.sid
-        
-        @login_required
-        def on_cancel(self, _):
-            if (current_user.driver):
+                # a rider whose request was taken while their connection was down (so they never got gotride)
+                emit('gotride', {'rideId': activeRideId})
                 return
-            for carType, rideRequestList in RideExchangeNamespace.pendingRideRequests:
-                for rideRequest in rideRequestList:
-                    if (rideRequest['userId'] == current_user.id):
-                        RideExchangeNamespace.pendingRideRequests[carType].remove(rideRequest)
-                        return
-
-        @login_required
-        def on_selrid(self, data):
-            if (not current_user.driver):
+            emit('Failed', {'msg': 'You are already in a ride!'})
+            return
+        if (not current_user.driver):
+            # the request is priced from this, so nothing that affects the fare is taken from the client as is:
+            # the destination is looked up again from the address (a cache hit, the form already looked it up) and the car type has to exist
+            try:
+                destination = geocoder.Lookup(data['textAddress'])
+                pickup = (float(data['pickup']['lat']), float(data['pickup']['long']))
+            except GeocodingError:
+                current_app.logger.exception("Geocoding failed")
+                emit('Failed', {'msg': "We couldn't look up that address right now, please try again!"})
+                return
+            except (KeyError, TypeError, ValueError):
+                destination = pickup = None
+            if (destination is None or pickup is None or not (-90 <= pickup[0] <= 90 and -180 <= pickup[1] <= 180)
+                or data.get('carType') not in driverStore.CarTypes()):
+                emit('Failed', {'msg': 'Invalid ride request!'})
                 return
-            userId = data['userId']
-            carType = data['carType']
-            for rideRequest in RideExchangeNamespace.pendingRideRequests[carType]:
-                if (rideRequest['userId'] == userId):
-                    ride = rides.insert_one({'driverId': current_user.id, 'riderId': userId, 'textAddress': rideRequest['textAddress'], 'address': rideRequest['address'], 'pickup': rideRequest['pickup'], 'time': rideRequest['time'], 'chat': []})
-                    RideExchangeNamespace.pendingRideRequests[carType].remove(rideRequest)
-                    emit('gotride', {'rideId': str(ride.inserted_id)}, room=f"{userId}-WAITING", broadcast=True)
-                    emit('redirect', {'url': f"/ride/{str(ride.inserted_id)}"})
-
-    class RequestRide(FlaskForm):
-        address = StringField(gettext('Address'), validators=[DataRequired()])
-        nowOrLater = RadioField(gettext('Now or Later'), choices=[('now', gettext('Now')), ('later', gettext('Later'))], validators=[DataRequired()])
-        time = StringField(gettext('Time'))
-        vehicleType = SelectField(gettext('Vehicle Type'), validators=[DataRequired()])
-        long = HiddenField(validators=[DataRequired()], render_kw={"id": "long"})
-        lat = HiddenField(validators=[DataRequired()], render_kw={"id": "lat"})
-        submit = SubmitField(gettext('Request Ride'))
-
-    @app.before_request
-    def before_request():
-        request.startTime = datetime.now()
-
-    @app.after_request
-    def after_request(response):
-        end_time = datetime.now()
-
-        if request.startTime is not None:
-            app.logger.debug(f"Response Time: {end_time - request.startTime} seconds for [{request.method}] {request.base_url} - {response.status}")
-
-        return response
-
-    # Custom error handler for 404 Not Found
-    @app.errorhandler(HttpErrors.NotFound)
-    def not_found_error(_): # discard argument because we dont need it
-        return render_template("error.html", error=f"{gettext("Page not found")} :("), HttpErrors.NotFound.code
-
-    # Custom error handler for 500 Internal Server Error
-    @app.errorhandler(HttpErrors.InternalServerError)
-    def internal_server_error(_):
-        return render_template("error.html", error=f"{gettext("An internal error occurred")} :("), HttpErrors.InternalServerError.code
-
-
-    if __name__ == '__main__':
-        # need to use app context or else the code immediately crashes whenever i try to access the g object
+        # the room id for drivers is basically dependent on their car type
+        join_room(f"{current_user.id}-WAITING" if not current_user.driver else f"{current_user.carType}-DECIDING")
+        if (current_user.driver):
+            # the driver is waiting for a ride so they can be matched with riders (the page sends their location if it knows it)
+            Driver.availability.Available(current_user.id, current_user.carType, data.get('lat'), data.get('long'))
+        if (not current_user.driver):
+            # create the ride request object
+            rideRequest = {'requestId': str(ObjectId()), 'userId': current_user.id, 'address': { 'long': destination[1], 'lat': destination[0] }, 'textAddress': data['textAddress'], 
+                            'pickup': {'long': pickup[1], 'lat': pickup[0]},
+                            'time': data['time'] if 'time' in data else 'now', 'carType': data['carType']
+                        }
+            # priced once here, so drivers see it right away and the rider pays what they were quoted
+            rideRequest['quote'] = fares.QuoteRequests([rideRequest])[0]
+            # add the ride request to the pending ride requests (this replaces any older request from the same rider)
+            evicted = RideExchangeNamespace.pendingRideRequests.Add(rideRequest)
+            # let the drivers it is relevant to know (they add it to their page without reloading)
+            broadcaster.Added(rideRequest)
+            for oldRequest in evicted:
+                retractRideRequest(oldRequest, 'evicted')
+        # store session ids just in case we need to communicate directly with someone
+        RideExchangeNamespace.userSessionIds[current_user.id] = request.sid
+    
+    # a driver that leaves stops getting requests, a rider that leaves takes their request with them unless they reconnect
+    # within PENDING_RIDE_DISCONNECT_GRACE seconds (a ping timeout or a network blip shouldn't cost them their place)
+    def on_disconnect(self, *_):
+        if (not current_user.is_authenticated or not forgetSession(RideExchangeNamespace.userSessionIds, current_user.id, request.sid)):
+            return # an older tab closing while the user is still connected from a newer one
+        if (current_user.driver):
+            Driver.availability.Busy(current_user.id)
+            return
+        grace = current_app.config['PENDING_RIDE_DISCONNECT_GRACE']
+        if (grace > 0):
+            rideRequest = RideExchangeNamespace.pendingRideRequests.Get(current_user.id)
+            if (rideRequest is not None):
+                socketio.start_background_task(dropAbandonedRideRequest, current_app._get_current_object(), rideRequest, grace)
+            return
+        rideRequest = RideExchangeNamespace.pendingRideRequests.Remove(current_user.id)
+        if (rideRequest is not None):
+            retractRideRequest(rideRequest, 'disconnected')
+
+    @login_required
+    def on_cancel(self, _):
+        if (current_user.driver):
+            return
+        rideRequest = RideExchangeNamespace.pendingRideRequests.Remove(current_user.id)
+        if (rideRequest is not None):
+            broadcaster.Removed(rideRequest)
+
+    @login_required
+    def on_selrid(self, data):
+        if (not current_user.driver):
+            return
+        userId = data['userId']
+        carType = data['carType']
+        # only one driver can claim a request, everyone else is told right away that it's gone
+        rideRequest = RideExchangeNamespace.pendingRideRequests.Claim(userId, current_user.id, carType, data.get('requestId'))
+        if (rideRequest is None):
+            emit('taken', {'userId': userId})
+            return
+        ride = rides.CreateFromRequest(rideRequest, current_user.id)
+        if (ride['driverId'] != current_user.id):
+            emit('taken', {'userId': userId})
+            return
+        broadcaster.Removed(rideRequest)
+        Driver.availability.Busy(current_user.id)
+        activeRides.Started(str(ride['_id']), current_user.id, userId)
+        emit('gotride', {'rideId': str(ride['_id'])}, room=f"{userId}-WAITING", broadcast=True)
+        emit('redirect', {'url': f"/ride/{str(ride['_id'])}"})
+
+# forget the user's socket session if it is this one, returns whether it was
+def forgetSession(sessions, userId: str, sid: str) -> bool:
+    if (sessions.get(userId) != sid):
+        return False
+    sessions.pop(userId, None)
+    return True
+
+# takes a request off every driver's page and tells the rider it's gone (it expired or made room for newer requests)
+def retractRideRequest(rideRequest: dict, reason: str) -> None:
+    broadcaster.Removed(rideRequest)
+    socketio.emit('expired', {'reason': reason}, to=f"{rideRequest['userId']}-WAITING", namespace='/rideExchange')
+    droppedRides.Inc(reason)
+
+# drops the request of a rider who disconnected and didn't come back (their page rejoins as soon as it reconnects)
+def dropAbandonedRideRequest(app: Flask, rideRequest: dict, grace: float) -> None:
+    socketio.sleep(grace)
+    with app.app_context():
+        pending = RideExchangeNamespace.pendingRideRequests
+        userId = rideRequest['userId']
+        current = pending.Get(userId)
+        # still the same request (rejoining replaces it) and the rider is still gone
+        if (RideExchangeNamespace.userSessionIds.get(userId) is not None or current is None or current['requestId'] != rideRequest['requestId']):
+            return
+        removed = pending.Remove(userId)
+        if (removed is not None):
+            retractRideRequest(removed, 'disconnected')
+
+# drops pending requests nobody took in time (and tracked rides whose driver went quiet), runs in the background for as long as the app does
+def sweepPendingRides(app: Flask) -> None:
+    while True:
+        socketio.sleep(app.config['PENDING_SWEEP_INTERVAL'])
         with app.app_context():
-            # pass values to other blueprints using the g object
-            g.mail = mail
-            g.login_manager = login_manager
-            g.babel = babel
-            g.instance_path = app.instance_path
-            # you need to import them here in order to avoid circular imports
-            from auth import auth_blueprint
-            app.register_blueprint(auth_blueprint)
-            from profiles import profiles_blueprint
-            app.register_blueprint(profiles_blueprint)
-        socketio.on_namespace(RideExchangeNamespace('/rideExchange'))
-        socketio.on_namespace(RideChatNamespace('/rideChat'))
-        socketio.on_namespace(RideNamespace('/ride'))
-        socketio.run(app, debug=True)
\ No newline at end of file
+            try:
+                for rideRequest in RideExchangeNamespace.pendingRideRequests.Expire():
+                    retractRideRequest(rideRequest, 'expired')
+            except Exception:
+                app.logger.exception("Expiring pending ride requests failed")
+            try:
+                tracker.Expire()
+            except Exception:
+                app.logger.exception("Expiring tracked rides failed")
+
+# sends a frame of pending request changes to one driver (or to every driver of the car type when driverId is None)
+def sendRideRequestFrame(carType: str, driverId: str|None, frame: dict) -> None:
+    if (driverId is None):
+        socketio.emit('giveride', frame, to=f"{carType}-DECIDING", namespace='/rideExchange')
+        return
+    sid = RideExchangeNamespace.userSessionIds.get(driverId)
+    if (sid is not None):
+        socketio.emit('giveride', frame, to=sid, namespace='/rideExchange')
+
+class RequestRide(FlaskForm):
+    address = StringField(gettext('Address'), validators=[DataRequired()])
+    nowOrLater = RadioField(gettext('Now or Later'), choices=[('now', gettext('Now')), ('later', gettext('Later'))], validators=[DataRequired()])
+    time = StringField(gettext('Time'))
+    vehicleType = SelectField(gettext('Vehicle Type'), validators=[DataRequired()])
+    long = HiddenField(validators=[DataRequired()], render_kw={"id": "long"})
+    lat = HiddenField(validators=[DataRequired()], render_kw={"id": "lat"})
+    submit = SubmitField(gettext('Request Ride'))
+
+@main_blueprint.before_app_request
+def before_request():
+    request.startTime = time.perf_counter()
+    requestsInFlight.Inc()
+
+@main_blueprint.after_app_request
+def after_request(response):
+    g._status = response.status_code
+    return response
+
+# runs even when the view raised, so every request that was counted as in flight is finished here
+@main_blueprint.teardown_app_request
+def teardown_request(_):
+    startTime = getattr(request, 'startTime', None)
+    if (startTime is None):
+        return
+    # the route pattern (not the path) so every ride shares one series
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    requestLatency.Observe(time.perf_counter() - startTime, route, request.method, g.get('_status', 500))
+    requestsInFlight.Dec()
+
+# request, socket.io, pending request and outbound call metrics in the prometheus text format
+# only for scrapers that send METRICS_TOKEN as a bearer token, addresses in METRICS_ALLOWED_IPS and logged in admins
+@main_blueprint.route('/metrics')
+def metricsPage():
+    token = current_app.config['METRICS_TOKEN']
+    authorized = token and hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+    if (not authorized and request.remote_addr not in current_app.config['METRICS_ALLOWED_IPS'] and not isAdmin()):
+        raise HttpErrors.Forbidden()
+    return Response(metrics.registry.Render(), mimetype='text/plain; version=0.0.4')
+
+# Custom error handler for 404 Not Found
+@main_blueprint.app_errorhandler(HttpErrors.NotFound)
+def not_found_error(_): # discard argument because we dont need it
+    return render_template("error.html", error=f"{gettext("Page not found")} :("), HttpErrors.NotFound.code
+
+# Custom error handler for 500 Internal Server Error
+@main_blueprint.app_errorhandler(HttpErrors.InternalServerError)
+def internal_server_error(_):
+    return render_template("error.html", error=f"{gettext("An internal error occurred")} :("), HttpErrors.InternalServerError.code
+
+def create_app(config: dict|None = None) -> Flask:
+    app = Flask(__name__)
+
+    # point MAIL_SERVER/MAIL_PORT at a local smtp sink (and turn off MAIL_USE_TLS) to test without mailtrap
+    app.config['MAIL_SERVER'] = getenv('MAIL_SERVER', 'sandbox.smtp.mailtrap.io')
+    app.config['MAIL_PORT'] = int(getenv('MAIL_PORT', 2525))
+    app.config['MAIL_USERNAME'] = getenv('MAIL_USERNAME')
+    app.config['MAIL_PASSWORD'] = getenv('MAIL_PASSWORD')
+    app.config['MAIL_USE_TLS'] = getenv('MAIL_USE_TLS', 'true').lower() == 'true'
+    app.config['MAIL_USE_SSL'] = False
+    # "memory" keeps mail in memory instead of sending it
+    app.config['MAIL_BACKEND'] = getenv('MAIL_BACKEND', 'smtp')
+    app.config['OUTBOX_PATH'] = getenv('OUTBOX_PATH', 'outbox.db')
+    app.config['OUTBOX_BATCH_SIZE'] = int(getenv('OUTBOX_BATCH_SIZE', 50))
+
+    # randomize secret key for development (you will need to reauthenticate whenever you restart the server)
+    app.config['SECRET_KEY'] = 'test'#str(ObjectId())
+
+    app.config['LANGUAGES'] = {
+        'en': 'English',
+        'fr': 'French',
+        'ar': 'Arabic'
+    }
+
+    app.config['GEOCODE_TIMEOUT'] = float(getenv('GEOCODE_TIMEOUT', 5))
+    app.config['GEOCODE_CACHE_PATH'] = getenv('GEOCODE_CACHE_PATH', 'geocode.db')
+
+    # how many chat messages are sent to the browser at a time and how many are stored together
+    app.config['CHAT_PAGE_SIZE'] = int(getenv('CHAT_PAGE_SIZE', 50))
+    app.config['CHAT_BUCKET_SIZE'] = int(getenv('CHAT_BUCKET_SIZE', 50))
+
+    # "server" renders the ride map with folium (cached per ride), "client" only sends the coordinates and lets the browser draw it
+    app.config['RIDE_MAP_MODE'] = getenv('RIDE_MAP_MODE', 'server')
+    app.config['RIDE_MAP_CACHE_SIZE'] = int(getenv('RIDE_MAP_CACHE_SIZE', 1024))
+
+    # pricing: average speed in the city, how much longer the roads are than a straight line and (as json) the rates
+    # per car type and the 24 hourly multipliers (see ridelib/fares.py for the defaults)
+    app.config['FARE_SPEED_KMH'] = float(getenv('FARE_SPEED_KMH', 30))
+    app.config['FARE_ROAD_FACTOR'] = float(getenv('FARE_ROAD_FACTOR', 1.3))
+    app.config['FARE_RATES'] = json.loads(getenv('FARE_RATES', 'null'))
+    app.config['FARE_HOURLY_MULTIPLIERS'] = json.loads(getenv('FARE_HOURLY_MULTIPLIERS', 'null'))
+
+    # "threading" for the development server, server.py sets "eventlet" or "gevent" (after patching the standard library)
+    app.config['ASYNC_MODE'] = getenv('ASYNC_MODE', 'threading')
+    # how often socket.io pings every connection and how long it waits for the answer (in seconds), most connections
+    # are idle riders and drivers waiting, so this is most of what they cost once they're connected
+    app.config['SOCKETIO_PING_INTERVAL'] = float(getenv('SOCKETIO_PING_INTERVAL', 25))
+    app.config['SOCKETIO_PING_TIMEOUT'] = float(getenv('SOCKETIO_PING_TIMEOUT', 20))
+
+    # where pending ride requests and socket sessions are kept ("memory" or a redis:// url when running more than one process)
+    app.config['STATE_BACKEND'] = getenv('STATE_BACKEND', 'memory')
+    # a redis:// (or any kombu) url that lets socket.io processes send events to clients connected to other processes
+    app.config['SOCKETIO_MESSAGE_QUEUE'] = getenv('SOCKETIO_MESSAGE_QUEUE')
+
+    # create any missing mongo indexes when the app starts
+    app.config['ENSURE_INDEXES'] = getenv('ENSURE_INDEXES', 'true').lower() == 'true'
+
+    # how many pending requests a driver sees and how far away (in km) they can be
+    app.config['PENDING_RIDES_LIMIT'] = int(getenv('PENDING_RIDES_LIMIT', 50))
+    app.config['PENDING_RIDES_RADIUS_KM'] = float(getenv('PENDING_RIDES_RADIUS_KM', 15))
+    # pending requests nobody takes within this many seconds are dropped (checked every PENDING_SWEEP_INTERVAL seconds)
+    app.config['PENDING_RIDE_TTL'] = float(getenv('PENDING_RIDE_TTL', 600))
+    app.config['PENDING_SWEEP_INTERVAL'] = float(getenv('PENDING_SWEEP_INTERVAL', 5))
+    # a rider who disconnects from the waiting page keeps their request for this many seconds in case they reconnect
+    app.config['PENDING_RIDE_DISCONNECT_GRACE'] = float(getenv('PENDING_RIDE_DISCONNECT_GRACE', 15))
+    # at most this many pending requests are kept, the oldest ones are dropped to make room
+    app.config['PENDING_RIDES_MAX'] = int(getenv('PENDING_RIDES_MAX', 100000))
+    # new and removed requests are sent to drivers in one frame per this many seconds (0 sends every change right away)
+    app.config['DRIVER_FRAME_WINDOW'] = float(getenv('DRIVER_FRAME_WINDOW', 0.25))
+    # drivers are only told about requests within this many km of them, 0 sends every request to every driver of the car type
+    # (driver locations are only known to the process the driver is connected to, so use 0 when running more than one process)
+    app.config['DRIVER_FRAME_RADIUS_KM'] = float(getenv('DRIVER_FRAME_RADIUS_KM', app.config['PENDING_RIDES_RADIUS_KM']))
+
+    # extra pymongo client options (on top of the MONGO_* environment variables read by mongolib.connection)
+    app.config['MONGO_CLIENT_OPTIONS'] = {}
+    # bcrypt cost (existing hashes are upgraded when their user logs in), how many processes hash passwords and
+    # how long a request waits for one of them before it gives up (at most PASSWORD_MAX_PENDING calls are queued at once)
+    app.config['PASSWORD_ROUNDS'] = int(getenv('PASSWORD_ROUNDS', 12))
+    app.config['PASSWORD_WORKERS'] = int(getenv('PASSWORD_WORKERS', 2))
+    app.config['PASSWORD_MAX_PENDING'] = int(getenv('PASSWORD_MAX_PENDING', 0)) or None
+    app.config['PASSWORD_WAIT_TIMEOUT'] = float(getenv('PASSWORD_WAIT_TIMEOUT', 5))
+    # login attempts allowed per username and per ip address in every LOGIN_ATTEMPT_WINDOW seconds
+    app.config['LOGIN_ATTEMPTS_PER_USER'] = int(getenv('LOGIN_ATTEMPTS_PER_USER', 10))
+    app.config['LOGIN_ATTEMPTS_PER_IP'] = int(getenv('LOGIN_ATTEMPTS_PER_IP', 100))
+    app.config['LOGIN_ATTEMPT_WINDOW'] = float(getenv('LOGIN_ATTEMPT_WINDOW', 300))
+    # how long an admin login lasts before the admin pages ask for the password again
+    app.config['ADMIN_SESSION_SECONDS'] = float(getenv('ADMIN_SESSION_SECONDS', 1800))
+
+    # driver locations are sent to the rider at most LOCATION_MAX_HZ times a second and only once they moved LOCATION_MIN_METERS,
+    # the stored track keeps a point every TRACK_KEEP_METERS and is written TRACK_BATCH_SIZE points (or TRACK_FLUSH_SECONDS) at a time
+    # while it's on the ride page always draws its map in the browser (whatever RIDE_MAP_MODE is) to show where the driver is
+    app.config['LOCATION_TRACKING'] = getenv('LOCATION_TRACKING', 'true').lower() == 'true'
+    app.config['LOCATION_MAX_HZ'] = float(getenv('LOCATION_MAX_HZ', 1))
+    app.config['LOCATION_MIN_METERS'] = float(getenv('LOCATION_MIN_METERS', 5))
+    app.config['TRACK_KEEP_METERS'] = float(getenv('TRACK_KEEP_METERS', 25))
+    app.config['TRACK_BATCH_SIZE'] = int(getenv('TRACK_BATCH_SIZE', 20))
+    app.config['TRACK_FLUSH_SECONDS'] = float(getenv('TRACK_FLUSH_SECONDS', 30))
+    # rides whose driver sent nothing for this long are forgotten (checked every PENDING_SWEEP_INTERVAL seconds)
+    app.config['TRACK_IDLE_SECONDS'] = float(getenv('TRACK_IDLE_SECONDS', 900))
+
+    # mongo commands slower than this (in milliseconds) are logged as warnings
+    app.config['MONGO_SLOW_MS'] = float(getenv('MONGO_SLOW_MS', 200))
+    # who can read /metrics besides admins: a scraper sending "Authorization: Bearer <METRICS_TOKEN>" and the addresses in
+    # METRICS_ALLOWED_IPS (comma separated, none by default since behind a reverse proxy every request comes from its address)
+    app.config['METRICS_TOKEN'] = getenv('METRICS_TOKEN')
+    app.config['METRICS_ALLOWED_IPS'] = [i.strip() for i in getenv('METRICS_ALLOWED_IPS', '').split(',') if i.strip()]
+    # how many reverse proxies / load balancers sit in front of the app, their X-Forwarded-For is trusted so request.remote_addr
+    # is the client's address (the metrics allowlist and the per ip login limit depend on it), 0 trusts none
+    app.config['TRUSTED_PROXIES'] = int(getenv('TRUSTED_PROXIES', 0))
+
+    if (config is not None):
+        app.config.update(config)
+
+    if (app.config['TRUSTED_PROXIES'] > 0):
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
+    connection.configure(**app.config['MONGO_CLIENT_OPTIONS'])
+    global slowMongoSeconds
+    slowMongoSeconds = app.config['MONGO_SLOW_MS'] / 1000
+
+    blocking.configure(app.config['ASYNC_MODE'])
+    socketio.init_app(app, async_mode=app.config['ASYNC_MODE'], message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+                      ping_interval=app.config['SOCKETIO_PING_INTERVAL'], ping_timeout=app.config['SOCKETIO_PING_TIMEOUT'])
+    babel.init_app(app, locale_selector=get_locale)
+    login_manager.init_app(app)
+    # tell the login manager to use the login route to redirect users to when they try to access areas that require authentication
+    login_manager.login_view = 'auth.login'
+
+    # mail is queued and sent from a background thread so requests never wait on smtp
+    transport = MemoryTransport() if app.config['MAIL_BACKEND'] == 'memory' else FlaskMailTransport(app)
+    app.extensions['outbox'] = Outbox(transport, app.config['OUTBOX_PATH'], app.config['OUTBOX_BATCH_SIZE'])
+    # turns the addresses riders type in into coordinates (cached in memory and on disk, swap geocoder.upstream to use another service)
+    app.extensions['geocoder'] = Geocoder(NominatimUpstream(timeout=app.config['GEOCODE_TIMEOUT']), app.config['GEOCODE_CACHE_PATH'])
+    app.extensions['chats'] = ChatStore(rides.collection, LazyCollection('chatBuckets'), app.config['CHAT_BUCKET_SIZE'])
+    app.extensions['passwords'] = PasswordHasher(app.config['PASSWORD_ROUNDS'], app.config['PASSWORD_WORKERS'],
+                                                 app.config['PASSWORD_MAX_PENDING'], app.config['PASSWORD_WAIT_TIMEOUT'])
+    app.extensions['userLoginLimiter'] = RateLimiter(app.config['LOGIN_ATTEMPTS_PER_USER'], app.config['LOGIN_ATTEMPT_WINDOW'])
+    app.extensions['ipLoginLimiter'] = RateLimiter(app.config['LOGIN_ATTEMPTS_PER_IP'], app.config['LOGIN_ATTEMPT_WINDOW'])
+    app.extensions['fares'] = FareEngine(app.config['FARE_RATES'], app.config['FARE_HOURLY_MULTIPLIERS'], app.config['FARE_SPEED_KMH'], app.config['FARE_ROAD_FACTOR'])
+    app.extensions['rideMaps'] = RideMaps(app.config['RIDE_MAP_CACHE_SIZE'])
+    app.extensions['activeRides'] = ActiveRides(rides.collection)
+    app.extensions['tracker'] = RideTracker(LazyCollection('rideTracks'), app.config['LOCATION_MAX_HZ'], app.config['LOCATION_MIN_METERS'],
+                                            app.config['TRACK_KEEP_METERS'], app.config['TRACK_BATCH_SIZE'], app.config['TRACK_FLUSH_SECONDS'],
+                                            idleSeconds=app.config['TRACK_IDLE_SECONDS'])
+    app.extensions['broadcaster'] = RideRequestBroadcaster(sendRideRequestFrame, Driver.availability, app.config['DRIVER_FRAME_WINDOW'],
+                                                           app.config['DRIVER_FRAME_RADIUS_KM'], socketio.start_background_task, socketio.sleep)
+    driverStore.Initialize() # creates the drivers table (and its indexes) once per process
+    if (app.config['ENSURE_INDEXES']):
+        # chats that are still embedded in their ride documents are moved into buckets the first time the bucket index is created
+        ensureIndexes(getDatabase(), {('chatBuckets', 'rideId_bucket'): lambda db: app.extensions['chats'].MigrateEmbedded()})
+
+    from auth import auth_blueprint
+    app.register_blueprint(auth_blueprint, url_prefix='/auth') # the docs and tests expect the auth pages under /auth
+    from profiles import profiles_blueprint
+    app.register_blueprint(profiles_blueprint)
+    app.register_blueprint(main_blueprint)
+
+    state = app.extensions['state'] = createStateBackend(app.config['STATE_BACKEND'], app.config['PENDING_RIDE_TTL'], app.config['PENDING_RIDES_MAX'])
+    RideExchangeNamespace.pendingRideRequests = state.pending
+    RideExchangeNamespace.userSessionIds = state.Sessions('rideExchange')
+    RideChatNamespace.userSessionIds = state.Sessions('rideChat')
+    RideNamespace.userSessionIds = state.Sessions('ride')
+    socketio.on_namespace(RideExchangeNamespace('/rideExchange'))
+    socketio.on_namespace(RideChatNamespace('/rideChat'))
+    socketio.on_namespace(RideNamespace('/ride'))
+
+    app.extensions['outbox'].Start()
+    if (app.config['PENDING_SWEEP_INTERVAL'] > 0):
+        socketio.start_background_task(sweepPendingRides, app)
+    return app
+
+if __name__ == '__main__':
+    app = create_app()
+    socketio.run(app, debug=True)
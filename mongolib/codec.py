@@ -0,0 +1,74 @@
+from inspect import Parameter, signature
+from typing import get_args, get_origin, get_type_hints
+
+# how each field of a class is stored
+PLAIN, OBJECT, OBJECT_LIST = 0, 1, 2
+
+# the schema of a MongoObject class (its constructor arguments and which of them hold other MongoObjects)
+# worked out once per class so converting a document is just a loop over a precomputed field list
+class Codec():
+    def __init__(self, cls):
+        from mongolib.object import MongoObject
+        self.cls = cls
+        hints = get_type_hints(cls.__init__)
+        self.fields = [] # (name, kind, class of the nested object, default)
+        for name, parameter in signature(cls.__init__).parameters.items():
+            if (name == 'self' or parameter.kind in (Parameter.VAR_POSITIONAL, Parameter.VAR_KEYWORD)):
+                continue
+            hint = hints.get(name)
+            kind, nested = PLAIN, None
+            if (isinstance(hint, type) and issubclass(hint, MongoObject)):
+                kind, nested = OBJECT, hint
+            elif (get_origin(hint) is list and get_args(hint) and isinstance(get_args(hint)[0], type) and issubclass(get_args(hint)[0], MongoObject)):
+                kind, nested = OBJECT_LIST, get_args(hint)[0]
+            default = None if parameter.default is Parameter.empty else parameter.default
+            self.fields.append((name, kind, nested, default))
+        self.kinds = {name: (kind, nested) for name, kind, nested, _ in self.fields}
+
+    # instance -> mongo document (without the id, mongo keeps that in _id)
+    def Encode(self, obj) -> dict:
+        document = {}
+        for name, kind, nested, _ in self.fields:
+            if (name == 'id'):
+                continue
+            value = getattr(obj, name, None)
+            if (value is not None and kind != PLAIN):
+                value = value.MongoSafeObject() if kind == OBJECT else [i.MongoSafeObject() for i in value]
+            document[name] = value
+        return document
+
+    # a plain dict -> mongo safe dict, nested MongoObjects are converted wherever they are
+    def EncodeDict(self, dic: dict) -> dict:
+        from mongolib.object import MongoObject
+        document = {}
+        for key, value in dic.items():
+            if (key == 'id'):
+                continue
+            if (isinstance(value, MongoObject)):
+                value = value.MongoSafeObject()
+            elif (isinstance(value, list) and value and all(isinstance(i, MongoObject) for i in value)):
+                value = [i.MongoSafeObject() for i in value]
+            document[key] = value
+        return document
+
+    # mongo document -> instance, keys that aren't constructor arguments are ignored
+    def Decode(self, document: dict):
+        kwargs = {}
+        for name, kind, nested, default in self.fields:
+            if (name == 'id'):
+                value = document.get('_id', document.get('id'))
+                kwargs['id'] = str(value) if value is not None else None
+                continue
+            value = document.get(name, default)
+            if (value is not None and kind != PLAIN):
+                value = nested.convertBack(value) if kind == OBJECT else [nested.convertBack(i) for i in value]
+            kwargs[name] = value
+        return self.cls(**kwargs)
+
+_codecs = {}
+
+def codecFor(cls) -> Codec:
+    codec = _codecs.get(cls)
+    if (codec is None):
+        codec = _codecs[cls] = Codec(cls)
+    return codec
@@ -0,0 +1,94 @@
+from os import getenv
+from threading import Lock
+from pymongo import monitoring
+
+_client = None
+_lock = Lock()
+_options = {}
+
+# per command (e.g. "find rides") counts and timings, filled in by a pymongo command listener
+class CommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self.lock = Lock()
+        self.stats = {} # (command, collection) -> [count, failures, total seconds, max seconds]
+        self.inflight = {} # request id -> (command, collection)
+        self.observers = [] # called with (command, collection, seconds, failed) after every command
+
+    def _finished(self, event, failed: bool) -> None:
+        key = self.inflight.pop((event.connection_id, event.request_id), None)
+        if (key is None):
+            return
+        seconds = event.duration_micros / 1e6
+        with self.lock:
+            stat = self.stats.get(key)
+            if (stat is None):
+                stat = self.stats[key] = [0, 0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += failed
+            stat[2] += seconds
+            stat[3] = max(stat[3], seconds)
+        for observer in self.observers:
+            observer(key[0], key[1], seconds, failed)
+
+    def started(self, event) -> None:
+        collection = event.command.get(event.command_name)
+        self.inflight[(event.connection_id, event.request_id)] = (event.command_name, collection if isinstance(collection, str) else '')
+
+    def succeeded(self, event) -> None:
+        self._finished(event, False)
+
+    def failed(self, event) -> None:
+        self._finished(event, True)
+
+    # [(command, collection, count, failures, total seconds, max seconds)] slowest (in total) first
+    def Snapshot(self) -> list[tuple]:
+        with self.lock:
+            rows = [(key[0], key[1], *stat) for key, stat in self.stats.items()]
+        return sorted(rows, key=lambda i: i[4], reverse=True)
+
+commandMetrics = CommandMetrics()
+
+# the settings of the one mongo client every part of the app shares, all of them can be set from the environment
+def clientOptions() -> dict:
+    options = {
+        'maxPoolSize': int(getenv('MONGO_MAX_POOL_SIZE', 100)),
+        'minPoolSize': int(getenv('MONGO_MIN_POOL_SIZE', 0)),
+        'maxIdleTimeMS': int(getenv('MONGO_MAX_IDLE_MS', 60000)),
+        'waitQueueTimeoutMS': int(getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 10000)),
+        'connectTimeoutMS': int(getenv('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+        'serverSelectionTimeoutMS': int(getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 10000)),
+        'socketTimeoutMS': int(getenv('MONGO_SOCKET_TIMEOUT_MS', 30000)),
+        'readPreference': getenv('MONGO_READ_PREFERENCE', 'primary'),
+        'appname': getenv('MONGO_APP_NAME', 'webpy-rides'),
+    }
+    options.update(_options)
+    return options
+
+# override client settings (for example from create_app), has to happen before the client is first used
+def configure(**options) -> None:
+    _options.update(options)
+
+# the mongo client is only created the first time something actually talks to the database
+# (so importing the app or running tests that don't need mongo doesn't open any connections)
+def getClient():
+    global _client
+    if (_client is None):
+        with _lock:
+            if (_client is None):
+                from pymongo import MongoClient
+                _client = MongoClient(getenv("MONGO_URI"), event_listeners=[commandMetrics], **clientOptions())
+    return _client
+
+def getDatabase():
+    return getClient()[getenv("MONGO_DATABASE", "mainDatabase")]
+
+# stands in for a pymongo collection and resolves it on first use
+class LazyCollection():
+    def __init__(self, name: str):
+        self.name = name
+        self._collection = None
+
+    def __getattr__(self, attribute):
+        if (self._collection is None):
+            self._collection = getDatabase()[self.name]
+        return getattr(self._collection, attribute)
@@ -0,0 +1,32 @@
+from ridelib.cache import TTLCache
+from ridelib.repository import toObjectId
+
+# which ride (if any) every user is in right now, so joining the ride exchange doesn't have to ask mongo each time
+# rides are added when they are created and removed when they arrive, anything else is looked up once and remembered
+# ("not in a ride" is only remembered for a short time since another process could have started a ride for the user, and a
+# remembered ride is checked by its _id before it's trusted since another process could have finished it)
+class ActiveRides():
+    def __init__(self, rides, maxSize: int = 100000, ttl: float = 3600, missTtl: float = 5):
+        self.rides = rides
+        self.cache = TTLCache(maxSize, ttl)
+        self.missTtl = missTtl
+
+    # the id of the ride the user is in that hasn't arrived yet, None if they aren't in one
+    def ForUser(self, userId: str, driver: bool) -> str|None:
+        rideId = self.cache.Get(userId, False)
+        if (rideId is None):
+            return None
+        if (rideId is not False and self.rides.find_one({'_id': toObjectId(rideId), 'active': True}, {'_id': 1}) is not None):
+            return rideId
+        ride = self.rides.find_one({'driverId' if driver else 'riderId': userId, 'active': True}, {'_id': 1})
+        rideId = str(ride['_id']) if ride is not None else None
+        self.cache.Set(userId, rideId, None if rideId is not None else self.missTtl)
+        return rideId
+
+    def Started(self, rideId: str, driverId: str, riderId: str) -> None:
+        self.cache.Set(driverId, rideId)
+        self.cache.Set(riderId, rideId)
+
+    def Finished(self, driverId: str, riderId: str) -> None:
+        self.cache.Set(driverId, None, self.missTtl)
+        self.cache.Set(riderId, None, self.missTtl)
@@ -0,0 +1,22 @@
+# runs calls that would block the whole process under eventlet/gevent (cpu bound c code like bcrypt, or anything that
+# doesn't go through python's sockets) on a real os thread, while only the calling green thread waits for the result
+# in the default threading mode there is nothing to work around and calls just run where they are
+
+_mode = 'threading'
+
+# called once by the server before the app is built ("threading", "eventlet" or "gevent")
+def configure(mode: str) -> None:
+    global _mode
+    _mode = mode
+
+def cooperative() -> bool:
+    return _mode in ('eventlet', 'gevent')
+
+def offload(function, *args):
+    if (_mode == 'eventlet'):
+        from eventlet import tpool # os threads, sized by the EVENTLET_THREADPOOL_SIZE environment variable
+        return tpool.execute(function, *args)
+    if (_mode == 'gevent'):
+        import gevent # os threads, the hub's threadpool.maxsize of them
+        return gevent.get_hub().threadpool.apply(function, args)
+    return function(*args)
@@ -0,0 +1,75 @@
+from threading import Lock
+import time
+from ridelib import metrics
+
+frames = metrics.counter('ride_request_frames_total', 'Frames of pending request changes sent to drivers', ('scope',))
+
+# tells waiting drivers about pending requests that were added or removed, without them reloading their page
+# changes are collected for `window` seconds and then sent as one frame ({'added': [...], 'removed': [userId, ...]}),
+# a rider that changes twice in the same window only shows up once (the last change wins)
+# with a radius every driver only gets the requests within radiusKm of them (plus drivers that didn't share a location get all of them),
+# without one every frame goes to the whole car type's room
+class RideRequestBroadcaster():
+    def __init__(self, send, availability, window: float = 0.25, radiusKm: float|None = None, spawn=None, sleep=time.sleep):
+        self.send = send # send(carType, driverId or None for everyone, frame)
+        self.availability = availability
+        self.window = window
+        self.radiusKm = radiusKm
+        self.spawn = spawn # starts a background task, required when window > 0
+        self.sleep = sleep
+        self.lock = Lock()
+        self.changes = {} # carType -> {userId: (added, rideRequest)}
+        self.scheduled = False
+
+    def Added(self, rideRequest: dict) -> None:
+        self._change(rideRequest, True)
+
+    def Removed(self, rideRequest: dict) -> None:
+        self._change(rideRequest, False)
+
+    def _change(self, rideRequest: dict, added: bool) -> None:
+        with self.lock:
+            self.changes.setdefault(rideRequest['carType'], {})[rideRequest['userId']] = (added, rideRequest)
+            if (self.window > 0 and self.scheduled):
+                return
+            self.scheduled = self.window > 0
+        if (self.window > 0):
+            self.spawn(self._flushLater)
+        else:
+            self.Flush()
+
+    def _flushLater(self) -> None:
+        self.sleep(self.window)
+        self.Flush()
+
+    # send everything that changed since the last flush
+    def Flush(self) -> None:
+        with self.lock:
+            changes = self.changes
+            self.changes = {}
+            self.scheduled = False
+        for carType, byUser in changes.items():
+            if (not self.radiusKm):
+                frame = {'added': [], 'removed': []}
+                for userId, (added, rideRequest) in byUser.items():
+                    if (added):
+                        frame['added'].append(rideRequest)
+                    else:
+                        frame['removed'].append(userId)
+                self.send(carType, None, frame)
+                frames.Inc('room')
+                continue
+            perDriver = {}
+            for userId, (added, rideRequest) in byUser.items():
+                pickup = rideRequest['pickup']
+                for driverId, distance in self.availability.Near(carType, pickup['lat'], pickup['long'], self.radiusKm):
+                    frame = perDriver.get(driverId)
+                    if (frame is None):
+                        frame = perDriver[driverId] = {'added': [], 'removed': []}
+                    if (added):
+                        frame['added'].append(dict(rideRequest, distance=round(distance, 2)) if distance is not None else rideRequest)
+                    else:
+                        frame['removed'].append(userId)
+            for driverId, frame in perDriver.items():
+                self.send(carType, driverId, frame)
+            frames.Inc('driver', amount=len(perDriver))
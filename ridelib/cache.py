@@ -0,0 +1,46 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+_missing = object()
+
+# a thread safe LRU cache where every entry also expires after ttl seconds
+class TTLCache():
+    def __init__(self, maxSize: int = 1024, ttl: float = 300, clock=time.monotonic):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict() # key -> (expires, value), oldest first
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key) -> bool:
+        return self.Get(key, _missing) is not _missing
+
+    def Get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is None):
+                return default
+            if (entry[0] <= self.clock()):
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def Set(self, key, value, ttl: float|None = None) -> None:
+        with self.lock:
+            self.entries[key] = (self.clock() + (self.ttl if ttl is None else ttl), value)
+            self.entries.move_to_end(key)
+            while (len(self.entries) > self.maxSize):
+                self.entries.popitem(last=False)
+
+    def Delete(self, key) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def Clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,71 @@
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from ridelib.repository import toObjectId
+
+# stores ride chat messages, every message gets a sequence number that only goes up inside of its ride
+# so clients can append new messages as they arrive and page backwards through older ones
+# messages live in their own collection in fixed size buckets ({rideId, bucket, messages: [...]}) so the
+# ride document stays small no matter how much the rider and driver talk
+class ChatStore():
+    def __init__(self, rides, buckets, bucketSize: int = 50):
+        self.rides = rides
+        self.buckets = buckets
+        self.bucketSize = bucketSize
+
+    # store a message from one of the ride's participants, returns the stored message (None if they aren't part of the ride)
+    def Append(self, rideId: str, userId: str, sender: str, message: str) -> dict|None:
+        # bumping the counter also checks that the ride exists and that the user is part of it
+        rideId = toObjectId(rideId)
+        if (rideId is None):
+            return None
+        ride = self.rides.find_one_and_update({'_id': rideId, '$or': [{'driverId': userId}, {'riderId': userId}]},
+                                              {'$inc': {'chatSeq': 1}}, projection={'chatSeq': 1}, return_document=ReturnDocument.AFTER)
+        if (ride is None):
+            return None
+        chat = {'seq': ride['chatSeq'], 'sender': sender, 'message': message, 'time': datetime.now().isoformat(timespec='seconds')}
+        self.buckets.update_one({'rideId': str(rideId), 'bucket': (chat['seq'] - 1) // self.bucketSize},
+                                {'$push': {'messages': chat}, '$inc': {'count': 1}}, upsert=True)
+        return chat
+
+    # the first `limit` messages with a sequence number higher than `after`, oldest first (what a client missed while it was disconnected)
+    def After(self, rideId: str, after: int, limit: int = 50) -> list[dict]:
+        limit = max(1, limit)
+        query = {'rideId': rideId, 'bucket': {'$gte': max(after, 0) // self.bucketSize}}
+        bucketCount = -(-limit // self.bucketSize) + 1
+        messages = []
+        for bucket in self.buckets.find(query, {'messages': 1}).sort('bucket', ASCENDING).limit(bucketCount):
+            messages.extend(i for i in bucket['messages'] if i['seq'] > after)
+        messages.sort(key=lambda i: i['seq'])
+        return messages[:limit]
+
+    # the last `limit` messages with a sequence number lower than `before` (the newest ones if before is None), oldest first
+    def Page(self, rideId: str, before: int|None = None, limit: int = 50) -> list[dict]:
+        limit = max(1, limit) # messages[-0:] would be the whole history
+        query = {'rideId': rideId}
+        if (before is not None):
+            if (before <= 1):
+                return []
+            query['bucket'] = {'$lte': (before - 2) // self.bucketSize}
+        # enough buckets to fill the page even if the first one we read is almost empty
+        bucketCount = -(-limit // self.bucketSize) + 1
+        messages = []
+        for bucket in self.buckets.find(query, {'messages': 1}).sort('bucket', DESCENDING).limit(bucketCount):
+            messages.extend(bucket['messages'])
+        if (before is not None):
+            messages = [i for i in messages if i['seq'] < before]
+        messages.sort(key=lambda i: i['seq'])
+        return messages[-limit:]
+
+    # moves chats that were stored inside of the ride documents (before buckets existed) into buckets
+    def MigrateEmbedded(self) -> int:
+        migrated = 0
+        for ride in self.rides.find({'chat': {'$exists': True}}, {'chat': 1}):
+            rideId = str(ride['_id'])
+            messages = [dict(chat, seq=seq) for seq, chat in enumerate(ride['chat'], start=1)]
+            for start in range(0, len(messages), self.bucketSize):
+                bucket = messages[start:start + self.bucketSize]
+                self.buckets.replace_one({'rideId': rideId, 'bucket': start // self.bucketSize},
+                                         {'rideId': rideId, 'bucket': start // self.bucketSize, 'messages': bucket, 'count': len(bucket)}, upsert=True)
+            self.rides.update_one({'_id': ride['_id']}, {'$unset': {'chat': ''}, '$set': {'chatSeq': len(messages)}})
+            migrated += 1
+        return migrated
@@ -0,0 +1,100 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+from queue import Empty, Queue
+from threading import Lock
+
+# the sqlite table that holds every driver's vehicle information
+# connections come from a small pool (instead of one new connection per request) and the database runs in WAL mode
+# so readers never wait for a writer, the list of car types is kept in memory until a driver is added or changed
+class DriverStore():
+    def __init__(self, path: str = 'drivers.db', poolSize: int = 8, catalogTtl: float = 60):
+        self.path = path
+        self.poolSize = poolSize
+        self.catalogTtl = catalogTtl # other processes can add car types too, so the catalog is also refreshed now and then
+        self.pool = Queue()
+        self.created = 0
+        self.lock = Lock()
+        self.initialized = False
+        self.carTypes = None
+        self.carTypesLoaded = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+        conn.execute('PRAGMA busy_timeout = 5000')
+        conn.execute('PRAGMA synchronous = NORMAL') # safe with WAL and a lot less fsyncs
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA cache_size = -8000') # 8MB page cache per connection
+        return conn
+
+    # create the table and indexes, only needs to happen once per process
+    def Initialize(self) -> None:
+        with self.lock:
+            if (self.initialized):
+                return
+            conn = self._connect()
+            conn.execute('PRAGMA journal_mode = WAL') # stored in the database file, so every connection uses it from now on
+            conn.execute("""
+                         CREATE TABLE IF NOT EXISTS drivers (
+                         userId VARCHAR(20) PRIMARY KEY,
+                         carType TEXT,
+                           carMake TEXT,
+                              carModel TEXT,
+                              carYear TEXT,
+                              carColor TEXT,
+                              carLicensePlate TEXT)""")
+            conn.execute('CREATE INDEX IF NOT EXISTS drivers_carType ON drivers (carType)')
+            conn.commit()
+            self.initialized = True
+            self.created += 1
+        self.pool.put(conn)
+
+    # borrow a connection from the pool (waits for one to be returned if they are all in use)
+    @contextmanager
+    def Connection(self):
+        if (not self.initialized):
+            self.Initialize()
+        try:
+            conn = self.pool.get_nowait()
+        except Empty:
+            with self.lock:
+                create = self.created < self.poolSize
+                if (create):
+                    self.created += 1
+            conn = self._connect() if create else self.pool.get(timeout=30)
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.put(conn)
+
+    def Get(self, userId: str) -> tuple|None:
+        with self.Connection() as conn:
+            return conn.execute('SELECT * FROM drivers WHERE userId = ?', (userId,)).fetchone()
+
+    def Insert(self, userId: str, carType: str, carMake: str, carModel: str, carYear: str, carColor: str, carLicensePlate: str) -> None:
+        with self.Connection() as conn:
+            conn.execute('INSERT INTO drivers VALUES (?, ?, ?, ?, ?, ?, ?)', (userId, carType, carMake, carModel, carYear, carColor, carLicensePlate))
+            conn.commit()
+        self.ForgetCarTypes()
+
+    def Update(self, userId: str, carType: str, carMake: str, carModel: str, carYear: str, carColor: str, carLicensePlate: str) -> None:
+        with self.Connection() as conn:
+            conn.execute('UPDATE drivers SET carType=?, carMake=?, carModel=?, carYear=?, carColor=?, carLicensePlate=? WHERE userId=?', (carType, carMake, carModel, carYear, carColor, carLicensePlate, userId))
+            conn.commit()
+        self.ForgetCarTypes()
+
+    # every car type that at least one driver has
+    def CarTypes(self) -> list[str]:
+        carTypes = self.carTypes
+        if (carTypes is None or time.monotonic() - self.carTypesLoaded > self.catalogTtl):
+            with self.Connection() as conn:
+                carTypes = [i[0] for i in conn.execute('SELECT DISTINCT carType FROM drivers ORDER BY carType')]
+            self.carTypes = carTypes
+            self.carTypesLoaded = time.monotonic()
+        return carTypes
+
+    def ForgetCarTypes(self) -> None:
+        self.carTypes = None
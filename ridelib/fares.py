@@ -0,0 +1,72 @@
+from datetime import datetime
+from ridelib.geo import EARTH_RADIUS_KM
+
+# prices every trip from its straight line distance (times roadFactor, since roads aren't straight), the car type's
+# rates and a multiplier for the hour of the day; quotes are computed for whole arrays of trips at once with numpy
+# so a driver's page (or every car type for a rider) is one call no matter how many requests there are
+
+# carType -> rates, car types without their own rates use 'default' (rates passed to FareEngine are merged over these)
+DEFAULT_RATES = {
+    'default': {'base': 3.0, 'perKm': 1.2, 'perMinute': 0.3, 'minimum': 6.0},
+    'van': {'base': 5.0, 'perKm': 1.6, 'perMinute': 0.4, 'minimum': 9.0},
+    'luxury': {'base': 8.0, 'perKm': 2.5, 'perMinute': 0.6, 'minimum': 15.0},
+}
+
+# one multiplier per hour of the day: nights and both rush hours cost more
+DEFAULT_HOURLY_MULTIPLIERS = [1.2] * 6 + [1.0, 1.3, 1.3, 1.0] + [1.0] * 6 + [1.3, 1.3, 1.3] + [1.0] * 3 + [1.2] * 2
+
+# great circle distances in km between arrays of points
+def haversineArray(lat1, long1, lat2, long2):
+    import numpy as np # only loaded once something gets priced
+    lat1, long1, lat2, long2 = (np.radians(np.asarray(i, dtype=float)) for i in (lat1, long1, lat2, long2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+class FareEngine():
+    def __init__(self, rates: dict|None = None, hourlyMultipliers: list[float]|None = None, speedKmh: float = 30, roadFactor: float = 1.3):
+        self.rates = DEFAULT_RATES | (rates or {})
+        self.hourlyMultipliers = hourlyMultipliers or DEFAULT_HOURLY_MULTIPLIERS
+        # a bad FARE_RATES / FARE_HOURLY_MULTIPLIERS should stop create_app, not fail every quote later
+        for carType, carRates in self.rates.items():
+            missing = {'base', 'perKm', 'perMinute', 'minimum'} - set(carRates)
+            if (missing):
+                raise ValueError(f"The fare rates for {carType} are missing {', '.join(sorted(missing))}")
+        if (len(self.hourlyMultipliers) != 24):
+            raise ValueError("There has to be one fare multiplier for every hour of the day")
+        self.speedKmh = speedKmh
+        self.roadFactor = roadFactor
+
+    def _rates(self, carTypes: list[str]):
+        import numpy as np
+        default = self.rates['default']
+        table = [self.rates.get(carType, default) for carType in carTypes]
+        return {key: np.fromiter((i[key] for i in table), dtype=float, count=len(table)) for key in ('base', 'perKm', 'perMinute', 'minimum')}
+
+    # minutes to drive between arrays of points
+    def Minutes(self, fromLats, fromLongs, toLats, toLongs):
+        return haversineArray(fromLats, fromLongs, toLats, toLongs) * self.roadFactor / self.speedKmh * 60
+
+    # a quote ({'fare', 'distanceKm', 'minutes'}) for every trip, carTypes is one car type per trip
+    def Quotes(self, carTypes: list[str], pickupLats, pickupLongs, destinationLats, destinationLongs, when: datetime|None = None) -> list[dict]:
+        import numpy as np
+        if (not len(carTypes)):
+            return []
+        distance = haversineArray(pickupLats, pickupLongs, destinationLats, destinationLongs) * self.roadFactor
+        minutes = distance / self.speedKmh * 60
+        rates = self._rates(carTypes)
+        multiplier = self.hourlyMultipliers[(when or datetime.now()).hour]
+        fares = np.maximum(rates['minimum'], (rates['base'] + rates['perKm'] * distance + rates['perMinute'] * minutes) * multiplier)
+        return [{'fare': fare, 'distanceKm': distanceKm, 'minutes': int(round(minute))}
+                for fare, distanceKm, minute in zip(np.round(fares, 2).tolist(), np.round(distance, 2).tolist(), minutes.tolist())]
+
+    # quotes for ride requests (or rides), from their pickup to their destination address
+    def QuoteRequests(self, rideRequests: list[dict], when: datetime|None = None) -> list[dict]:
+        return self.Quotes([i['carType'] for i in rideRequests],
+                           [float(i['pickup']['lat']) for i in rideRequests], [float(i['pickup']['long']) for i in rideRequests],
+                           [float(i['address']['lat']) for i in rideRequests], [float(i['address']['long']) for i in rideRequests], when)
+
+    # what the same trip costs with every car type, for the rider to compare before they request it
+    def QuoteCarTypes(self, carTypes: list[str], pickup: tuple[float, float], destination: tuple[float, float], when: datetime|None = None) -> list[dict]:
+        count = len(carTypes)
+        quotes = self.Quotes(carTypes, [pickup[0]] * count, [pickup[1]] * count, [destination[0]] * count, [destination[1]] * count, when)
+        return [dict(quote, carType=carType) for carType, quote in zip(carTypes, quotes)]
@@ -0,0 +1,114 @@
+from math import asin, cos, floor, radians, sin, sqrt
+import heapq
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+# great circle distance between two points in kilometers
+def haversine(lat1: float, long1: float, lat2: float, long2: float) -> float:
+    dLat = radians(lat2 - lat1)
+    dLong = radians(long2 - long1)
+    a = sin(dLat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dLong / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(a))
+
+# a uniform lat/long grid that buckets keyed points into cells so that nearby lookups only have to look at a few cells
+# instead of every point (cellSize is in degrees, 0.01 is roughly 1.1km)
+class GridIndex():
+    def __init__(self, cellSize: float = 0.01):
+        self.cellSize = cellSize
+        self.cells = {} # (row, col) -> {key: (lat, long, value)}
+        self.keys = {} # key -> (row, col)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key) -> bool:
+        return key in self.keys
+
+    def Cell(self, lat: float, long: float) -> tuple[int, int]:
+        return (floor(lat / self.cellSize), floor(long / self.cellSize))
+
+    def Insert(self, key, lat: float, long: float, value) -> None:
+        self.Remove(key) # moving a point is the same as removing and re adding it
+        cell = self.Cell(lat, long)
+        self.cells.setdefault(cell, {})[key] = (lat, long, value)
+        self.keys[key] = cell
+
+    def Remove(self, key):
+        cell = self.keys.pop(key, None)
+        if (cell is None):
+            return None
+        bucket = self.cells[cell]
+        _, _, value = bucket.pop(key)
+        if (not bucket): # dont keep empty cells around or the dict grows forever
+            del self.cells[cell]
+        return value
+
+    def Get(self, key):
+        cell = self.keys.get(key)
+        return self.cells[cell][key][2] if cell is not None else None
+
+    def Values(self):
+        for bucket in self.cells.values():
+            for _, _, value in bucket.values():
+                yield value
+
+    # returns up to k (distanceKm, key, value) tuples ordered by distance, only looking outward ring by ring
+    # until the remaining rings cannot possibly contain anything closer than what we already found
+    def Nearest(self, lat: float, long: float, k: int = 10, radiusKm: float|None = None, where=None) -> list[tuple]:
+        if (not self.keys or k <= 0):
+            return []
+        row, col = self.Cell(lat, long)
+        # the smallest side of a cell around this latitude, used to bound the distance of each ring
+        cellKm = self.cellSize * KM_PER_DEGREE * max(cos(radians(lat)), 0.01)
+        maxRing = None
+        if (radiusKm is not None):
+            maxRing = int(radiusKm / cellKm) + 1
+        found = []
+        ring = 0
+        visited = 0
+        while visited < len(self.cells):
+            if (maxRing is not None and ring > maxRing):
+                break
+            # every cell in ring r is at least (r - 1) cells away from the point
+            ringDistance = (ring - 1) * cellKm
+            if (len(found) >= k and ringDistance > -found[0][0]):
+                break
+            if (radiusKm is not None and ringDistance > radiusKm):
+                break
+            if (ring > 0 and 8 * ring > len(self.cells)):
+                # the ring has more cells than there are occupied cells, so just check the occupied ones that are left
+                cells = [cell for cell in self.cells if max(abs(cell[0] - row), abs(cell[1] - col)) >= ring]
+                visited = len(self.cells)
+            else:
+                cells = self._ring(row, col, ring)
+            for cell in cells:
+                bucket = self.cells.get(cell)
+                if (bucket is None):
+                    continue
+                visited += 1
+                for key, (pLat, pLong, value) in bucket.items():
+                    if (where is not None and not where(value)):
+                        continue
+                    distance = haversine(lat, long, pLat, pLong)
+                    if (radiusKm is not None and distance > radiusKm):
+                        continue
+                    # keep a max heap of size k (negated distances) so we only hold the best k candidates
+                    item = (-distance, id(value), key, value)
+                    if (len(found) < k):
+                        heapq.heappush(found, item)
+                    elif (distance < -found[0][0]):
+                        heapq.heapreplace(found, item)
+            ring += 1
+        return [(-d, key, value) for d, _, key, value in sorted(found, reverse=True)]
+
+    def _ring(self, row: int, col: int, ring: int):
+        if (ring == 0):
+            yield (row, col)
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield (row - ring, c)
+            yield (row + ring, c)
+        for r in range(row - ring + 1, row + ring):
+            yield (r, col - ring)
+            yield (r, col + ring)
@@ -0,0 +1,141 @@
+import re
+import sqlite3
+import time
+from threading import Event, Lock
+from ridelib.cache import TTLCache
+from ridelib import metrics
+
+lookups = metrics.counter('geocode_lookups_total', 'Address lookups by where the answer came from', ('source',))
+upstreamLatency = metrics.histogram('geocode_upstream_seconds', 'Time spent calling the geocoding service', ('result',))
+
+class GeocodingError(Exception):
+    pass
+
+# "  Ben Gurion  Airport, " and "ben gurion airport" should share a cache entry
+def normalizeAddress(address: str) -> str:
+    address = re.sub(r'\s+', ' ', address.casefold())
+    address = re.sub(r'\s*,\s*', ', ', address)
+    return address.strip(' ,.')
+
+# looks addresses up on nominatim (openstreetmap), returns (lat, long) or None if nothing matched
+class NominatimUpstream():
+    def __init__(self, url: str = 'https://nominatim.openstreetmap.org/search', timeout: float = 5, userAgent: str = 'WebPy-Rides/1.0'):
+        self.url = url
+        self.timeout = timeout
+        self.userAgent = userAgent
+        self.session = None
+
+    def __call__(self, address: str) -> tuple[float, float]|None:
+        import requests
+        if (self.session is None):
+            self.session = requests.Session() # reuse the connection to nominatim between lookups
+            self.session.headers['User-Agent'] = self.userAgent
+        try:
+            response = self.session.get(self.url, params={'q': address, 'format': 'json', 'limit': 1}, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise GeocodingError(str(e)) from e
+        if (response.status_code != 200):
+            raise GeocodingError(f"nominatim answered with {response.status_code}")
+        try:
+            data = response.json()
+            if (not data):
+                return None
+            location = data[0] # pick the first matching location
+            return (float(location['lat']), float(location['lon']))
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            # not the json we expected (for example a proxy's error page), callers only have to handle GeocodingError
+            raise GeocodingError(f"unexpected answer from nominatim: {e!r}") from e
+
+# a fixed address book, for tests and local development without network access
+class StaticUpstream():
+    def __init__(self, places: dict[str, tuple[float, float]]):
+        self.places = {normalizeAddress(address): location for address, location in places.items()}
+        self.calls = 0
+
+    def __call__(self, address: str) -> tuple[float, float]|None:
+        self.calls += 1
+        return self.places.get(normalizeAddress(address))
+
+class _Flight():
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
+
+# sits in front of an upstream geocoder: memory LRU -> sqlite table on disk -> upstream
+# concurrent lookups of the same address share a single upstream request
+class Geocoder():
+    def __init__(self, upstream, path: str = 'geocode.db', ttl: float = 30 * 24 * 3600, missTtl: float = 3600, maxSize: int = 4096):
+        self.upstream = upstream
+        self.ttl = ttl
+        self.missTtl = missTtl # addresses that don't exist are remembered for a shorter time
+        self.memory = TTLCache(maxSize, ttl, clock=time.time)
+        self.inflight = {}
+        self.lock = Lock()
+        self.dbLock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+                        CREATE TABLE IF NOT EXISTS geocodes (
+                        address TEXT PRIMARY KEY,
+                        lat REAL,
+                        long REAL,
+                        expires REAL)""")
+        self.db.commit()
+
+    def Lookup(self, address: str) -> tuple[float, float]|None:
+        key = normalizeAddress(address)
+        if (not key):
+            return None
+        cached = self.memory.Get(key, False)
+        if (cached is not False):
+            lookups.Inc('memory')
+            return cached
+
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if (leader):
+                flight = self.inflight[key] = _Flight()
+        if (not leader):
+            # somebody is already looking this address up, wait for their answer
+            flight.event.wait()
+            if (flight.error is not None):
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._resolve(key)
+            return flight.result
+        except Exception as e: # whatever the upstream raised, the waiters raise it too instead of getting None
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.event.set()
+
+    def _resolve(self, key: str) -> tuple[float, float]|None:
+        now = time.time()
+        with self.dbLock:
+            row = self.db.execute('SELECT lat, long, expires FROM geocodes WHERE address = ?', (key,)).fetchone()
+        if (row is not None and row[2] > now):
+            location = (row[0], row[1]) if row[0] is not None else None
+            self.memory.Set(key, location, row[2] - now)
+            lookups.Inc('disk')
+            return location
+
+        start = time.perf_counter()
+        try:
+            location = self.upstream(key)
+        except Exception:
+            upstreamLatency.Observe(time.perf_counter() - start, 'error')
+            raise
+        upstreamLatency.Observe(time.perf_counter() - start, 'found' if location is not None else 'not_found')
+        lookups.Inc('upstream')
+        ttl = self.ttl if location is not None else self.missTtl
+        self.memory.Set(key, location, ttl)
+        with self.dbLock:
+            self.db.execute('INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)',
+                            (key, location[0] if location else None, location[1] if location else None, now + ttl))
+            self.db.commit()
+        return location
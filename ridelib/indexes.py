@@ -0,0 +1,52 @@
+import logging
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+# every index the app relies on, as (collection, keys, options)
+INDEXES = [
+    # a ride can only be created once per ride request (see on_selrid)
+    ('rides', [('requestId', ASCENDING)], {'name': 'requestId', 'unique': True, 'partialFilterExpression': {'requestId': {'$exists': True}}}),
+    # "is this user in a ride right now", only rides that haven't arrived yet are in these
+    ('rides', [('driverId', ASCENDING)], {'name': 'active_driverId', 'partialFilterExpression': {'active': True}}),
+    ('rides', [('riderId', ASCENDING)], {'name': 'active_riderId', 'partialFilterExpression': {'active': True}}),
+    ('users', [('username', ASCENDING)], {'name': 'username', 'unique': True}),
+    ('users', [('email', ASCENDING)], {'name': 'email'}),
+    ('chatBuckets', [('rideId', ASCENDING), ('bucket', ASCENDING)], {'name': 'rideId_bucket', 'unique': True}),
+    # the batches of a ride's driver track, in the order they were written
+    ('rideTracks', [('rideId', ASCENDING), ('_id', ASCENDING)], {'name': 'rideId__id'}),
+    # profile images and their thumbnails (see auth.image)
+    ('fs.files', [('image_id', ASCENDING), ('size', ASCENDING)], {'name': 'image_id_size'}),
+]
+
+# rides from before the active flag existed, the active indexes only see rides that have it
+def markActiveRides(db) -> None:
+    db['rides'].update_many({'arrived': {'$exists': False}, 'active': {'$exists': False}}, {'$set': {'active': True}})
+
+# run once the first time an index gets created (for data that has to be fixed up before the index is useful)
+MIGRATIONS = {
+    ('rides', 'active_driverId'): markActiveRides,
+}
+
+# create every index that doesn't exist yet (creating one that already exists is a cheap no-op for mongo)
+# migrations adds to MIGRATIONS, for the ones that need something from the app (like the chat store's bucket size)
+def ensureIndexes(db, migrations: dict|None = None) -> list[str]:
+    logger = logging.getLogger(__name__)
+    migrations = MIGRATIONS | (migrations or {})
+    created = []
+    existing = {}
+    for collection, keys, options in INDEXES:
+        if (collection not in existing):
+            existing[collection] = set(db[collection].index_information())
+        if (options['name'] in existing[collection]):
+            continue
+        migration = migrations.get((collection, options['name']))
+        if (migration is not None):
+            migration(db)
+        try:
+            db[collection].create_index(keys, **options)
+        except OperationFailure:
+            # for example duplicate usernames that were created before the unique index, the app still works without it
+            logger.exception("Couldn't create index %s on %s", options['name'], collection)
+            continue
+        created.append(f"{collection}.{options['name']}")
+    return created
@@ -0,0 +1,37 @@
+from ridelib.cache import TTLCache
+
+# rendered folium maps per ride, a ride's pickup and destination never change so the html can be reused
+# for every view of the ride page (it's keyed by the coordinates as well just in case)
+class RideMaps():
+    def __init__(self, maxSize: int = 1024, ttl: float = 3600):
+        self.cache = TTLCache(maxSize, ttl)
+
+    def Render(self, rideId: str, pickup: tuple[float, float], destination: tuple[float, float]) -> str:
+        cached = self.cache.Get(rideId)
+        if (cached is not None and cached[0] == (pickup, destination)):
+            return cached[1]
+        html = renderRideMap(pickup, destination)
+        self.cache.Set(rideId, ((pickup, destination), html))
+        return html
+
+    def Forget(self, rideId: str) -> None:
+        self.cache.Delete(rideId)
+
+# pickup and destination are (lat, long)
+def renderRideMap(pickup: tuple[float, float], destination: tuple[float, float]) -> str:
+    import folium # folium takes a while to import, so only do it once a map is actually needed
+    # Create the map
+    map = folium.Map(location=destination, zoom_start = 13)
+
+    # Add points to the map
+    folium.Marker(pickup, popup='Pickup').add_to(map)
+    folium.Marker(destination, popup='Destination').add_to(map)
+
+    # Draw line between point A and point B
+    folium.PolyLine(locations=[pickup, destination], color="red", weight=2.5, opacity=1).add_to(map)
+    return map._repr_html_()
+
+# the (pickup, destination) points of a ride document as (lat, long) tuples
+def ridePoints(ride: dict) -> tuple[tuple[float, float], tuple[float, float]]:
+    return ((float(ride['pickup']['lat']), float(ride['pickup']['long'])),
+            (float(ride['address']['lat']), float(ride['address']['long'])))
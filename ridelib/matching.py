@@ -0,0 +1,87 @@
+from math import isfinite
+from threading import RLock
+from ridelib.geo import GridIndex
+
+# (lat, long) as floats, or None if either is missing, not a number or out of range
+def parseLocation(lat, long) -> tuple[float, float]|None:
+    try:
+        lat, long = float(lat), float(long)
+    except (TypeError, ValueError):
+        return None
+    if (not (isfinite(lat) and isfinite(long) and -90 <= lat <= 90 and -180 <= long <= 180)):
+        return None
+    return (lat, long)
+
+# keeps track of which drivers are free to take a ride right now (per car type) and where they are
+# drivers are added when they open the ride exchange and removed when they leave it or a ride gets created for them
+# (a driver who finished a ride is added back once they open the ride exchange again)
+class DriverAvailability():
+    def __init__(self, cellSize: float = 0.01):
+        self.cellSize = cellSize
+        self.grids = {} # carType -> GridIndex of driverId (drivers with a known location)
+        self.unlocated = {} # carType -> {driverId: None} (drivers that didn't share a location, in insertion order)
+        self.carTypes = {} # driverId -> carType
+        self.lock = RLock()
+
+    def __len__(self) -> int:
+        return len(self.carTypes)
+
+    def __contains__(self, driverId: str) -> bool:
+        return driverId in self.carTypes
+
+    # a location that is missing or isn't a real coordinate (it comes from the driver's browser) counts as unknown
+    def Available(self, driverId: str, carType: str, lat: float|None = None, long: float|None = None) -> None:
+        location = parseLocation(lat, long)
+        with self.lock:
+            self.Busy(driverId)
+            self.carTypes[driverId] = carType
+            if (location is None):
+                self.unlocated.setdefault(carType, {})[driverId] = None
+                return
+            grid = self.grids.get(carType)
+            if (grid is None):
+                grid = self.grids[carType] = GridIndex(self.cellSize)
+            grid.Insert(driverId, *location, driverId)
+
+    # mark a driver as not available (in a ride or offline), returns whether they were available
+    def Busy(self, driverId: str) -> bool:
+        with self.lock:
+            carType = self.carTypes.pop(driverId, None)
+            if (carType is None):
+                return False
+            grid = self.grids.get(carType)
+            if (grid is not None and grid.Remove(driverId) is not None and not len(grid)):
+                del self.grids[carType]
+            unlocated = self.unlocated.get(carType)
+            if (unlocated is not None):
+                unlocated.pop(driverId, None)
+                if (not unlocated):
+                    del self.unlocated[carType]
+            return True
+
+    def Count(self, carType: str) -> int:
+        grid = self.grids.get(carType)
+        return (len(grid) if grid is not None else 0) + len(self.unlocated.get(carType, ()))
+
+    # the id of the closest free driver to a point, falling back to a free driver with no known location
+    def Closest(self, carType: str, lat: float|None = None, long: float|None = None, radiusKm: float|None = None) -> str|None:
+        with self.lock:
+            grid = self.grids.get(carType)
+            if (grid is not None and lat is not None and long is not None):
+                nearest = grid.Nearest(float(lat), float(long), 1, radiusKm)
+                if (nearest):
+                    return nearest[0][1]
+            unlocated = self.unlocated.get(carType)
+            if (unlocated):
+                return next(iter(unlocated))
+            if (grid is not None and (lat is None or long is None)):
+                return next(grid.Values(), None)
+            return None
+
+    # every free driver of a car type that could care about a point: (driverId, distanceKm) for the located ones within radiusKm
+    # and (driverId, None) for the ones whose location we don't know
+    def Near(self, carType: str, lat: float, long: float, radiusKm: float) -> list[tuple[str, float|None]]:
+        with self.lock:
+            grid = self.grids.get(carType)
+            near = [(driverId, distance) for distance, driverId, _ in grid.Nearest(float(lat), float(long), len(grid), radiusKm)] if grid is not None else []
+            return near + [(driverId, None) for driverId in self.unlocated.get(carType, ())]
@@ -0,0 +1,150 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+import time
+
+# small, dependency free metrics that render in the prometheus text format (served on /metrics)
+# every metric keeps its values per tuple of label values, recording one is a dict lookup and a few additions under a lock
+
+# in seconds, from a cache hit up to a slow upstream call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if (extra):
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metric():
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        self.values = {} # label values -> value
+
+    def Render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            values = list(self.values.items())
+        for labelValues, value in values:
+            lines.append(f'{self.name}{_labels(self.labels, labelValues)} {_number(value)}')
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def Inc(self, *labelValues, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def Value(self, *labelValues) -> float:
+        return self.values.get(labelValues, 0)
+
+# a value that goes up and down, or (with `collect`) one that is read from somewhere else whenever the metrics are scraped
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect # returns {label values: value}
+
+    def Inc(self, *labelValues, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def Dec(self, *labelValues, amount: float = 1) -> None:
+        self.Inc(*labelValues, amount=-amount)
+
+    def Set(self, value: float, *labelValues) -> None:
+        with self.lock:
+            self.values[labelValues] = value
+
+    def Value(self, *labelValues) -> float:
+        return self.values.get(labelValues, 0)
+
+    def Render(self) -> list[str]:
+        if (self.collect is not None):
+            values = self.collect()
+            with self.lock:
+                self.values = dict(values)
+        return super().Render()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def Observe(self, value: float, *labelValues) -> None:
+        index = bisect_left(self.buckets, value) # the first bucket the value fits in (len(buckets) is +Inf)
+        with self.lock:
+            state = self.values.get(labelValues)
+            if (state is None):
+                state = self.values[labelValues] = [[0] * (len(self.buckets) + 1), 0.0, 0] # per bucket counts, sum, count
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    # times the block with a monotonic clock
+    @contextmanager
+    def Time(self, *labelValues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.Observe(time.perf_counter() - start, *labelValues)
+
+    # (count, sum) for one set of label values
+    def Value(self, *labelValues) -> tuple[int, float]:
+        state = self.values.get(labelValues)
+        return (state[2], state[1]) if state is not None else (0, 0.0)
+
+    def Render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            values = [(labelValues, (list(state[0]), state[1], state[2])) for labelValues, state in self.values.items()]
+        for labelValues, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets, counts):
+                cumulative += bucketCount
+                lines.append(f'{self.name}_bucket{_labels(self.labels, labelValues, f'le="{_number(bound)}"')} {cumulative}')
+            lines.append(f'{self.name}_bucket{_labels(self.labels, labelValues, 'le="+Inf"')} {count}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, labelValues)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labels, labelValues)} {count}')
+        return lines
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+
+    # returns the metric that is already registered under the same name, so modules that are imported twice share it
+    def Register(self, metric: Metric) -> Metric:
+        return self.metrics.setdefault(metric.name, metric)
+
+    def Render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.Render())
+        return '\n'.join(lines) + '\n'
+
+# the registry /metrics renders, every module registers its metrics here
+registry = Registry()
+
+def counter(name: str, help: str, labels: tuple = ()) -> Counter:
+    return registry.Register(Counter(name, help, labels))
+
+def gauge(name: str, help: str, labels: tuple = (), collect=None) -> Gauge:
+    return registry.Register(Gauge(name, help, labels, collect))
+
+def histogram(name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return registry.Register(Histogram(name, help, labels, buckets))
@@ -0,0 +1,146 @@
+import json
+import logging
+import sqlite3
+import time
+from threading import Event, Lock, Thread
+from ridelib import metrics
+
+sendLatency = metrics.histogram('mail_send_batch_seconds', 'Time spent handing a batch of mail to the transport (smtp)')
+mailResults = metrics.counter('mail_messages_total', 'Mail the outbox tried to send by result', ('result',))
+
+# sends mail through flask-mail, a whole batch goes over one smtp connection
+class FlaskMailTransport():
+    def __init__(self, app):
+        self.app = app
+        self.mail = None # flask-mail is only loaded once there is something to send
+
+    # returns the error for every message that couldn't be sent (None for the ones that were sent)
+    def SendBatch(self, messages: list[dict]) -> list[Exception|None]:
+        from flask_mail import Mail, Message
+        if (self.mail is None):
+            self.mail = Mail(self.app)
+        results = []
+        with self.app.app_context(), self.mail.connect() as connection:
+            for message in messages:
+                try:
+                    connection.send(Message(subject=message['subject'], body=message['body'], sender=message['sender'], recipients=message['recipients']))
+                    results.append(None)
+                except Exception as e:
+                    results.append(e)
+        return results
+
+# keeps every message in memory instead of sending it (tests, benchmarks and development without an smtp server)
+class MemoryTransport():
+    def __init__(self):
+        self.sent = []
+        self.batches = 0
+
+    def SendBatch(self, messages: list[dict]) -> list[Exception|None]:
+        self.batches += 1
+        self.sent.extend(messages)
+        return [None] * len(messages)
+
+# a durable queue of outgoing mail, requests only write a row to sqlite and a background thread
+# sends everything that is due in batches (retrying failures with exponential backoff)
+# a batch is claimed before it is sent by pushing its nextAttempt lease seconds ahead, so several processes can share
+# one outbox.db without sending the same mail twice (and a process that dies while sending only delays its batch)
+class Outbox():
+    def __init__(self, transport, path: str = 'outbox.db', batchSize: int = 50, maxAttempts: int = 5, retryDelay: float = 5, lease: float = 300):
+        self.transport = transport
+        self.batchSize = batchSize
+        self.maxAttempts = maxAttempts
+        self.retryDelay = retryDelay
+        self.lease = lease
+        self.wakeup = Event()
+        self.stopping = Event()
+        self.thread = None
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+                        CREATE TABLE IF NOT EXISTS outbox (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        subject TEXT,
+                        body TEXT,
+                        sender TEXT,
+                        recipients TEXT,
+                        attempts INTEGER DEFAULT 0,
+                        nextAttempt REAL,
+                        lastError TEXT)""")
+        self.db.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (attempts, nextAttempt)')
+        self.db.commit()
+
+    # queue a flask_mail.Message (or anything with subject/body/sender/recipients) for sending
+    def Send(self, msg) -> None:
+        self.Enqueue(msg.subject, msg.body, msg.sender, msg.recipients)
+
+    def Enqueue(self, subject: str, body: str, sender: str, recipients: list[str]) -> None:
+        with self.lock:
+            self.db.execute('INSERT INTO outbox (subject, body, sender, recipients, nextAttempt) VALUES (?, ?, ?, ?, ?)',
+                            (subject, body, sender, json.dumps(list(recipients)), time.time()))
+            self.db.commit()
+        self.wakeup.set()
+
+    def Pending(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM outbox WHERE attempts < ?', (self.maxAttempts,)).fetchone()[0]
+
+    # send one batch of due messages, returns how many were sent
+    def Flush(self) -> int:
+        now = time.time()
+        with self.lock:
+            # a single statement, so sqlite's write lock makes the claim atomic across processes too
+            rows = self.db.execute('UPDATE outbox SET nextAttempt = ? WHERE id IN (SELECT id FROM outbox WHERE attempts < ? AND nextAttempt <= ? ORDER BY id LIMIT ?) '
+                                   'RETURNING id, subject, body, sender, recipients, attempts',
+                                   (now + self.lease, self.maxAttempts, now, self.batchSize)).fetchall()
+            self.db.commit()
+        rows.sort(key=lambda i: i[0])
+        if (not rows):
+            return 0
+        messages = [{'subject': i[1], 'body': i[2], 'sender': i[3], 'recipients': json.loads(i[4])} for i in rows]
+        start = time.perf_counter()
+        try:
+            results = self.transport.SendBatch(messages)
+        except Exception as e: # couldn't even connect, the whole batch failed
+            results = [e] * len(rows)
+        sendLatency.Observe(time.perf_counter() - start)
+
+        sent = [(row[0],) for row, error in zip(rows, results) if error is None]
+        failed = [(row[5] + 1, time.time() + self.retryDelay * 2 ** row[5], str(error), row[0]) for row, error in zip(rows, results) if error is not None]
+        mailResults.Inc('sent', amount=len(sent))
+        mailResults.Inc('failed', amount=len(failed))
+        with self.lock:
+            self.db.executemany('DELETE FROM outbox WHERE id = ?', sent)
+            # messages that ran out of attempts stay in the table (with their last error) so they can be looked at
+            self.db.executemany('UPDATE outbox SET attempts = ?, nextAttempt = ?, lastError = ? WHERE id = ?', failed)
+            self.db.commit()
+        return len(sent)
+
+    def _nextDue(self) -> float|None:
+        with self.lock:
+            row = self.db.execute('SELECT MIN(nextAttempt) FROM outbox WHERE attempts < ?', (self.maxAttempts,)).fetchone()
+        return row[0]
+
+    def _run(self) -> None:
+        while not self.stopping.is_set():
+            self.wakeup.clear() # anything queued from now on wakes us up again
+            try:
+                while self.Flush() == self.batchSize:
+                    pass # there is probably more waiting, keep going
+            except Exception:
+                # never let the worker die, the rows are still in the table and will be retried
+                logging.getLogger(__name__).exception("Sending queued mail failed")
+            nextDue = self._nextDue()
+            self.wakeup.wait(None if nextDue is None else max(nextDue - time.time(), 0.1))
+
+    def Start(self) -> None:
+        if (self.thread is None):
+            self.thread = Thread(target=self._run, name='outbox', daemon=True)
+            self.thread.start()
+
+    def Stop(self) -> None:
+        self.stopping.set()
+        self.wakeup.set()
+        if (self.thread is not None):
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,93 @@
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+import multiprocessing
+import time
+import bcrypt
+from ridelib.cache import TTLCache
+from ridelib import blocking
+from ridelib import metrics
+
+hashLatency = metrics.histogram('password_hash_seconds', 'Time spent hashing or checking a password (including waiting for a worker)', ('operation',))
+
+class PasswordServiceBusy(Exception):
+    pass
+
+# these run in the worker processes, so they have to be plain module level functions
+def _hash(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _check(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+# hashes and checks passwords with bcrypt on a pool of worker processes, so a burst of logins uses those processes'
+# cpu instead of tying up the workers that answer requests and socket events
+# at most maxPending calls are queued or running at once, anyone else waits up to `timeout` seconds and then gets PasswordServiceBusy
+# (workers=0 runs everything in the calling thread, for tests and tools)
+# under eventlet/gevent the calls go to the hub's os threads instead (bcrypt releases the gil, so they still use every core)
+class PasswordHasher():
+    def __init__(self, rounds: int = 12, workers: int = 2, maxPending: int|None = None, timeout: float = 5):
+        self.rounds = rounds
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = BoundedSemaphore(maxPending or max(workers, 1) * 4)
+        self.executor = None # the processes are only started once a password has to be hashed
+        self.lock = Lock()
+
+    def _run(self, operation: str, function, *args):
+        start = time.perf_counter()
+        if (not self.slots.acquire(timeout=self.timeout)):
+            raise PasswordServiceBusy()
+        try:
+            if (self.workers <= 0):
+                return function(*args)
+            if (blocking.cooperative()):
+                return blocking.offload(function, *args)
+            if (self.executor is None):
+                with self.lock:
+                    if (self.executor is None):
+                        # forkserver children don't inherit the app's threads and open sockets the way forked ones would
+                        self.executor = ProcessPoolExecutor(self.workers, multiprocessing.get_context('forkserver'))
+            return self.executor.submit(function, *args).result()
+        finally:
+            self.slots.release()
+            hashLatency.Observe(time.perf_counter() - start, operation)
+
+    def Hash(self, password: str) -> str:
+        return self._run('hash', _hash, password.encode('utf-8'), self.rounds).decode('utf-8')
+
+    def Check(self, password: str, hashed: str) -> bool:
+        return self._run('check', _check, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    # whether a hash was made with a different cost than the current one (so it should be replaced after the next login)
+    def NeedsRehash(self, hashed: str) -> bool:
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def Close(self) -> None:
+        if (self.executor is not None):
+            self.executor.shutdown()
+            self.executor = None
+
+# allows `limit` attempts per key (a username, an ip address) in every `window` seconds
+class RateLimiter():
+    def __init__(self, limit: int, window: float, maxKeys: int = 100000, clock=time.monotonic):
+        self.limit = limit
+        self.window = window
+        self.clock = clock
+        self.counts = TTLCache(maxKeys, window, clock) # key -> (window end, attempts)
+        self.lock = Lock()
+
+    # counts an attempt, returns False if the key already used up its attempts for this window
+    def Hit(self, key: str) -> bool:
+        with self.lock:
+            now = self.clock()
+            end, attempts = self.counts.Get(key, (now + self.window, 0))
+            if (attempts >= self.limit):
+                return False
+            self.counts.Set(key, (end, attempts + 1), end - now)
+            return True
+
+    def Reset(self, key: str) -> None:
+        self.counts.Delete(key)
@@ -0,0 +1,129 @@
+from itertools import count
+from threading import Lock
+import heapq
+import time
+from ridelib.geo import GridIndex
+
+# holds every ride request that hasn't been picked up by a driver yet
+# requests are indexed by the rider's userId (so cancel/select are a dict lookup) and by the pickup location
+# in a grid per car type (so drivers can ask for the closest requests without walking all of them)
+# each car type has its own lock, and claiming a request doesn't need one at all until the winner is known
+# requests expire `ttl` seconds after they were added and once there are more than maxSize the oldest ones are dropped,
+# both are found with a heap of deadlines (entries for requests that are already gone are skipped when they come up)
+class PendingRideStore():
+    def __init__(self, cellSize: float = 0.01, ttl: float|None = None, maxSize: int|None = None, clock=time.monotonic):
+        self.cellSize = cellSize
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.clock = clock
+        self.requests = {} # userId -> ride request
+        self.grids = {} # carType -> GridIndex of userId
+        self.locks = {} # carType -> Lock
+        self.deadlines = [] # heap of (deadline, order, userId, ride request)
+        self.order = count() # keeps requests with the same deadline in the order they were added
+        self.deadlinesLock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.requests)
+
+    def __contains__(self, userId: str) -> bool:
+        return userId in self.requests
+
+    def _lock(self, carType: str) -> Lock:
+        lock = self.locks.get(carType)
+        if (lock is None):
+            lock = self.locks.setdefault(carType, Lock()) # setdefault is atomic, so every thread ends up with the same lock
+        return lock
+
+    # returns the requests that had to be dropped to stay under maxSize
+    def Add(self, rideRequest: dict) -> list[dict]:
+        lat, long = float(rideRequest['pickup']['lat']), float(rideRequest['pickup']['long'])
+        # a rider can only have one pending request at a time
+        self.Remove(rideRequest['userId'])
+        with self._lock(rideRequest['carType']):
+            self.requests[rideRequest['userId']] = rideRequest
+            grid = self.grids.get(rideRequest['carType'])
+            if (grid is None):
+                grid = self.grids[rideRequest['carType']] = GridIndex(self.cellSize)
+            grid.Insert(rideRequest['userId'], lat, long, rideRequest)
+        deadline = self.clock() + self.ttl if self.ttl else float('inf')
+        with self.deadlinesLock:
+            heapq.heappush(self.deadlines, (deadline, next(self.order), rideRequest['userId'], rideRequest))
+            if (len(self.deadlines) > 2 * len(self.requests) + 64):
+                # most entries belong to requests that were claimed or cancelled, drop them
+                self.deadlines = [i for i in self.deadlines if self.requests.get(i[2]) is i[3]]
+                heapq.heapify(self.deadlines)
+        if (self.maxSize is not None and len(self.requests) > self.maxSize):
+            return self._popDue(lambda _: len(self.requests) > self.maxSize)
+        return []
+
+    # remove and return every request whose deadline has passed
+    def Expire(self) -> list[dict]:
+        now = self.clock()
+        return self._popDue(lambda deadline: deadline <= now)
+
+    # pop requests in deadline order while due(deadline of the next one) says so
+    def _popDue(self, due) -> list[dict]:
+        removed = []
+        while True:
+            with self.deadlinesLock:
+                if (not self.deadlines or not due(self.deadlines[0][0])):
+                    return removed
+                _, _, userId, rideRequest = heapq.heappop(self.deadlines)
+            if (self._discard(userId, rideRequest)):
+                removed.append(rideRequest)
+
+    def Get(self, userId: str) -> dict|None:
+        return self.requests.get(userId)
+
+    # remove a request and return it (None if there was nothing to remove)
+    def Remove(self, userId: str, carType: str|None = None) -> dict|None:
+        rideRequest = self.requests.get(userId)
+        if (rideRequest is None or (carType is not None and rideRequest['carType'] != carType)):
+            return None
+        return rideRequest if self._discard(userId, rideRequest) else None
+
+    # hand a request to exactly one driver, everyone else (and anyone asking for a request that was replaced) gets None
+    def Claim(self, userId: str, driverId: str, carType: str|None = None, requestId: str|None = None) -> dict|None:
+        rideRequest = self.requests.get(userId)
+        if (rideRequest is None or (carType is not None and rideRequest['carType'] != carType)
+            or (requestId is not None and rideRequest.get('requestId') != requestId)):
+            return None
+        # the first driver to set claimedBy wins, dict.setdefault is atomic so this works as a compare and swap
+        if (rideRequest.setdefault('claimedBy', driverId) != driverId):
+            return None
+        return rideRequest if self._discard(userId, rideRequest) else None
+
+    # remove this exact request object (not a newer one from the same rider), returns whether it was removed
+    def _discard(self, userId: str, rideRequest: dict) -> bool:
+        carType = rideRequest['carType']
+        with self._lock(carType):
+            if (self.requests.get(userId) is not rideRequest):
+                return False
+            del self.requests[userId]
+            grid = self.grids[carType]
+            grid.Remove(userId)
+            if (not len(grid)):
+                del self.grids[carType]
+            return True
+
+    def Count(self, carType: str) -> int:
+        grid = self.grids.get(carType)
+        return len(grid) if grid is not None else 0
+
+    def All(self, carType: str, limit: int|None = None) -> list[dict]:
+        with self._lock(carType):
+            grid = self.grids.get(carType)
+            if (grid is None):
+                return []
+            values = list(grid.Values())
+        return values if limit is None else values[:limit]
+
+    # the k closest pending requests of a car type to a point, each one gets a 'distance' (in km) for the template
+    def Nearest(self, carType: str, lat: float, long: float, k: int = 20, radiusKm: float|None = None) -> list[dict]:
+        with self._lock(carType):
+            grid = self.grids.get(carType)
+            if (grid is None):
+                return []
+            nearest = grid.Nearest(lat, long, k, radiusKm)
+        return [dict(rideRequest, distance=round(distance, 2)) for distance, _, rideRequest in nearest]
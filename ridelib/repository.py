@@ -0,0 +1,83 @@
+from bson import ObjectId
+from pymongo import ReturnDocument
+from mongolib.connection import LazyCollection
+
+# every query the app makes against the rides and users collections lives here,
+# so they all share the one mongo client (and its pool) from mongolib.connection and can be found (and indexed for) in one place
+
+# the chat lives in its own collection so ride lookups never need to read it
+RIDE_PROJECTION = {'chat': 0}
+# just enough of a ride to check who is allowed to see it
+PARTICIPANTS_PROJECTION = {'driverId': 1, 'riderId': 1}
+
+# ids come from urls and socket events so anything that isn't an ObjectId is treated as "not found" instead of raising
+def toObjectId(id) -> ObjectId|None:
+    if (isinstance(id, ObjectId)):
+        return id
+    return ObjectId(id) if ObjectId.is_valid(id) else None
+
+class RideRepository():
+    def __init__(self, collection):
+        self.collection = collection
+
+    def Find(self, rideId, projection: dict = RIDE_PROJECTION) -> dict|None:
+        rideId = toObjectId(rideId)
+        if (rideId is None):
+            return None
+        return self.collection.find_one({'_id': rideId}, projection)
+
+    # the ride, but only if the user is its driver or its rider (otherwise None)
+    def FindForUser(self, rideId, userId: str, projection: dict = RIDE_PROJECTION) -> dict|None:
+        rideId = toObjectId(rideId)
+        if (rideId is None):
+            return None
+        # still a single lookup on _id, the participant check is just applied to the one document it finds
+        return self.collection.find_one({'_id': rideId, '$or': [{'driverId': userId}, {'riderId': userId}]}, projection)
+
+    def FindForDriver(self, rideId, driverId: str, projection: dict = RIDE_PROJECTION) -> dict|None:
+        rideId = toObjectId(rideId)
+        if (rideId is None):
+            return None
+        return self.collection.find_one({'_id': rideId, 'driverId': driverId}, projection)
+
+    # the ride for a claimed request, created the first time and returned as is after that
+    # (it is keyed by the request id, so a retried or duplicated claim can never create a second ride)
+    def CreateFromRequest(self, rideRequest: dict, driverId: str) -> dict:
+        return self.collection.find_one_and_update({'requestId': rideRequest['requestId']},
+                                                   {'$setOnInsert': {'requestId': rideRequest['requestId'], 'driverId': driverId, 'riderId': rideRequest['userId'],
+                                                                     'textAddress': rideRequest['textAddress'], 'address': rideRequest['address'], 'pickup': rideRequest['pickup'],
+                                                                     'time': rideRequest['time'], 'quote': rideRequest.get('quote'), 'chatSeq': 0, 'active': True}},
+                                                   projection={'driverId': 1}, upsert=True, return_document=ReturnDocument.AFTER)
+
+    def Finish(self, rideId, cost) -> None:
+        self.collection.update_one({'_id': toObjectId(rideId)}, {'$set': {'arrived': True, 'cost': cost}, '$unset': {'active': ''}})
+
+class UserRepository():
+    def __init__(self, collection):
+        self.collection = collection
+
+    def FindById(self, userId) -> dict|None:
+        userId = toObjectId(userId)
+        if (userId is None):
+            return None
+        return self.collection.find_one({'_id': userId})
+
+    def FindByUsername(self, username: str) -> dict|None:
+        return self.collection.find_one({'username': username})
+
+    def FindAll(self):
+        return self.collection.find({})
+
+    # returns the new user's id
+    def Insert(self, document: dict) -> str:
+        return str(self.collection.insert_one(document).inserted_id)
+
+    def Update(self, userId: str, document: dict) -> None:
+        self.collection.update_one({'_id': ObjectId(userId)}, {'$set': document})
+
+    # up to limit + 1 users (so the caller can tell if there is another page) ordered by id, without their password hashes
+    def Page(self, query: dict, limit: int):
+        return self.collection.find(query, {'password': 0}).sort('_id', 1).limit(limit + 1).batch_size(min(limit + 1, 100))
+
+rides = RideRepository(LazyCollection('rides'))
+users = UserRepository(LazyCollection('users'))
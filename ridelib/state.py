@@ -0,0 +1,154 @@
+import json
+import time
+from ridelib.pending import PendingRideStore
+
+# where the ride exchange keeps state that every worker process has to agree on:
+# the pending ride requests and which socket session belongs to which user (per namespace)
+
+# everything in this process, only works when the app runs as a single process
+class MemoryStateBackend():
+    def __init__(self, pendingTtl: float|None = None, pendingMaxSize: int|None = None):
+        self.pending = PendingRideStore(ttl=pendingTtl, maxSize=pendingMaxSize)
+        self.sessions = {}
+
+    def Sessions(self, namespace: str) -> dict:
+        return self.sessions.setdefault(namespace, {})
+
+# everything in redis, so any number of processes (on any number of machines) share the same pending requests
+class RedisStateBackend():
+    def __init__(self, url: str, prefix: str = 'rides', pendingTtl: float|None = None, pendingMaxSize: int|None = None):
+        import redis # only needed when this backend is used
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.pending = RedisPendingRideStore(self.client, prefix, pendingTtl, pendingMaxSize)
+
+    def Sessions(self, namespace: str) -> 'RedisSessionMap':
+        return RedisSessionMap(self.client, f"{self.prefix}:sessions:{namespace}")
+
+# userId -> socket session id, stored in a redis hash (behaves like the dict the memory backend uses)
+class RedisSessionMap():
+    def __init__(self, client, key: str):
+        self.client = client
+        self.key = key
+
+    def __setitem__(self, userId: str, sid: str) -> None:
+        self.client.hset(self.key, userId, sid)
+
+    def __getitem__(self, userId: str) -> str:
+        sid = self.client.hget(self.key, userId)
+        if (sid is None):
+            raise KeyError(userId)
+        return sid
+
+    def __delitem__(self, userId: str) -> None:
+        if (not self.client.hdel(self.key, userId)):
+            raise KeyError(userId)
+
+    def __contains__(self, userId: str) -> bool:
+        return bool(self.client.hexists(self.key, userId))
+
+    def __len__(self) -> int:
+        return self.client.hlen(self.key)
+
+    def get(self, userId: str, default=None):
+        sid = self.client.hget(self.key, userId)
+        return default if sid is None else sid
+
+    def pop(self, userId: str, default=None):
+        sid = self.client.hget(self.key, userId)
+        if (sid is None):
+            return default
+        self.client.hdel(self.key, userId)
+        return sid
+
+# removes a request from the hash and from its car type's geo set in one step (so only one caller ever gets it back)
+REMOVE_SCRIPT = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if not raw then return nil end
+local request = cjson.decode(raw)
+if ARGV[2] ~= '' and request['carType'] ~= ARGV[2] then return nil end
+if ARGV[4] ~= '' and request['requestId'] ~= ARGV[4] then return nil end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREM', ARGV[3] .. request['carType'], ARGV[1])
+return raw
+"""
+
+# requests without a ttl get a deadline this far away (instead of +inf) so they still expire and get evicted in the order they were added
+NO_EXPIRY = 10 ** 10
+
+# the same interface as PendingRideStore, but the requests are kept in a redis hash, the pickup locations in
+# one redis geo set per car type (so redis answers the nearest request queries) and the deadlines in a sorted set
+class RedisPendingRideStore():
+    def __init__(self, client, prefix: str = 'rides', ttl: float|None = None, maxSize: int|None = None, clock=time.time):
+        self.client = client
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.clock = clock # wall clock time, since the deadlines are shared between machines
+        self.requestsKey = f"{prefix}:pending"
+        self.deadlinesKey = f"{prefix}:pending:deadlines"
+        self.geoPrefix = f"{prefix}:pending:geo:"
+        self.remove = client.register_script(REMOVE_SCRIPT)
+
+    def __len__(self) -> int:
+        return self.client.hlen(self.requestsKey)
+
+    def __contains__(self, userId: str) -> bool:
+        return bool(self.client.hexists(self.requestsKey, userId))
+
+    def Add(self, rideRequest: dict) -> list[dict]:
+        # a rider can only have one pending request at a time
+        self.Remove(rideRequest['userId'])
+        pipeline = self.client.pipeline()
+        pipeline.hset(self.requestsKey, rideRequest['userId'], json.dumps(rideRequest))
+        pipeline.geoadd(self.geoPrefix + rideRequest['carType'], (float(rideRequest['pickup']['long']), float(rideRequest['pickup']['lat']), rideRequest['userId']))
+        pipeline.zadd(self.deadlinesKey, {rideRequest['userId']: self.clock() + (self.ttl or NO_EXPIRY)})
+        pipeline.hlen(self.requestsKey)
+        size = pipeline.execute()[-1]
+        if (self.maxSize is not None and size > self.maxSize):
+            return self._removeAll(self.client.zrange(self.deadlinesKey, 0, size - self.maxSize - 1))
+        return []
+
+    # remove and return every request whose deadline has passed (the script makes sure every process sweeping gets different ones)
+    def Expire(self) -> list[dict]:
+        return self._removeAll(self.client.zrangebyscore(self.deadlinesKey, '-inf', self.clock()))
+
+    def _removeAll(self, userIds: list[str]) -> list[dict]:
+        removed = [self.Remove(userId) for userId in userIds]
+        return [i for i in removed if i is not None]
+
+    def Get(self, userId: str) -> dict|None:
+        raw = self.client.hget(self.requestsKey, userId)
+        return json.loads(raw) if raw is not None else None
+
+    def Remove(self, userId: str, carType: str|None = None) -> dict|None:
+        raw = self.remove(keys=[self.requestsKey, self.deadlinesKey], args=[userId, carType or '', self.geoPrefix, ''])
+        return json.loads(raw) if raw is not None else None
+
+    # the removal happens inside of redis in one script, so exactly one caller (across every process) gets the request
+    def Claim(self, userId: str, driverId: str, carType: str|None = None, requestId: str|None = None) -> dict|None:
+        raw = self.remove(keys=[self.requestsKey, self.deadlinesKey], args=[userId, carType or '', self.geoPrefix, requestId or ''])
+        return dict(json.loads(raw), claimedBy=driverId) if raw is not None else None
+
+    def Count(self, carType: str) -> int:
+        return self.client.zcard(self.geoPrefix + carType)
+
+    def _load(self, userIds: list[str]) -> list[dict]:
+        if (not userIds):
+            return []
+        return [json.loads(raw) for raw in self.client.hmget(self.requestsKey, userIds) if raw is not None]
+
+    def All(self, carType: str, limit: int|None = None) -> list[dict]:
+        return self._load(self.client.zrange(self.geoPrefix + carType, 0, -1 if limit is None else limit - 1))
+
+    def Nearest(self, carType: str, lat: float, long: float, k: int = 20, radiusKm: float|None = None) -> list[dict]:
+        found = self.client.geosearch(self.geoPrefix + carType, longitude=long, latitude=lat, radius=radiusKm or 20000, unit='km',
+                                      sort='ASC', count=k, withdist=True)
+        distances = {userId: distance for userId, distance in found}
+        return [dict(rideRequest, distance=round(distances[rideRequest['userId']], 2)) for rideRequest in self._load(list(distances))]
+
+# "memory" (the default) or a redis:// url
+def createStateBackend(url: str|None, pendingTtl: float|None = None, pendingMaxSize: int|None = None):
+    if (not url or url == 'memory'):
+        return MemoryStateBackend(pendingTtl, pendingMaxSize)
+    return RedisStateBackend(url, pendingTtl=pendingTtl, pendingMaxSize=pendingMaxSize)
@@ -0,0 +1,118 @@
+from datetime import datetime
+from threading import Lock
+import time
+from ridelib.geo import haversine
+from ridelib import metrics
+
+updates = metrics.counter('driver_location_updates_total', 'Driver location updates by whether they were sent on to the ride', ('result',))
+trackWrites = metrics.counter('ride_track_points_total', 'Points of ride tracks written to the database')
+
+# coordinates are sent and stored as integers of 1e-5 degrees (about a meter)
+SCALE = 100000
+
+# follows the driver's location during a ride: the driver's browser can send its position as often as it likes, but only
+# updates that come at most maxHz times a second and moved at least minMeters are passed on to the ride's room
+# frames are delta encoded: {'s': seq, 'k': [lat, long]} is a keyframe, {'s': seq, 'd': [dLat, dLong]} is a change from the
+# frame before it (clients that miss a frame wait for the next keyframe, one is sent every keyframeEvery frames)
+# the stored track only keeps a point every keepMeters and is written to the tracks collection in batches of batchSize
+# points (or every flushSeconds), one document per batch ({rideId, points: [[lat, long, time], ...]})
+# rides are forgotten when they arrive, or by Expire once their driver hasn't been heard from for idleSeconds
+class RideTracker():
+    def __init__(self, tracks, maxHz: float = 1, minMeters: float = 5, keepMeters: float = 25, batchSize: int = 20,
+                 flushSeconds: float = 30, keyframeEvery: int = 10, idleSeconds: float = 900, clock=time.monotonic):
+        self.tracks = tracks
+        self.minInterval = 1 / maxHz
+        self.minMeters = minMeters
+        self.keepMeters = keepMeters
+        self.batchSize = batchSize
+        self.flushSeconds = flushSeconds
+        self.keyframeEvery = keyframeEvery
+        self.idleSeconds = idleSeconds
+        self.clock = clock
+        self.rides = {} # rideId -> state of the ride that is being tracked
+        self.lock = Lock()
+
+    # start following a ride, only its driver can send locations for it
+    def Start(self, rideId: str, driverId: str) -> None:
+        with self.lock:
+            now = self.clock()
+            if (rideId not in self.rides):
+                self.rides[rideId] = {'driverId': driverId, 'seq': 0, 'sentAt': None, 'sent': None, 'kept': None, 'points': [], 'flushedAt': now}
+            self.rides[rideId]['seenAt'] = now
+
+    # returns the frame to send to the ride's room, or None if the update was dropped
+    def Update(self, rideId: str, driverId: str, lat: float, long: float) -> dict|None:
+        try:
+            lat, long = float(lat), float(long)
+        except (TypeError, ValueError):
+            lat = long = float('nan')
+        if (not (-90 <= lat <= 90 and -180 <= long <= 180)): # also catches nan
+            updates.Inc('rejected')
+            return None
+        now = self.clock()
+        batch = None
+        with self.lock:
+            ride = self.rides.get(rideId)
+            if (ride is None or ride['driverId'] != driverId):
+                updates.Inc('rejected')
+                return None
+            ride['seenAt'] = now
+            point = (round(lat * SCALE), round(long * SCALE))
+            if (ride['kept'] is None or haversine(*ride['kept'], lat, long) * 1000 >= self.keepMeters):
+                ride['kept'] = (lat, long)
+                ride['points'].append([point[0], point[1], datetime.now().isoformat(timespec='seconds')])
+            if (len(ride['points']) >= self.batchSize or (ride['points'] and now - ride['flushedAt'] >= self.flushSeconds)):
+                batch, ride['points'], ride['flushedAt'] = ride['points'], [], now
+
+            frame = None
+            sent = ride['sent']
+            if (sent is None or (now - ride['sentAt'] >= self.minInterval and haversine(sent[0] / SCALE, sent[1] / SCALE, lat, long) * 1000 >= self.minMeters)):
+                ride['seq'] += 1
+                if (sent is None or ride['seq'] % self.keyframeEvery == 0):
+                    frame = {'s': ride['seq'], 'k': list(point)}
+                else:
+                    frame = {'s': ride['seq'], 'd': [point[0] - sent[0], point[1] - sent[1]]}
+                ride['sent'], ride['sentAt'] = point, now
+        if (batch):
+            self._write(rideId, batch)
+        updates.Inc('dropped' if frame is None else 'sent')
+        return frame
+
+    # a keyframe of where the driver was last seen (for someone who just opened the ride page), None if nothing was sent yet
+    def Position(self, rideId: str) -> dict|None:
+        with self.lock:
+            ride = self.rides.get(rideId)
+            if (ride is None or ride['sent'] is None):
+                return None
+            return {'s': ride['seq'], 'k': list(ride['sent'])}
+
+    # stop following a ride and store whatever is left of its track
+    def Finish(self, rideId: str) -> None:
+        with self.lock:
+            ride = self.rides.pop(rideId, None)
+        if (ride is not None and ride['points']):
+            self._write(rideId, ride['points'])
+
+    # forget rides whose driver went quiet (they never pressed "Arrived" or closed the page) and store what is left of
+    # their tracks, returns their ids
+    def Expire(self) -> list[str]:
+        cutoff = self.clock() - self.idleSeconds
+        with self.lock:
+            expired = {rideId: ride for rideId, ride in self.rides.items() if ride['seenAt'] <= cutoff}
+            for rideId in expired:
+                del self.rides[rideId]
+        for rideId, ride in expired.items():
+            if (ride['points']):
+                self._write(rideId, ride['points'])
+        return list(expired)
+
+    def _write(self, rideId: str, points: list) -> None:
+        self.tracks.insert_one({'rideId': rideId, 'points': points})
+        trackWrites.Inc(amount=len(points))
+
+    # the stored track of a ride as [[lat, long, time], ...] in degrees, oldest first
+    def Track(self, rideId: str) -> list[list]:
+        points = []
+        for batch in self.tracks.find({'rideId': rideId}, {'points': 1}).sort('_id', 1):
+            points.extend([lat / SCALE, long / SCALE, at] for lat, long, at in batch['points'])
+        return points
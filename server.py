@@ -0,0 +1,23 @@
+# the production entry point: python server.py
+# ASYNC_MODE=eventlet (the default here) or gevent serves every http request and socket.io connection from green threads,
+# so an idle connection costs a little memory instead of a whole os thread; ASYNC_MODE=threading is the plain threaded server
+# (see "Running In Production" in TechnicalDocs.md for the settings and how to size them)
+from os import getenv
+
+ASYNC_MODE = getenv('ASYNC_MODE', 'eventlet')
+
+# the standard library has to be patched before anything (pymongo, requests, smtplib, threading) is imported
+if (ASYNC_MODE == 'eventlet'):
+    import eventlet
+    eventlet.monkey_patch()
+elif (ASYNC_MODE == 'gevent'):
+    from gevent import monkey
+    monkey.patch_all()
+
+from extensions import socketio
+from main import create_app
+
+if __name__ == '__main__':
+    app = create_app({'ASYNC_MODE': ASYNC_MODE})
+    socketio.run(app, host=getenv('HOST', '0.0.0.0'), port=int(getenv('PORT', 5000)), log_output=getenv('ACCESS_LOG', 'false').lower() == 'true',
+                 allow_unsafe_werkzeug=ASYNC_MODE == 'threading') # the threaded mode is werkzeug's server, only meant for small deployments
@@ -1,12 +1,11 @@
-function createSocket(namespace, sessionId) {
+function createSocket(namespace, sessionId, extra, onJoined) {
     window.socket = io.connect('http://' + location.hostname + ':' + location.port + namespace);
+    window.socket.on('refresh', function() {
+        location.reload();
+    });
+    // join again after every reconnect (a new connection starts without any rooms), onJoined runs once the server has joined us
     window.socket.on('connect', function() {
-        window.socket.on('refresh', function() {
-            location.reload();
-        });
+        if (sessionId)
+            window.socket.emit('join', Object.assign({ id: sessionId }, extra || {}), onJoined || function() {});
     });
-
-    if (sessionId)
-        window.socket.emit('join', { id: sessionId });
-
-}
\ No newline at end of file
+}
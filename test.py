@@ -1,6 +1,33 @@
+import os
+import tempfile
+import threading
+import time
 import unittest
 
-from main import app
+from main import create_app
+from auth import User, prepareImage
+from types import SimpleNamespace
+from mongolib.connection import CommandMetrics
+from mongolib.object import MongoObject
+from ridelib.active import ActiveRides
+from ridelib.broadcast import RideRequestBroadcaster
+from ridelib.chat import ChatStore
+from datetime import datetime
+from ridelib.driverstore import DriverStore
+from ridelib.fares import DEFAULT_RATES, FareEngine
+from ridelib.geo import haversine
+from ridelib.geocoding import Geocoder, GeocodingError, NominatimUpstream, StaticUpstream
+from ridelib.indexes import ensureIndexes
+from ridelib.matching import DriverAvailability
+from ridelib.metrics import Histogram
+from ridelib.outbox import MemoryTransport, Outbox
+from ridelib.passwords import PasswordHasher, PasswordServiceBusy, RateLimiter
+from ridelib.pending import PendingRideStore
+from ridelib.repository import RideRepository
+from ridelib.state import RedisStateBackend
+from ridelib.tracking import RideTracker
+
+app = create_app({'MAIL_BACKEND': 'memory', 'ENSURE_INDEXES': False})
 
 class Test(unittest.TestCase):
     def setUp(self):
@@ -21,4 +48,514 @@ class Test(unittest.TestCase):
 
     def test_profile_route(self):
         response = self.app.get("/profiles/profile")
-        self.assertEqual(response.status_code, 302)
\ No newline at end of file
+        self.assertEqual(response.status_code, 302)
+
+    def test_admin_users_invalid_after(self):
+        with self.app.session_transaction() as session:
+            session['admin'] = time.time()
+        response = self.app.get("/auth/admin/users?after=not-an-id")
+        self.assertEqual(response.status_code, 400) # rejected before mongo is queried
+
+    def test_admin_session(self):
+        with self.app.session_transaction() as session:
+            session['admin'] = time.time() - app.config['ADMIN_SESSION_SECONDS'] - 1
+        self.assertEqual(self.app.get("/auth/admin/users").status_code, 302) # expired
+        with self.app.session_transaction() as session:
+            session['admin'] = time.time()
+        self.app.get("/auth/logout")
+        self.assertEqual(self.app.get("/auth/admin/users").status_code, 302)
+
+class FareEngineTest(unittest.TestCase):
+    def test_quotes(self):
+        engine = FareEngine(rates={'default': {'base': 2, 'perKm': 1, 'perMinute': 0, 'minimum': 5}, 'van': {'base': 4, 'perKm': 2, 'perMinute': 0, 'minimum': 5}},
+                            hourlyMultipliers=[1] * 17 + [2] + [1] * 6, roadFactor=1)
+        noon, rushHour = datetime(2024, 1, 1, 12), datetime(2024, 1, 1, 17)
+        trip = (32.08, 34.78, 32.18, 34.88)
+        distance = haversine(*trip)
+        quotes = engine.Quotes(['sedan', 'van', 'sedan'], [trip[0], trip[0], 32.0], [trip[1], trip[1], 35.0], [trip[2], trip[2], 32.0], [trip[3], trip[3], 35.0], noon)
+        self.assertAlmostEqual(quotes[0]['fare'], 2 + distance, places=2) # unknown car types use the default rates
+        self.assertAlmostEqual(quotes[1]['fare'], 4 + 2 * distance, places=2)
+        self.assertEqual(quotes[2]['fare'], 5) # a trip that goes nowhere still costs the minimum
+        self.assertEqual(quotes[0]['minutes'], round(distance / 30 * 60))
+        rushQuote = engine.Quotes(['sedan'], [trip[0]], [trip[1]], [trip[2]], [trip[3]], rushHour)[0]
+        self.assertAlmostEqual(rushQuote['fare'], 2 * (2 + distance), places=2)
+
+    def test_rate_overrides(self):
+        # overriding one car type keeps the default rates for everything else
+        engine = FareEngine(rates={'van': {'base': 0, 'perKm': 0, 'perMinute': 0, 'minimum': 1}})
+        quotes = engine.Quotes(['sedan', 'van'], [32.0] * 2, [35.0] * 2, [32.0] * 2, [35.0] * 2)
+        self.assertEqual([quote['fare'] for quote in quotes], [DEFAULT_RATES['default']['minimum'], 1])
+        with self.assertRaises(ValueError):
+            FareEngine(rates={'van': {'base': 1}})
+        with self.assertRaises(ValueError):
+            FareEngine(hourlyMultipliers=[1] * 23)
+
+class RideTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = [0.0]
+        self.written = []
+        self.tracker = RideTracker(SimpleNamespace(insert_one=self.written.append), maxHz=1, minMeters=5, keepMeters=25, batchSize=2,
+                                   flushSeconds=60, keyframeEvery=3, clock=lambda: self.now[0])
+        self.tracker.Start('ride1', 'driver1')
+
+    def update(self, lat, long, seconds=1):
+        self.now[0] += seconds
+        return self.tracker.Update('ride1', 'driver1', lat, long)
+
+    def test_frames(self):
+        self.assertIsNone(self.tracker.Update('ride1', 'someone else', 32.0, 34.0))
+        self.assertEqual(self.update(32.0, 34.0), {'s': 1, 'k': [3200000, 3400000]})
+        self.assertIsNone(self.update(32.0001, 34.0, seconds=0.5)) # too soon
+        self.assertIsNone(self.update(32.00001, 34.0)) # about a meter away
+        self.assertEqual(self.update(32.0001, 33.9999), {'s': 2, 'd': [10, -10]})
+        self.assertEqual(self.update(32.0002, 33.9999), {'s': 3, 'k': [3200020, 3399990]})
+        self.assertEqual(self.tracker.Position('ride1'), {'s': 3, 'k': [3200020, 3399990]})
+        self.assertIsNone(self.update('nowhere', 34.0))
+
+    def test_track(self):
+        self.update(32.0, 34.0)
+        self.update(32.0001, 34.0) # 11m from the last kept point, sent but not stored
+        self.assertEqual(self.written, [])
+        self.update(32.001, 34.0) # the second stored point fills the batch
+        self.assertEqual([point[:2] for point in self.written[0]['points']], [[3200000, 3400000], [3200100, 3400000]])
+        self.update(32.002, 34.0)
+        self.tracker.Finish('ride1')
+        self.assertEqual([len(batch['points']) for batch in self.written], [2, 1])
+        self.assertIsNone(self.tracker.Position('ride1'))
+        self.assertIsNone(self.update(32.003, 34.0))
+
+    def test_expire(self):
+        self.tracker.idleSeconds = 60
+        self.tracker.Start('ride2', 'driver2')
+        self.update(32.0, 34.0, seconds=30)
+        self.now[0] += 40 # ride1 was heard from 40 seconds ago, ride2 70 seconds ago
+        self.assertEqual(self.tracker.Expire(), ['ride2'])
+        self.now[0] += 30
+        self.assertEqual(self.tracker.Expire(), ['ride1'])
+        self.assertEqual(len(self.written), 1) # ride1's unwritten point was stored
+        self.assertEqual(self.tracker.rides, {})
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test', ('route',), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.Observe(value, '/ride/<rideId>')
+        lines = histogram.Render()
+        self.assertIn('test_seconds_bucket{route="/ride/<rideId>",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{route="/ride/<rideId>",le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{route="/ride/<rideId>",le="+Inf"} 3', lines)
+        self.assertEqual(histogram.Value('/ride/<rideId>'), (3, 5.55))
+
+    def test_metrics_route(self):
+        client = app.test_client()
+        client.get("/auth/login")
+        self.assertEqual(client.get("/metrics").status_code, 403) # even from localhost (that's what a reverse proxy looks like)
+        app.config['METRICS_TOKEN'] = 'scraper-token'
+        try:
+            response = client.get("/metrics", headers={'Authorization': 'Bearer scraper-token'})
+            self.assertEqual(client.get("/metrics", headers={'Authorization': 'Bearer guess'}).status_code, 403)
+        finally:
+            app.config['METRICS_TOKEN'] = None
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('http_request_seconds_count{route="/auth/login",method="GET",status="200"}', response.get_data(as_text=True))
+
+class PendingRideStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = PendingRideStore()
+
+    def rideRequest(self, userId, lat, long, carType='sedan'):
+        return {'userId': userId, 'pickup': {'lat': str(lat), 'long': str(long)}, 'carType': carType}
+
+    def test_nearest(self):
+        self.store.Add(self.rideRequest('far', 32.5, 35.5))
+        self.store.Add(self.rideRequest('near', 32.01, 35.01))
+        self.store.Add(self.rideRequest('middle', 32.1, 35.1))
+        self.store.Add(self.rideRequest('other', 32.0, 35.0, carType='van'))
+        nearest = self.store.Nearest('sedan', 32.0, 35.0, k=2)
+        self.assertEqual([i['userId'] for i in nearest], ['near', 'middle'])
+        nearest = self.store.Nearest('sedan', 32.0, 35.0, k=10, radiusKm=5)
+        self.assertEqual([i['userId'] for i in nearest], ['near'])
+
+    def test_remove(self):
+        self.store.Add(self.rideRequest('rider', 32.0, 35.0))
+        self.assertIsNone(self.store.Remove('rider', carType='van'))
+        self.assertEqual(self.store.Remove('rider')['userId'], 'rider')
+        self.assertIsNone(self.store.Remove('rider'))
+        self.assertEqual(self.store.Count('sedan'), 0)
+        self.assertEqual(self.store.Nearest('sedan', 32.0, 35.0), [])
+
+    def test_claim(self):
+        self.store.Add(dict(self.rideRequest('rider', 32.0, 35.0), requestId='old'))
+        self.store.Add(dict(self.rideRequest('rider', 32.0, 35.0), requestId='new'))
+        self.assertIsNone(self.store.Claim('rider', 'driver1', 'sedan', 'old')) # replaced by a newer request
+        self.assertEqual(self.store.Claim('rider', 'driver1', 'sedan', 'new')['requestId'], 'new')
+        self.assertIsNone(self.store.Claim('rider', 'driver2', 'sedan', 'new'))
+        self.assertNotIn('rider', self.store)
+
+    def test_expire(self):
+        now = [1000.0]
+        self.store.clock = lambda: now[0]
+        self.store.ttl = 60
+        self.store.Add(self.rideRequest('old', 32.0, 35.0))
+        now[0] += 30
+        self.store.Add(self.rideRequest('new', 32.0, 35.0))
+        self.store.Add(self.rideRequest('claimed', 32.0, 35.0))
+        self.store.Remove('claimed')
+        self.assertEqual(self.store.Expire(), [])
+        now[0] += 31
+        self.assertEqual([i['userId'] for i in self.store.Expire()], ['old'])
+        self.assertEqual([i['userId'] for i in self.store.Nearest('sedan', 32.0, 35.0)], ['new'])
+
+    def test_max_size(self):
+        self.store.maxSize = 2
+        self.assertEqual(self.store.Add(self.rideRequest('first', 32.0, 35.0)), [])
+        self.store.Add(self.rideRequest('second', 32.0, 35.0))
+        evicted = self.store.Add(self.rideRequest('third', 32.0, 35.0))
+        self.assertEqual([i['userId'] for i in evicted], ['first'])
+        self.assertEqual(len(self.store), 2)
+
+
+class DriverAvailabilityTest(unittest.TestCase):
+    def test_closest(self):
+        availability = DriverAvailability()
+        availability.Available('far', 'sedan', 32.5, 35.5)
+        availability.Available('near', 'sedan', 32.01, 35.01)
+        availability.Available('van', 'van', 32.0, 35.0)
+        self.assertEqual(availability.Closest('sedan', 32.0, 35.0), 'near')
+        availability.Busy('near')
+        self.assertEqual(availability.Closest('sedan', 32.0, 35.0), 'far')
+        availability.Busy('far')
+        self.assertIsNone(availability.Closest('sedan', 32.0, 35.0))
+        availability.Available('unlocated', 'sedan')
+        self.assertEqual(availability.Closest('sedan', 32.0, 35.0), 'unlocated')
+
+    def test_invalid_location(self):
+        availability = DriverAvailability()
+        for i, (lat, long) in enumerate([('north', 35.0), (float('nan'), 35.0), (float('inf'), 35.0), (91, 35.0)]):
+            availability.Available(f"driver{i}", 'sedan', lat, long) # treated as unlocated instead of raising
+        self.assertEqual(availability.Count('sedan'), 4)
+        self.assertEqual(len(availability), 4)
+
+
+class RideRequestBroadcasterTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.scheduled = []
+        self.availability = DriverAvailability()
+        self.availability.Available('near', 'sedan', 32.08, 34.78)
+        self.availability.Available('far', 'sedan', 31.25, 34.79) # beer sheva, ~90km away
+        self.availability.Available('unlocated', 'sedan')
+        self.broadcaster = RideRequestBroadcaster(lambda carType, driverId, frame: self.sent.append((driverId, frame)), self.availability,
+                                                  window=0.25, radiusKm=15, spawn=self.scheduled.append)
+
+    def request(self, userId, lat=32.09, long=34.78):
+        return {'userId': userId, 'requestId': f"{userId}-request", 'carType': 'sedan', 'pickup': {'lat': lat, 'long': long}}
+
+    def test_coalesce(self):
+        for i in range(50):
+            self.broadcaster.Added(self.request(f"rider{i}"))
+        self.broadcaster.Removed(self.request('rider0'))
+        self.assertEqual(len(self.scheduled), 1) # one flush for the whole burst
+        self.broadcaster.Flush()
+        frames = dict(self.sent)
+        self.assertEqual(set(frames), {'near', 'unlocated'}) # the far driver doesn't hear about requests across the country
+        self.assertEqual(len(frames['near']['added']), 49)
+        self.assertEqual(frames['near']['removed'], ['rider0'])
+        self.assertIn('distance', frames['near']['added'][0])
+
+    def test_no_radius(self):
+        self.broadcaster.radiusKm = 0
+        self.broadcaster.window = 0
+        self.broadcaster.Added(self.request('rider1'))
+        self.assertEqual(self.sent, [(None, {'added': [self.request('rider1')], 'removed': []})])
+
+class GeocoderTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'geocode.db')
+        self.upstream = StaticUpstream({'Ben Gurion Airport': (32.0055, 34.8854)})
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_cache(self):
+        geocoder = Geocoder(self.upstream, self.path)
+        self.assertEqual(geocoder.Lookup('Ben Gurion Airport'), (32.0055, 34.8854))
+        self.assertEqual(geocoder.Lookup('  ben gurion   AIRPORT,'), (32.0055, 34.8854))
+        self.assertIsNone(geocoder.Lookup('nowhere'))
+        self.assertIsNone(geocoder.Lookup('Nowhere'))
+        self.assertEqual(self.upstream.calls, 2)
+        # a new process starts with an empty memory cache but still has the disk cache
+        geocoder = Geocoder(self.upstream, self.path)
+        self.assertEqual(geocoder.Lookup('ben gurion airport'), (32.0055, 34.8854))
+        self.assertEqual(self.upstream.calls, 2)
+
+    def test_coalescing(self):
+        gate = threading.Event()
+        def slowUpstream(address):
+            gate.wait()
+            return self.upstream(address)
+        geocoder = Geocoder(slowUpstream, self.path)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(geocoder.Lookup('Ben Gurion Airport'))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [(32.0055, 34.8854)] * 8)
+        self.assertEqual(self.upstream.calls, 1)
+
+    def test_unexpected_answer(self):
+        upstream = NominatimUpstream()
+        for answer in ([{'lat': 'north', 'lon': '34.8'}], [{'lat': '32.0'}], {'error': 'rate limited'}):
+            upstream.session = SimpleNamespace(get=lambda *args, **kwargs: SimpleNamespace(status_code=200, json=lambda: answer))
+            with self.assertRaises(GeocodingError):
+                upstream('Ben Gurion Airport')
+
+    def test_coalesced_error(self):
+        gate = threading.Event()
+        def brokenUpstream(address):
+            gate.wait()
+            raise ValueError("not json")
+        geocoder = Geocoder(brokenUpstream, self.path)
+        errors = []
+        def lookup():
+            try:
+                geocoder.Lookup('Ben Gurion Airport')
+            except ValueError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=lookup) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 4) # the waiters get the leader's error, not None
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'outbox.db')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_batching(self):
+        transport = MemoryTransport()
+        outbox = Outbox(transport, self.path, batchSize=10)
+        for i in range(25):
+            outbox.Enqueue(f"subject {i}", "body", "no-reply@company.com", ["rider@company.com"])
+        self.assertEqual([outbox.Flush() for _ in range(4)], [10, 10, 5, 0])
+        self.assertEqual(transport.batches, 3)
+        self.assertEqual(transport.sent[0]['recipients'], ["rider@company.com"])
+
+    def test_retry(self):
+        class FailingTransport():
+            def SendBatch(self, messages):
+                raise ConnectionError("smtp is down")
+        outbox = Outbox(FailingTransport(), self.path, retryDelay=0)
+        outbox.Enqueue("subject", "body", "no-reply@company.com", ["rider@company.com"])
+        self.assertEqual(outbox.Flush(), 0)
+        self.assertEqual(outbox.Pending(), 1)
+        outbox.transport = MemoryTransport()
+        self.assertEqual(outbox.Flush(), 1)
+        self.assertEqual(outbox.Pending(), 0)
+
+    def test_claim(self):
+        # two processes sharing one outbox.db never send the same message
+        first, second = MemoryTransport(), MemoryTransport()
+        outboxes = [Outbox(first, self.path, batchSize=2), Outbox(second, self.path, batchSize=2)]
+        for i in range(3):
+            outboxes[0].Enqueue(f"subject {i}", "body", "no-reply@company.com", ["rider@company.com"])
+        class ClaimingTransport():
+            # the first process's batch is still being sent when the second one flushes
+            def SendBatch(self, messages):
+                outboxes[1].Flush()
+                return first.SendBatch(messages)
+        outboxes[0].transport = ClaimingTransport()
+        outboxes[0].Flush()
+        self.assertEqual([i['subject'] for i in first.sent], ["subject 0", "subject 1"])
+        self.assertEqual([i['subject'] for i in second.sent], ["subject 2"])
+
+
+class ImageUploadTest(unittest.TestCase):
+    def upload(self, filename, contentType):
+        from io import BytesIO
+        from werkzeug.datastructures import FileStorage
+        return prepareImage(FileStorage(BytesIO(b'<script>alert(1)</script>'), filename=filename, content_type=contentType))
+
+    def test_content_type(self):
+        self.assertIsNone(self.upload('page.html', 'text/html'))
+        # the browser's content type is never stored (with pillow installed this isn't an image at all)
+        prepared = self.upload('x.png', 'text/html')
+        self.assertTrue(prepared is None or prepared['contentType'] == 'image/png')
+
+class UserCacheTest(unittest.TestCase):
+    def test_cached_user(self):
+        user = User('0123456789ab0123456789ab', 'rider', 'hash', 'rider@company.com', False, None)
+        User.cache.Set(user.id, user)
+        with app.app_context():
+            loaded = User.GetUserById(user.id)
+            self.assertIsNot(loaded, user) # requests get their own copy
+            self.assertEqual(loaded.username, 'rider')
+            self.assertIs(User.GetUserById(user.id), loaded) # memoized for the rest of the request
+            User.ForgetUser(user.id)
+        self.assertIsNone(User.cache.Get(user.id))
+
+
+class Point(MongoObject):
+    __slots__ = ('lat', 'long')
+
+    def __init__(self, lat: float, long: float):
+        self.lat = lat
+        self.long = long
+
+class Route(MongoObject):
+    def __init__(self, id: str, name: str, start: Point, stops: list[Point]):
+        self.id = id
+        self.name = name
+        self.start = start
+        self.stops = stops
+
+class CodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        route = Route('0123456789ab0123456789ab', 'airport', Point(32.0, 34.8), [Point(32.1, 34.9), Point(32.2, 35.0)])
+        document = route.MongoSafeObject()
+        self.assertEqual(document, {'name': 'airport', 'start': {'lat': 32.0, 'long': 34.8},
+                                    'stops': [{'lat': 32.1, 'long': 34.9}, {'lat': 32.2, 'long': 35.0}]})
+        document['_id'] = route.id
+        document['unknown'] = True # fields that aren't constructor arguments are ignored
+        loaded = Route.convertBack(document)
+        self.assertEqual(loaded.id, route.id)
+        self.assertIsInstance(loaded.start, Point)
+        self.assertEqual([i.long for i in loaded.stops], [34.9, 35.0])
+
+
+class DriverStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.store = DriverStore(os.path.join(self.tempdir.name, 'drivers.db'), poolSize=2)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_catalog(self):
+        self.assertEqual(self.store.CarTypes(), [])
+        self.store.Insert('driver1', 'sedan', 'Toyota', 'Corolla', '2020', 'White', '123')
+        self.store.Insert('driver2', 'van', 'Ford', 'Transit', '2018', 'Blue', '456')
+        self.assertEqual(self.store.CarTypes(), ['sedan', 'van'])
+        self.store.Update('driver2', 'sedan', 'Ford', 'Transit', '2018', 'Blue', '456')
+        self.assertEqual(self.store.CarTypes(), ['sedan'])
+        self.assertEqual(self.store.Get('driver2')[1], 'sedan')
+        self.assertIsNone(self.store.Get('nobody'))
+
+    def test_pool(self):
+        self.store.Insert('driver1', 'sedan', 'Toyota', 'Corolla', '2020', 'White', '123')
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.store.Get('driver1')[0])) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['driver1'] * 20)
+        self.assertLessEqual(self.store.created, 2)
+
+class PasswordTest(unittest.TestCase):
+    def test_hash(self):
+        hasher = PasswordHasher(rounds=4, workers=0)
+        hashed = hasher.Hash('hunter2')
+        self.assertTrue(hasher.Check('hunter2', hashed))
+        self.assertFalse(hasher.Check('hunter3', hashed))
+        self.assertFalse(hasher.NeedsRehash(hashed))
+        hasher.rounds = 5 # the cost went up, old hashes get replaced on the next login
+        self.assertTrue(hasher.NeedsRehash(hashed))
+
+    def test_admin_busy(self):
+        class BusyHasher():
+            def Check(self, password, hashed):
+                raise PasswordServiceBusy()
+        passwords = app.extensions['passwords']
+        app.extensions['passwords'] = BusyHasher()
+        app.config['WTF_CSRF_ENABLED'] = False
+        try:
+            response = app.test_client().post("/auth/admin", data={'username': 'admin', 'password': 'hunter2'})
+        finally:
+            app.extensions['passwords'] = passwords
+            app.config['WTF_CSRF_ENABLED'] = True
+        self.assertEqual(response.status_code, 503)
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        limiter = RateLimiter(2, 60, clock=lambda: now[0])
+        self.assertTrue(limiter.Hit('user'))
+        self.assertTrue(limiter.Hit('user'))
+        self.assertFalse(limiter.Hit('user'))
+        self.assertTrue(limiter.Hit('other'))
+        now[0] += 61
+        self.assertTrue(limiter.Hit('user'))
+
+class MongoDataAccessTest(unittest.TestCase):
+    def test_command_metrics(self):
+        metrics = CommandMetrics()
+        seen = []
+        metrics.observers.append(lambda *args: seen.append(args))
+        for requestId, (command, micros, failed) in enumerate([('find', 1000, False), ('find', 3000, True), ('insert', 500, False)]):
+            metrics.started(SimpleNamespace(command_name=command, command={command: 'rides'}, connection_id=('localhost', 27017), request_id=requestId))
+            finished = SimpleNamespace(command_name=command, connection_id=('localhost', 27017), request_id=requestId, duration_micros=micros)
+            (metrics.failed if failed else metrics.succeeded)(finished)
+        self.assertEqual(metrics.Snapshot()[0], ('find', 'rides', 2, 1, 0.004, 0.003))
+        self.assertEqual(len(seen), 3)
+
+    def test_migrate_embedded_chats(self):
+        legacy = {'_id': 'ride1', 'chat': [{'sender': 'rider', 'message': str(i)} for i in range(3)]}
+        buckets, updates = [], []
+        rides = SimpleNamespace(find=lambda query, projection: [legacy], update_one=lambda query, update: updates.append(update))
+        store = ChatStore(rides, SimpleNamespace(replace_one=lambda query, bucket, upsert: buckets.append(bucket)), bucketSize=2)
+        indexes = {}
+        db = {name: SimpleNamespace(index_information=lambda name=name: indexes.setdefault(name, {}),
+                                    create_index=lambda keys, name, **options: None, update_many=lambda *args: None)
+              for name in ('rides', 'users', 'chatBuckets', 'fs.files', 'rideTracks')}
+        # the migration runs with the first creation of the bucket index
+        ensureIndexes(db, {('chatBuckets', 'rideId_bucket'): lambda db: store.MigrateEmbedded()})
+        self.assertEqual([[i['seq'] for i in bucket['messages']] for bucket in buckets], [[1, 2], [3]])
+        self.assertEqual(updates, [{'$unset': {'chat': ''}, '$set': {'chatSeq': 3}}]) # new messages continue from 4
+
+    def test_active_ride_finished_elsewhere(self):
+        rideId = '0123456789ab0123456789ab'
+        active = {rideId}
+        def findOne(query, projection):
+            if ('_id' in query):
+                return {'_id': query['_id']} if str(query['_id']) in active else None
+            return {'_id': rideId} if active else None
+        activeRides = ActiveRides(SimpleNamespace(find_one=findOne))
+        activeRides.Started(rideId, 'driver1', 'rider1')
+        self.assertEqual(activeRides.ForUser('rider1', False), rideId)
+        active.clear() # another process finished the ride, this one never heard about it
+        self.assertIsNone(activeRides.ForUser('rider1', False))
+
+    def test_invalid_ride_id(self):
+        # an id that can't be an ObjectId never reaches mongo
+        repository = RideRepository(None)
+        self.assertIsNone(repository.FindForUser('not-an-id', 'user1'))
+        self.assertIsNone(repository.Find('1234'))
+
+# needs a local redis server, for example: redis-server --port 6390 & REDIS_URL=redis://localhost:6390/15 python -m pytest test.py
+@unittest.skipUnless(os.getenv('REDIS_URL'), "REDIS_URL isn't set")
+class RedisStateBackendTest(PendingRideStoreTest):
+    def setUp(self):
+        self.backend = RedisStateBackend(os.getenv('REDIS_URL'), prefix=f"test-{time.time()}")
+        self.store = self.backend.pending
+
+    def tearDown(self):
+        for key in self.backend.client.scan_iter(f"{self.backend.prefix}:*"):
+            self.backend.client.delete(key)
+
+    def test_sessions(self):
+        sessions = self.backend.Sessions('rideExchange')
+        sessions['rider'] = 'sid'
+        self.assertEqual(self.backend.Sessions('rideExchange').get('rider'), 'sid')
+        self.assertEqual(sessions.pop('rider'), 'sid')
+        self.assertNotIn('rider', sessions)